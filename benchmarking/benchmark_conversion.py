@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+'''Benchmark conversion of FASTQ to FASTA by the awk and builtin conversion
+engines, from FASTQ and FASTQ.GZ to FASTA and FASTA.GZ.
+
+Throughput is given in MB of uncompressed FASTQ per second. Each case is run
+in a fresh process, so that its peak memory use, and that of the processes
+it runs, can be measured. Cases which need programs that are not installed
+are skipped. e.g.
+
+    python benchmarking/benchmark_conversion.py --output conversion.json --size-mb 1024 --threads 8
+'''
+
+import argparse
+import datetime
+import gzip
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import socket
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')] + sys.path
+
+import kingfisher
+from kingfisher import _convert_fastq_to_fasta
+from kingfisher.metrics import MetricsRecorder
+
+from benchmark_get import git_commit, write_fastq_gz
+from stand_in_servers import which_missing
+
+
+def all_cases(threads):
+    cases = []
+    for input_format in ['fastq', 'fastq.gz']:
+        for output_format in ['fasta', 'fasta.gz']:
+            programs = ['pigz'] if input_format.endswith('.gz') or output_format.endswith('.gz') else []
+            cases.append(('{}-to-{}/awk'.format(input_format, output_format),
+                input_format, output_format, 'awk', threads, programs + ['awk']))
+            for engine_threads in sorted(set([1, threads])):
+                cases.append(('{}-to-{}/builtin/{}-threads'.format(input_format, output_format, engine_threads),
+                    input_format, output_format, 'builtin', engine_threads, []))
+    return cases
+
+
+def run_case(input_path, output_path, engine, threads, result_queue):
+    try:
+        start = time.time()
+        _convert_fastq_to_fasta('SRR1', input_path, output_path, engine, threads, MetricsRecorder())
+        seconds = time.time() - start
+        result_queue.put({
+            'status': 'ok',
+            'seconds': seconds,
+            'output_bytes': os.path.getsize(output_path),
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'peak_child_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        })
+    except Exception as e:
+        result_queue.put({'status': 'failed', 'reason': str(e)})
+    finally:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', required=True, help='JSON file to write results to')
+    parser.add_argument('--size-mb', type=float, default=256, help='Size of the uncompressed FASTQ [default: 256]')
+    parser.add_argument('--threads', type=int, default=8, help='Threads for pigz and the builtin engine [default: 8]')
+    parser.add_argument('--repeats', type=int, default=3, help='Number of times to run each case [default: 3]')
+    parser.add_argument('--scratch-directory', help='Directory to write data to [default: a temporary directory]')
+    parser.add_argument('--debug', action='store_true', help='Show debug logging')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
+        format='%(asctime)s %(levelname)s: %(message)s')
+
+    scratch_directory = tempfile.mkdtemp(dir=args.scratch_directory, prefix='kingfisher-benchmark')
+    results = []
+    try:
+        inputs = {
+            'fastq.gz': os.path.join(scratch_directory, 'SRR1.fastq.gz'),
+            'fastq': os.path.join(scratch_directory, 'SRR1.fastq'),
+        }
+        logging.info("Writing synthetic FASTQ ..")
+        write_fastq_gz(inputs['fastq.gz'], int(args.size_mb * 1024 * 1024), 'SRR1')
+        with gzip.open(inputs['fastq.gz']) as f, open(inputs['fastq'], 'wb') as g:
+            shutil.copyfileobj(f, g)
+        fastq_bytes = os.path.getsize(inputs['fastq'])
+
+        context = multiprocessing.get_context('spawn')
+        for (name, input_format, output_format, engine, threads, programs) in all_cases(args.threads):
+            missing = which_missing(programs)
+            if len(missing) > 0:
+                results.append({'case': name, 'status': 'skipped', 'reason': 'Not installed: {}'.format(', '.join(missing))})
+                continue
+            logging.info("Running case {} ..".format(name))
+            output_path = os.path.join(scratch_directory, 'SRR1.{}'.format(output_format))
+            runs = []
+            for _ in range(args.repeats):
+                result_queue = context.Queue()
+                process = context.Process(target=run_case, args=(inputs[input_format], output_path, engine, threads, result_queue))
+                process.start()
+                run = result_queue.get()
+                process.join()
+                if run['status'] != 'ok':
+                    break
+                runs.append(run)
+            if run['status'] != 'ok':
+                logging.warning("Case {} failed: {}".format(name, run['reason']))
+                results.append(dict({'case': name}, **run))
+                continue
+            median_seconds = statistics.median([r['seconds'] for r in runs])
+            result = {
+                'case': name,
+                'status': 'ok',
+                'fastq_bytes': fastq_bytes,
+                'output_bytes': runs[0]['output_bytes'],
+                'seconds': [r['seconds'] for r in runs],
+                'median_seconds': median_seconds,
+                'throughput_mb_per_second': fastq_bytes / 1e6 / median_seconds,
+                'peak_rss_kb': max([r['peak_rss_kb'] for r in runs]),
+                'peak_child_rss_kb': max([r['peak_child_rss_kb'] for r in runs]),
+            }
+            logging.info("{}: {:.2f} s, {:.1f} MB/s, peak RSS {} kB, peak child RSS {} kB".format(
+                name, median_seconds, result['throughput_mb_per_second'], result['peak_rss_kb'], result['peak_child_rss_kb']))
+            results.append(result)
+    finally:
+        shutil.rmtree(scratch_directory, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'kingfisher_version': kingfisher.__version__,
+            'git_commit': git_commit(),
+            'date': datetime.datetime.now().isoformat(),
+            'hostname': socket.gethostname(),
+            'python': platform.python_version(),
+            'parameters': {
+                'size_mb': args.size_mb,
+                'threads': args.threads,
+                'repeats': args.repeats,
+            },
+            'results': results,
+        }, f, indent=2)
+    logging.info("Wrote results to {}".format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+
+'''Benchmark downloading and extraction with kingfisher get and extract.
+
+Downloads are made from local stand-in servers serving synthetic data, so
+that the results reflect changes to Kingfisher rather than to the network:
+aws-http is pointed at an HTTP server through the NCBI location cache, and
+ena-ftp at an emulation of the ENA portal API, with the files served over
+HTTP, and over FTP when pyftpdlib is installed. Extraction is benchmarked for
+each output format, sorted and unsorted, when a real .sra file is given with
+--sra-file, since synthetic .sra files cannot be extracted.
+
+Each case is run in a fresh process, so that its peak memory use can be
+measured. Cases which need programs that are not installed are skipped.
+Results are written as JSON, and can be compared with those of a previous
+commit using --compare e.g.
+
+    python benchmarking/benchmark_get.py --output before.json
+    git checkout my-branch
+    python benchmarking/benchmark_get.py --output after.json --compare before.json
+'''
+
+import argparse
+import datetime
+import gzip
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')] + sys.path
+
+import kingfisher
+import kingfisher.ena
+from kingfisher.location import LocationCache
+
+from stand_in_servers import StandInHttpServer, StandInFtpServer, EnaRun, FTP_AVAILABLE, which_missing
+
+AWS_RUN = 'SRR9000001'
+ENA_RUN = 'ERR9000001'
+READ_LENGTH = 150
+EXTRACTION_SLICES = 4
+WRITE_SIZE = 4 * 1024 * 1024
+# Maps random bytes to nucleotides
+NUCLEOTIDES = bytes.maketrans(bytes(range(256)), b'ACGT' * 64)
+
+
+class Case:
+    '''A benchmark case. kind is 'aws-http', 'ena-ftp' or 'extract'.'''
+    def __init__(self, name, kind, required_programs, **params):
+        self.name = name
+        self.kind = kind
+        self.required_programs = required_programs
+        self.params = params
+
+
+def all_cases(download_threads):
+    cases = []
+    for (downloader, threads, programs) in [
+            ('curl', 1, ['curl']),
+            ('aria2c', download_threads, ['aria2c']),
+            ('builtin', download_threads, [])]:
+        for check_md5sums in (False, True):
+            cases.append(Case(
+                'aws-http/{}{}'.format(downloader, '/md5' if check_md5sums else ''), 'aws-http', programs,
+                http_downloader='builtin' if downloader == 'builtin' else 'external',
+                download_threads=threads, check_md5sums=check_md5sums))
+
+    for (downloader, threads, programs, ftp) in [
+            ('curl', 1, ['curl'], False),
+            ('aria2c', download_threads, ['aria2c'], True),
+            ('builtin', download_threads, [], False)]:
+        for output_format in ['fastq.gz', 'fastq', 'fasta', 'fasta.gz']:
+            cases.append(Case(
+                'ena-ftp/{}/{}'.format(downloader, output_format), 'ena-ftp',
+                programs + ['pigz'] + (['awk'] if 'fasta' in output_format else []),
+                http_downloader='builtin' if downloader == 'builtin' else 'external',
+                download_threads=threads, output_format=output_format, ftp=ftp))
+
+    for unsorted in (False, True):
+        for stdout in ((False, True) if unsorted else (False,)):
+            for output_format in ['fastq', 'fastq.gz', 'fasta', 'fasta.gz']:
+                programs = ['sracat'] if unsorted else ['fasterq-dump']
+                if output_format.endswith('.gz') and not (unsorted and output_format == 'fastq.gz' and not stdout):
+                    programs.append('pigz')
+                if output_format != 'fastq' and not unsorted:
+                    programs.append('awk')
+                cases.append(Case(
+                    'extract/{}{}/{}'.format('unsorted' if unsorted else 'sorted', '/stdout' if stdout else '', output_format),
+                    'extract', programs, output_format=output_format, unsorted=unsorted, stdout=stdout))
+    for output_format in ['fastq', 'fastq.gz', 'fasta', 'fasta.gz']:
+        cases.append(Case(
+            'extract/sorted/{}-slices/{}'.format(EXTRACTION_SLICES, output_format), 'extract',
+            ['fastq-dump', 'awk'] + (['pigz'] if output_format.endswith('.gz') else []),
+            output_format=output_format, unsorted=False, stdout=False, extraction_slices=EXTRACTION_SLICES))
+    return cases
+
+
+def write_sra_blob(path, size):
+    '''Write a file of random data with the header of a .sra file, returning
+    its md5sum.'''
+    hash_md5 = hashlib.md5()
+    with open(path, 'wb') as f:
+        data = b'NCBI.sra' + os.urandom(min(size, WRITE_SIZE) - 8)
+        written = 0
+        while written < size:
+            chunk = data[:min(len(data), size - written)]
+            f.write(chunk)
+            hash_md5.update(chunk)
+            written += len(chunk)
+            data = os.urandom(min(size - written, WRITE_SIZE))
+    return hash_md5.hexdigest()
+
+
+def write_fastq_gz(path, uncompressed_size, read_name_prefix):
+    '''Write a gzipped FASTQ file of random reads, returning its md5sum.'''
+    record_size = 2 * READ_LENGTH + 2 * len(read_name_prefix) + 30
+    num_reads = max(1, uncompressed_size // record_size)
+    quality = b'F' * READ_LENGTH
+    with gzip.open(path, 'wb', compresslevel=1) as f:
+        reads_per_block = 10000
+        for block_start in range(0, num_reads, reads_per_block):
+            n = min(reads_per_block, num_reads - block_start)
+            sequences = os.urandom(n * READ_LENGTH).translate(NUCLEOTIDES)
+            records = []
+            for i in range(n):
+                name = '{}.{}'.format(read_name_prefix, block_start + i + 1).encode()
+                records.append(b'@' + name + b'\n' + sequences[i*READ_LENGTH:(i+1)*READ_LENGTH] +
+                    b'\n+\n' + quality + b'\n')
+            f.write(b''.join(records))
+    with open(path, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+def make_data(directory, size_mb):
+    '''Make the files served by the stand-in servers, returning the md5sum of
+    the .sra file and the ENA runs.'''
+    size = int(size_mb * 1024 * 1024)
+    sra_directory = os.path.join(directory, 'sra-pub-run-odp', 'sra', AWS_RUN)
+    os.makedirs(sra_directory)
+    logging.info("Writing synthetic {} byte .sra file ..".format(size))
+    sra_md5 = write_sra_blob(os.path.join(sra_directory, AWS_RUN), size)
+
+    fastq_directory = os.path.join(directory, 'vol1', 'fastq', ENA_RUN)
+    os.makedirs(fastq_directory)
+    file_names = []
+    md5sums = []
+    for read in (1, 2):
+        name = '{}_{}.fastq.gz'.format(ENA_RUN, read)
+        logging.info("Writing synthetic {} ..".format(name))
+        # Each file of the pair is about half the size of the .sra file
+        md5sums.append(write_fastq_gz(os.path.join(fastq_directory, name), size, ENA_RUN))
+        file_names.append(os.path.join('vol1', 'fastq', ENA_RUN, name))
+    return sra_md5, {ENA_RUN: EnaRun(ENA_RUN, file_names, md5sums)}
+
+
+def location_json(link, size, md5sum):
+    return {
+        'version': '2',
+        'result': [{
+            'bundle': AWS_RUN,
+            'status': 200,
+            'files': [{
+                'object': 'srapub_files|{}'.format(AWS_RUN),
+                'type': 'sra',
+                'name': AWS_RUN,
+                'size': size,
+                'md5': md5sum,
+                'locations': [{'service': 's3', 'region': 'us-east-1', 'link': link}],
+            }]
+        }]
+    }
+
+
+def run_case(case, config, result_queue):
+    '''Run a benchmark case in this (child) process, putting the result on
+    result_queue.'''
+    logging.basicConfig(level=config['log_level'], format='%(asctime)s %(levelname)s: %(message)s')
+    work_directory = tempfile.mkdtemp(dir=config['scratch_directory'])
+    try:
+        start = time.time()
+        if case.kind == 'aws-http':
+            cache_directory = os.path.join(work_directory, 'location_cache')
+            LocationCache(cache_directory, 24).put(
+                AWS_RUN, location_json(config['sra_url'], config['sra_size'], config['sra_md5']))
+            kingfisher.download_and_extract(
+                run_identifiers=[AWS_RUN], run_identifiers_file=None,
+                download_methods=['aws-http'], output_format_possibilities=['sra'],
+                location_cache_ttl=24, location_cache_directory=cache_directory,
+                output_directory=work_directory, hide_download_progress=True,
+                http_downloader=case.params['http_downloader'],
+                download_threads=case.params['download_threads'],
+                check_md5sums=case.params['check_md5sums'])
+            num_bytes = config['sra_size']
+        elif case.kind == 'ena-ftp':
+            kingfisher.ena.ENA_PORTAL_API_URL = config['ena_ftp_api_url'] if case.params['ftp'] else config['ena_http_api_url']
+            kingfisher.ena.ENA_FASTQ_HTTP_SCHEME = 'http'
+            kingfisher.download_and_extract(
+                run_identifiers=[ENA_RUN], run_identifiers_file=None,
+                download_methods=['ena-ftp'], output_format_possibilities=[case.params['output_format']],
+                location_cache_ttl=0, output_directory=work_directory, hide_download_progress=True,
+                http_downloader=case.params['http_downloader'],
+                download_threads=case.params['download_threads'])
+            num_bytes = config['ena_size']
+        elif case.kind == 'extract':
+            if case.params['stdout']:
+                devnull = os.open(os.devnull, os.O_WRONLY)
+                os.dup2(devnull, 1)
+            sra_file = os.path.join(work_directory, os.path.basename(config['sra_file']))
+            shutil.copy(config['sra_file'], sra_file)
+            kingfisher.extract(
+                sra_file=sra_file, output_format_possibilities=[case.params['output_format']],
+                unsorted=case.params['unsorted'], stdout=case.params['stdout'],
+                threads=config['extraction_threads'], output_directory=work_directory,
+                extraction_slices=case.params.get('extraction_slices', 1))
+            num_bytes = os.path.getsize(sra_file)
+        else:
+            raise Exception("Unknown case kind {}".format(case.kind))
+        seconds = time.time() - start
+        result_queue.put({
+            'status': 'ok',
+            'bytes': num_bytes,
+            'seconds': seconds,
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'peak_child_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        })
+    except Exception as e:
+        result_queue.put({'status': 'failed', 'reason': str(e)})
+    finally:
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+
+def benchmark(case, config, repeats):
+    missing = which_missing(case.required_programs)
+    if case.kind == 'extract' and config['sra_file'] is None:
+        return {'case': case.name, 'status': 'skipped', 'reason': 'No --sra-file given'}
+    if case.params.get('ftp') and config['ena_ftp_api_url'] is None:
+        return {'case': case.name, 'status': 'skipped', 'reason': 'pyftpdlib is not installed'}
+    if len(missing) > 0:
+        return {'case': case.name, 'status': 'skipped', 'reason': 'Not installed: {}'.format(', '.join(missing))}
+
+    context = multiprocessing.get_context('spawn')
+    runs = []
+    for _ in range(repeats):
+        result_queue = context.Queue()
+        process = context.Process(target=run_case, args=(case, config, result_queue))
+        process.start()
+        result = result_queue.get()
+        process.join()
+        if result['status'] != 'ok':
+            logging.warning("Case {} failed: {}".format(case.name, result['reason']))
+            return dict({'case': case.name}, **result)
+        runs.append(result)
+
+    median_seconds = statistics.median([r['seconds'] for r in runs])
+    result = {
+        'case': case.name,
+        'status': 'ok',
+        'bytes': runs[0]['bytes'],
+        'seconds': [r['seconds'] for r in runs],
+        'median_seconds': median_seconds,
+        'throughput_mb_per_second': runs[0]['bytes'] / 1e6 / median_seconds if median_seconds > 0 else None,
+        'peak_rss_kb': max([r['peak_rss_kb'] for r in runs]),
+        'peak_child_rss_kb': max([r['peak_child_rss_kb'] for r in runs]),
+    }
+    logging.info("{}: {:.2f} s, {:.1f} MB/s, peak RSS {} kB, peak child RSS {} kB".format(
+        case.name, median_seconds, result['throughput_mb_per_second'] or 0,
+        result['peak_rss_kb'], result['peak_child_rss_kb']))
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.realpath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = dict([(r['case'], r) for r in json.load(f)['results']])
+    print("{:<40} {:>12} {:>12} {:>8} {:>14} {:>14}".format(
+        'case', 'before MB/s', 'after MB/s', 'ratio', 'before RSS kB', 'after RSS kB'))
+    for result in results:
+        before = baseline.get(result['case'])
+        if result['status'] != 'ok' or before is None or before['status'] != 'ok':
+            continue
+        print("{:<40} {:>12.1f} {:>12.1f} {:>8.2f} {:>14} {:>14}".format(
+            result['case'], before['throughput_mb_per_second'], result['throughput_mb_per_second'],
+            result['throughput_mb_per_second'] / before['throughput_mb_per_second'],
+            before['peak_rss_kb'], result['peak_rss_kb']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', required=True, help='JSON file to write results to')
+    parser.add_argument('--size-mb', type=float, default=64,
+        help='Size of the synthetic .sra file, and roughly of each uncompressed FASTQ file [default: 64]')
+    parser.add_argument('--sra-file', help='A real .sra file, to benchmark extraction [default: extraction is not benchmarked]')
+    parser.add_argument('--cases', help='Only run cases whose names contain this string')
+    parser.add_argument('--repeats', type=int, default=3, help='Number of times to run each case [default: 3]')
+    parser.add_argument('--download-threads', type=int, default=8,
+        help='Threads used by aria2c and the builtin downloader [default: 8]')
+    parser.add_argument('--extraction-threads', type=int, default=8, help='Threads used in extraction [default: 8]')
+    parser.add_argument('--scratch-directory', help='Directory to write data to [default: a temporary directory]')
+    parser.add_argument('--compare', help='Compare with the results in this JSON file, from an earlier run')
+    parser.add_argument('--debug', action='store_true', help='Show debug logging')
+    args = parser.parse_args()
+
+    log_level = logging.DEBUG if args.debug else logging.INFO
+    logging.basicConfig(level=log_level, format='%(asctime)s %(levelname)s: %(message)s')
+
+    scratch_directory = tempfile.mkdtemp(dir=args.scratch_directory, prefix='kingfisher-benchmark')
+    http_server = None
+    ftp_server = None
+    try:
+        served_directory = os.path.join(scratch_directory, 'served')
+        os.mkdir(served_directory)
+        sra_md5, ena_runs = make_data(served_directory, args.size_mb)
+
+        if FTP_AVAILABLE:
+            ftp_server = StandInFtpServer(served_directory)
+        http_server = StandInHttpServer(
+            served_directory, ena_runs, ftp_server.address if ftp_server is not None else None)
+
+        sra_relative_path = os.path.join('sra-pub-run-odp', 'sra', AWS_RUN, AWS_RUN)
+        config = {
+            'log_level': logging.DEBUG if args.debug else logging.WARNING,
+            'scratch_directory': scratch_directory,
+            'sra_url': http_server.url(sra_relative_path),
+            'sra_size': os.path.getsize(os.path.join(served_directory, sra_relative_path)),
+            'sra_md5': sra_md5,
+            'ena_http_api_url': http_server.ena_portal_api_url(),
+            'ena_ftp_api_url': http_server.ena_portal_api_url(ftp=True) if ftp_server is not None else None,
+            'ena_size': sum([os.path.getsize(os.path.join(served_directory, f)) for f in ena_runs[ENA_RUN].file_names]),
+            'sra_file': os.path.abspath(args.sra_file) if args.sra_file is not None else None,
+            'extraction_threads': args.extraction_threads,
+        }
+
+        results = []
+        for case in all_cases(args.download_threads):
+            if args.cases is not None and args.cases not in case.name:
+                continue
+            logging.info("Running case {} ..".format(case.name))
+            results.append(benchmark(case, config, args.repeats))
+    finally:
+        if http_server is not None:
+            http_server.stop()
+        if ftp_server is not None:
+            ftp_server.stop()
+        shutil.rmtree(scratch_directory, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'kingfisher_version': kingfisher.__version__,
+            'git_commit': git_commit(),
+            'date': datetime.datetime.now().isoformat(),
+            'hostname': socket.gethostname(),
+            'python': platform.python_version(),
+            'parameters': {
+                'size_mb': args.size_mb,
+                'sra_file': args.sra_file,
+                'repeats': args.repeats,
+                'download_threads': args.download_threads,
+                'extraction_threads': args.extraction_threads,
+            },
+            'results': results,
+        }, f, indent=2)
+    logging.info("Wrote results of {} case(s) to {}".format(len(results), args.output))
+
+    if args.compare is not None:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+'''Benchmark parsing of efetch metadata, as used by kingfisher annotate.
+
+The recorded efetch XML in test/data is replayed through
+SraMetadata.parse_efetch_metadata_stream and then _output_formatted_metadata, with
+the single experiment package repeated (with distinct accessions) to make
+responses of 1, 1,000 and 100,000 packages by default. Each size is run in a
+fresh process, so that its peak memory use can be measured.
+
+With --baseline, the results are compared with those of an earlier run, and
+the exit status is 1 if throughput has fallen, or peak memory use has risen,
+by more than --tolerance e.g.
+
+    python benchmarking/benchmark_metadata.py --output baseline.json
+    git checkout my-branch
+    python benchmarking/benchmark_metadata.py --output new.json --baseline baseline.json
+'''
+
+import argparse
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import socket
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')] + sys.path
+
+import kingfisher
+from kingfisher import _output_formatted_metadata
+from kingfisher.sra_metadata import SraMetadata, BASES_KEY
+
+from benchmark_get import git_commit
+
+FIXTURE = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'test', 'data', 'efetch_ERR1739691.xml')
+FIXTURE_RUN = 'ERR1739691'
+FIXTURE_EXPERIMENT = 'ERX1809317'
+FIXTURE_SAMPLE = 'ERS1396358'
+
+
+def write_efetch_xml(path, num_packages):
+    '''Write an efetch response of num_packages experiment packages, each a
+    copy of the one in the fixture with its own run, experiment and sample
+    accessions.'''
+    with open(FIXTURE) as f:
+        fixture = f.read()
+    start = fixture.index('<EXPERIMENT_PACKAGE>')
+    end = fixture.index('</EXPERIMENT_PACKAGE>') + len('</EXPERIMENT_PACKAGE>')
+    package = fixture[start:end]
+    with open(path, 'w') as f:
+        f.write(fixture[:start])
+        for i in range(num_packages):
+            f.write(package
+                .replace(FIXTURE_RUN, 'ERR{:07d}'.format(i))
+                .replace(FIXTURE_EXPERIMENT, 'ERX{:07d}'.format(i))
+                .replace(FIXTURE_SAMPLE, 'ERS{:07d}'.format(i)))
+            f.write('\n')
+        f.write(fixture[end:])
+
+
+def run_case(xml_path, output_format, columns, result_queue):
+    '''Parse and format the metadata in xml_path in this (child) process,
+    putting the result on result_queue.'''
+    try:
+        baseline_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        # Parsed from a stream, as efetch responses are
+        with open(xml_path, 'rb') as f:
+            metadata = SraMetadata.parse_efetch_metadata_stream(
+                f, columns=None if columns is None else [BASES_KEY if c == 'Gbp' else c for c in columns])
+        parse_seconds = time.time() - start
+        with tempfile.NamedTemporaryFile(suffix='.' + output_format) as f:
+            start = time.time()
+            _output_formatted_metadata(metadata, f.name, output_format, columns is None, columns)
+            format_seconds = time.time() - start
+        result_queue.put({
+            'status': 'ok',
+            'runs': len(metadata),
+            'parse_seconds': parse_seconds,
+            'format_seconds': format_seconds,
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'baseline_rss_kb': baseline_rss_kb,
+        })
+    except Exception as e:
+        result_queue.put({'status': 'failed', 'reason': str(e)})
+
+
+def benchmark(num_packages, xml_path, output_format, repeats, columns=None):
+    context = multiprocessing.get_context('spawn')
+    runs = []
+    for _ in range(repeats):
+        result_queue = context.Queue()
+        process = context.Process(target=run_case, args=(xml_path, output_format, columns, result_queue))
+        process.start()
+        result = result_queue.get()
+        process.join()
+        if result['status'] != 'ok':
+            raise Exception("Benchmark of {} packages failed: {}".format(num_packages, result['reason']))
+        if result['runs'] != num_packages:
+            raise Exception("Expected {} runs to be parsed, found {}".format(num_packages, result['runs']))
+        runs.append(result)
+
+    total_seconds = statistics.median([r['parse_seconds'] + r['format_seconds'] for r in runs])
+    result = {
+        'case': '{}_packages'.format(num_packages),
+        'packages': num_packages,
+        'xml_bytes': os.path.getsize(xml_path),
+        'median_parse_seconds': statistics.median([r['parse_seconds'] for r in runs]),
+        'median_format_seconds': statistics.median([r['format_seconds'] for r in runs]),
+        'packages_per_second': num_packages / total_seconds if total_seconds > 0 else None,
+        'peak_rss_kb': max([r['peak_rss_kb'] for r in runs]),
+        # Memory used by parsing and formatting, beyond that of the Python
+        # interpreter and the imported modules
+        'peak_rss_increase_kb': max([r['peak_rss_kb'] - r['baseline_rss_kb'] for r in runs]),
+    }
+    logging.info("{} packages: parse {:.3f} s, format {:.3f} s, {:.0f} packages/s, peak RSS {} kB (+{} kB)".format(
+        num_packages, result['median_parse_seconds'], result['median_format_seconds'],
+        result['packages_per_second'] or 0, result['peak_rss_kb'], result['peak_rss_increase_kb']))
+    return result
+
+
+def check_against_baseline(results, baseline_path, tolerance):
+    '''Return a list of descriptions of regressions relative to the results
+    in baseline_path.'''
+    with open(baseline_path) as f:
+        baseline = dict([(r['case'], r) for r in json.load(f)['results']])
+    regressions = []
+    for result in results:
+        before = baseline.get(result['case'])
+        if before is None:
+            continue
+        # Very small cases are dominated by fixed costs, so only memory is
+        # compared for them.
+        if result['packages'] >= 1000 and before['packages_per_second'] and result['packages_per_second'] and \
+                result['packages_per_second'] < before['packages_per_second'] * (1 - tolerance):
+            regressions.append("{}: {:.0f} packages/s, down from {:.0f}".format(
+                result['case'], result['packages_per_second'], before['packages_per_second']))
+        if result['peak_rss_increase_kb'] > max(before['peak_rss_increase_kb'], 1024) * (1 + tolerance):
+            regressions.append("{}: peak RSS increase of {} kB, up from {} kB".format(
+                result['case'], result['peak_rss_increase_kb'], before['peak_rss_increase_kb']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', required=True, help='JSON file to write results to')
+    parser.add_argument('--packages', type=int, nargs='+', default=[1, 1000, 100000],
+        help='Numbers of experiment packages to benchmark [default: 1 1000 100000]')
+    parser.add_argument('--output-format', default='tsv',
+        help='Output format passed to _output_formatted_metadata, with all columns [default: tsv]')
+    parser.add_argument('--columns', nargs='+',
+        help='Parse and output only these columns, as annotate --columns does [default: all columns]')
+    parser.add_argument('--repeats', type=int, default=3, help='Number of times to run each size [default: 3]')
+    parser.add_argument('--baseline', help='Compare with the results in this JSON file, exiting with status 1 on regression')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+        help='Fractional slowdown or memory increase relative to --baseline tolerated [default: 0.2]')
+    parser.add_argument('--debug', action='store_true', help='Show debug logging')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
+        format='%(asctime)s %(levelname)s: %(message)s')
+
+    scratch_directory = tempfile.mkdtemp(prefix='kingfisher-benchmark')
+    results = []
+    try:
+        for num_packages in args.packages:
+            xml_path = os.path.join(scratch_directory, 'efetch_{}.xml'.format(num_packages))
+            write_efetch_xml(xml_path, num_packages)
+            results.append(benchmark(num_packages, xml_path, args.output_format, args.repeats, args.columns))
+            os.remove(xml_path)
+    finally:
+        shutil.rmtree(scratch_directory, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'kingfisher_version': kingfisher.__version__,
+            'git_commit': git_commit(),
+            'date': datetime.datetime.now().isoformat(),
+            'hostname': socket.gethostname(),
+            'python': platform.python_version(),
+            'parameters': {
+                'output_format': args.output_format,
+                'repeats': args.repeats,
+                'columns': args.columns,
+            },
+            'results': results,
+        }, f, indent=2)
+    logging.info("Wrote results to {}".format(args.output))
+
+    if args.baseline is not None:
+        regressions = check_against_baseline(results, args.baseline, args.tolerance)
+        if len(regressions) > 0:
+            for regression in regressions:
+                logging.error("Regression: {}".format(regression))
+            sys.exit(1)
+        logging.info("No regressions relative to {}".format(args.baseline))
+
+
+if __name__ == '__main__':
+    main()
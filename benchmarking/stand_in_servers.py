@@ -0,0 +1,186 @@
+'''Local stand-ins for the remote services Kingfisher downloads from, so that
+downloads can be benchmarked without the variability of the internet.
+
+StandInHttpServer serves the files in a directory, with support for range
+requests, and emulates the parts of the ENA portal API that Kingfisher uses.
+StandInFtpServer serves the same directory over FTP, and is only available if
+pyftpdlib is installed.
+'''
+
+import logging
+import os
+import re
+import shutil
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+try:
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+    FTP_AVAILABLE = True
+except ImportError:
+    FTP_AVAILABLE = False
+
+# Path prefixes of the emulated ENA portal API. The file paths it returns
+# point at the HTTP or FTP server depending on which is used.
+ENA_HTTP_API_PREFIX = '/ena-http/portal/api'
+ENA_FTP_API_PREFIX = '/ena-ftp/portal/api'
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+class EnaRun:
+    '''A run known to the emulated ENA portal API.'''
+    def __init__(self, run_identifier, file_names, md5sums):
+        self.run_identifier = run_identifier
+        self.file_names = file_names
+        self.md5sums = md5sums
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logging.debug("Stand-in HTTP server: " + format % args)
+
+    def _path(self):
+        path = os.path.normpath(os.path.join(self.server.directory, urlparse(self.path).path.lstrip('/')))
+        if not path.startswith(self.server.directory):
+            return None
+        return path
+
+    def _send_headers(self, status, length, content_range=None, content_type='application/octet-stream'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(length))
+        self.send_header('Accept-Ranges', 'bytes')
+        if content_range is not None:
+            self.send_header('Content-Range', content_range)
+        self.end_headers()
+
+    def do_HEAD(self):
+        path = self._path()
+        if path is None or not os.path.isfile(path):
+            self.send_error(404)
+            return
+        self._send_headers(200, os.path.getsize(path))
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        for prefix in (ENA_HTTP_API_PREFIX, ENA_FTP_API_PREFIX):
+            if parsed.path.startswith(prefix):
+                return self._ena_api(prefix, parsed.path[len(prefix):], parse_qs(parsed.query))
+
+        path = self._path()
+        if path is None or not os.path.isfile(path):
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        range_header = self.headers.get('Range')
+        if range_header is not None:
+            m = re.match(r'bytes=(\d+)-(\d*)', range_header)
+            start = int(m[1])
+            if m[2] != '':
+                end = min(int(m[2]), size - 1)
+            self._send_headers(206, end - start + 1, 'bytes {}-{}/{}'.format(start, end, size))
+        else:
+            self._send_headers(200, size)
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = f.read(min(COPY_BUFFER_SIZE, remaining))
+                if len(data) == 0:
+                    break
+                self.wfile.write(data)
+                remaining -= len(data)
+
+    def do_POST(self):
+        parsed = urlparse(self.path)
+        length = int(self.headers.get('Content-Length', 0))
+        params = parse_qs(self.rfile.read(length).decode())
+        for prefix in (ENA_HTTP_API_PREFIX, ENA_FTP_API_PREFIX):
+            if parsed.path.startswith(prefix):
+                return self._ena_api(prefix, parsed.path[len(prefix):], params)
+        self.send_error(404)
+
+    def _ena_api(self, prefix, endpoint, params):
+        if endpoint == '/filereport':
+            accessions = params['accession']
+        elif endpoint == '/search':
+            accessions = params['includeAccessions'][0].split(',')
+        else:
+            self.send_error(404)
+            return
+        if prefix == ENA_FTP_API_PREFIX:
+            if self.server.ftp_address is None:
+                self.send_error(404)
+                return
+            host = '{}:{}'.format(*self.server.ftp_address)
+        else:
+            host = '{}:{}'.format(*self.server.server_address)
+        lines = ['run_accession\tfastq_ftp\tfastq_md5\tfastq_bytes']
+        for accession in accessions:
+            run = self.server.ena_runs.get(accession)
+            if run is None:
+                continue
+            lines.append('\t'.join([
+                accession,
+                ';'.join(['{}/{}'.format(host, f) for f in run.file_names]),
+                ';'.join(run.md5sums),
+                ';'.join([str(os.path.getsize(os.path.join(self.server.directory, f))) for f in run.file_names]),
+            ]))
+        body = ('\n'.join(lines) + '\n').encode()
+        self._send_headers(200, len(body), content_type='text/plain')
+        self.wfile.write(body)
+
+
+class StandInHttpServer:
+    '''Serve the files in directory over HTTP on localhost, in a background
+    thread. ena_runs is a dict of run identifier to EnaRun, with file names
+    relative to directory.'''
+    def __init__(self, directory, ena_runs=None, ftp_address=None):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        self.server.daemon_threads = True
+        self.server.directory = os.path.abspath(directory)
+        self.server.ena_runs = ena_runs if ena_runs is not None else {}
+        self.server.ftp_address = ftp_address
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def url(self, path=''):
+        return 'http://{}:{}/{}'.format(*self.server.server_address, path.lstrip('/'))
+
+    def ena_portal_api_url(self, ftp=False):
+        return self.url(ENA_FTP_API_PREFIX if ftp else ENA_HTTP_API_PREFIX)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class StandInFtpServer:
+    '''Serve the files in directory over anonymous FTP on localhost, in a
+    background thread. Requires pyftpdlib.'''
+    def __init__(self, directory):
+        if not FTP_AVAILABLE:
+            raise Exception("pyftpdlib is required for the stand-in FTP server")
+        authorizer = DummyAuthorizer()
+        authorizer.add_anonymous(os.path.abspath(directory))
+        handler = FTPHandler
+        handler.authorizer = authorizer
+        self.server = ThreadedFTPServer(('127.0.0.1', 0), handler)
+        self.address = self.server.address
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.close_all()
+
+
+def which_missing(programs):
+    '''Return the programs which are not on the PATH.'''
+    return [p for p in programs if shutil.which(p) is None]
@@ -7,22 +7,42 @@ import subprocess
 import sys
 import gzip
 import re
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import extern
 from extern import ExternCalledProcessError
 import bird_tool_utils
 
 from .ena import EnaDownloader
-from .location import Location, NcbiLocationJson
+from .location import Location, NcbiLocationJson, LocationCache
 from .exception import DownloadMethodFailed
 from .sra_metadata import *
 from .md5sum import MD5
+from .scheduler import RunScheduler
+from .resume import DownloadJournal
+from .run_state import RunStateDatabase
+from .run_sizes import fetch_run_sizes, order_largest_first, parse_size
+from .sharding import RunLock, parse_shard, shard_by_hash, shard_by_size
+from .metrics import MetricsRecorder, PhaseRecord, PHASE_RESOLVE, PHASE_DOWNLOAD, PHASE_VERIFY, PHASE_CONVERT, PHASE_COMPRESS
+from .http_downloader import RangedHttpDownloader
+from .fastx import fastq_to_fasta, split_spots_command, interleave_spots_command
+from .subsample import Subsample, paired_groups, subsample_fastq_files, interleave_fastq_streams
+from . import tracing
 
 DEFAULT_ASPERA_SSH_KEY = 'linux'
 DEFAULT_OUTPUT_FORMAT_POSSIBILITIES = ['fastq', 'fastq.gz']
 DEFAULT_THREADS = 8
 DEFAULT_DOWNLOAD_THREADS = DEFAULT_THREADS
 DEFAULT_ASCP_ARGS = '-k 2'
+DEFAULT_PIPELINE_QUEUE_DEPTH = 1
+DEFAULT_HTTP_DOWNLOADER = 'external'
+RUN_ORDERS = ['input', 'largest-first']
+CONVERSION_ENGINES = ['awk', 'builtin']
+DEFAULT_CONVERSION_ENGINE = 'awk'
+# Options making the deflines of fastq-dump the same as those of fasterq-dump
+FASTQ_DUMP_DEFLINE_OPTIONS = "--defline-seq '@$ac.$si $sn length=$rl' --defline-qual '+$ac.$si $sn length=$rl'"
 
 class OutputLocation:
     def __init__(self, output_directory):
@@ -46,6 +66,16 @@ def download_and_extract(**kwargs):
     '''download an public sequence dataset and extract if necessary. kwargs
     here are largely the same as the arguments to the kingfisher executable.
     '''
+    trace_file = kwargs.pop('trace_file', None)
+    if trace_file is None:
+        return _download_and_extract(**kwargs)
+    tracing.start_tracing(trace_file)
+    try:
+        return _download_and_extract(**kwargs)
+    finally:
+        tracing.stop_tracing()
+
+def _download_and_extract(**kwargs):
     run_identifiers = kwargs.pop('run_identifiers')
     run_identifiers_file = kwargs.pop('run_identifiers_file')
     bioproject_accession = kwargs.pop('bioproject_accession', None)  # kept for API stability
@@ -61,17 +91,245 @@ def download_and_extract(**kwargs):
     if num_inputs != 1:
         raise Exception("Must specify exactly one input type: --run-identifiers, --bioproject-accessions or --run-identifiers-list")
 
+    # Options which need all the runs to be known before any is started
+    shard = kwargs.pop('shard', None)
+    balance_shards_by_size = kwargs.pop('shard_by_size', False)
+    # Runs are locked in the output directory when it may be shared with
+    # other kingfisher processes
+    kwargs['lock_runs'] = kwargs.pop('lock_runs', False) or shard is not None
+    run_order = kwargs.pop('run_order', 'input')
+    max_scratch = kwargs.pop('max_scratch', None)
+    extraction_slices = kwargs.get('extraction_slices', 1)
+
+    run_pages = None
     if bioproject_accessions is not None:
-        run_identifiers = SraMetadata().fetch_runs_from_bioprojects(bioproject_accessions)
-        logging.debug("Found {} run(s) to annotate".format(len(run_identifiers)))
+        run_pages = SraMetadata().run_pages_from_bioprojects(bioproject_accessions)
+        if shard is not None or run_order != 'input' or max_scratch is not None or extraction_slices > 1:
+            run_identifiers = [run for page in run_pages for run in page]
+            run_pages = None
+            logging.debug("Found {} run(s) to download".format(len(run_identifiers)))
     if run_identifiers_file is not None:
         with open(run_identifiers_file) as f:
             run_identifiers = list([r.strip() for r in f.readlines()])
 
-    for run in run_identifiers:
-        download_and_extract_one_run(run, **kwargs)
+    # Split the runs between shards before anything is looked up, so each
+    # shard only looks up its own runs.
+    output_format_possibilities = kwargs.get('output_format_possibilities', DEFAULT_OUTPUT_FORMAT_POSSIBILITIES)
+    run_sizes = None
+    if balance_shards_by_size and shard is None:
+        raise Exception("Balancing shards by size requires a shard to be specified")
+    if shard is not None:
+        shard_index, num_shards = shard
+        if balance_shards_by_size:
+            run_sizes = fetch_run_sizes(run_identifiers)
+            run_identifiers = shard_by_size(run_identifiers, dict([
+                (run, size.scratch_bytes(output_format_possibilities)) for (run, size) in run_sizes.items()]),
+                shard_index, num_shards)
+        else:
+            run_identifiers = shard_by_hash(run_identifiers, shard_index, num_shards)
+        logging.info("Processing {} run(s) in shard {} of {}".format(len(run_identifiers), shard_index, num_shards))
+
+    location_cache_ttl = kwargs.pop('location_cache_ttl', None)
+    location_cache_directory = kwargs.pop('location_cache_directory', None)
+    location_cache = None
+    if location_cache_ttl:
+        if location_cache_directory is None:
+            location_cache_directory = LocationCache.default_directory()
+        logging.debug("Caching NCBI locations in {} for {} hour(s)".format(location_cache_directory, location_cache_ttl))
+        location_cache = LocationCache(location_cache_directory, location_cache_ttl)
+        kwargs['location_cache'] = location_cache
+
+    ncbi_location_methods = ['aws-cp', 'gcp-cp']
+    if not kwargs.get('guess_aws_location', False):
+        ncbi_location_methods.append('aws-http')
+    prefetch_ncbi_locations = location_cache is not None and \
+        any([m in ncbi_location_methods for m in kwargs['download_methods']])
+    ena_downloader = None
+    if any([m in ['ena-ftp', 'ena-ascp'] for m in kwargs['download_methods']]) and \
+            (run_pages is not None or len(run_identifiers) > 1):
+        ena_downloader = EnaDownloader()
+        kwargs['ena_downloader'] = ena_downloader
+
+    def prefetch_locations(runs):
+        if len(runs) > 1:
+            if prefetch_ncbi_locations:
+                Location.prefetch_ncbi_locations(runs, location_cache)
+            if ena_downloader is not None:
+                # Resolve the ENA FTP paths of all runs up front in a few
+                # requests, rather than one request per run as each is
+                # downloaded.
+                ena_downloader.prefetch_file_reports(runs)
+
+    if run_pages is None:
+        prefetch_locations(run_identifiers)
+    else:
+        # Start on the runs of the first pages of the BioProject(s) while
+        # the later pages are still being fetched.
+        def runs_of_pages():
+            for page in run_pages:
+                prefetch_locations(page)
+                yield from page
+        run_identifiers = runs_of_pages()
+
+    kwargs['subsample'] = Subsample.from_options(
+        max_reads = kwargs.pop('max_reads', None),
+        fraction = kwargs.pop('fraction', None),
+        reservoir_reads = kwargs.pop('reservoir_reads', None),
+        seed = kwargs.pop('seed', None))
+    if run_order not in RUN_ORDERS:
+        raise Exception("Unknown run order: {}".format(run_order))
+    if run_sizes is None and (run_order == 'largest-first' or max_scratch is not None or extraction_slices > 1):
+        run_sizes = fetch_run_sizes(run_identifiers)
+    if run_sizes is not None:
+        if extraction_slices > 1:
+            # Slices are made from the number of spots of each run
+            kwargs['run_spots'] = dict([(run, size.spots) for (run, size) in run_sizes.items()])
+        if run_order == 'largest-first':
+            run_identifiers = order_largest_first(run_identifiers, run_sizes, output_format_possibilities)
+        if max_scratch is not None:
+            kwargs['scratch_budget'] = max_scratch
+            kwargs['run_costs'] = dict([
+                (run, run_sizes[run].scratch_bytes(output_format_possibilities) if run in run_sizes else None)
+                for run in run_identifiers])
+
+    run_state = None
+    if kwargs.pop('run_state_database', False):
+        if kwargs.get('stdout', False):
+            raise Exception("A run state database cannot be used with --stdout")
+        run_state = RunStateDatabase(OutputLocation(kwargs.get('output_directory', '.')).output_directory)
+        kwargs['run_state'] = run_state
+
+    metrics_file = kwargs.pop('metrics_file', None)
+    prometheus_file = kwargs.pop('prometheus_file', None)
+    metrics = None
+    if metrics_file is not None or prometheus_file is not None:
+        metrics = MetricsRecorder(metrics_file, prometheus_file)
+        kwargs['metrics'] = metrics
+
+    try:
+        _download_and_extract_runs(run_identifiers, **kwargs)
+    finally:
+        if run_state is not None:
+            run_state.close()
+        if metrics is not None:
+            metrics.close()
+
+def _download_and_extract_runs(run_identifiers, **kwargs):
+    parallel_runs = kwargs.pop('parallel_runs', 1)
+    parallel_extractions = kwargs.pop('parallel_extractions', None)
+    pipeline = kwargs.pop('pipeline', False)
+    pipeline_queue_depth = kwargs.pop('pipeline_queue_depth', None)
+    run_costs = kwargs.pop('run_costs', None)
+    scratch_budget = kwargs.pop('scratch_budget', None)
+    # Runs skipped because another process held their lock
+    locked_runs = []
+    kwargs['locked_runs'] = locked_runs
+
+    if parallel_runs == 1 and parallel_extractions is None and not pipeline:
+        if pipeline_queue_depth is not None:
+            raise Exception("A pipeline queue depth requires pipelining, or runs to be downloaded or extracted in parallel")
+        if scratch_budget is not None:
+            raise Exception("A scratch space budget requires pipelining, or runs to be downloaded or extracted in parallel")
+        for run in run_identifiers:
+            download_and_extract_one_run(run, **kwargs)
+    else:
+        if kwargs.get('stdout', False):
+            raise Exception("--stdout cannot be used when downloading runs in parallel or pipelined")
+        if parallel_extractions is None:
+            parallel_extractions = parallel_runs
+        if pipeline and pipeline_queue_depth is None:
+            pipeline_queue_depth = DEFAULT_PIPELINE_QUEUE_DEPTH
+        logging.info("Downloading up to {} run(s) and extracting up to {} run(s) at a time".format(
+            parallel_runs, parallel_extractions))
+        if pipeline_queue_depth is not None:
+            logging.info("Pausing downloads when {} downloaded run(s) are waiting to be extracted".format(
+                pipeline_queue_depth))
+        if scratch_budget is not None:
+            logging.info("Only starting downloads when the expected scratch space used stays within {} bytes".format(
+                scratch_budget))
+        scheduler = RunScheduler(
+            lambda run: _download_one_run(run, **kwargs),
+            _extract_downloaded_run,
+            parallel_runs,
+            parallel_extractions,
+            queue_depth = pipeline_queue_depth,
+            run_costs = run_costs,
+            scratch_budget = scratch_budget)
+        failures = scheduler.run(run_identifiers)
+        if len(failures) > 0:
+            logging.error("{} run(s) failed:".format(len(failures)))
+            for failure in failures:
+                logging.error("  {}".format(failure))
+            raise Exception("{} run(s) failed to be downloaded or extracted: {}".format(
+                len(failures), ', '.join([f.run_identifier for f in failures])))
+    if len(locked_runs) > 0:
+        # Expected when processes cooperate on the same runs, so not an error
+        logging.warning("{} run(s) were skipped because another process held their lock: {}".format(
+            len(locked_runs), ', '.join(locked_runs)))
+
+
+class DownloadedRun:
+    '''The outcome of the download phase for a single run, carrying what is
+    needed to carry out the extraction phase.'''
+    def __init__(self, run_identifier, downloaded_files, output_files, skip_download_and_extraction,
+        output_location_factory, output_format_possibilities, unsorted, stdout, extraction_threads,
+        output_directory, run_state=None, metrics=None, conversion_engine=DEFAULT_CONVERSION_ENGINE,
+        extraction_slices=1, num_spots=None, subsample=None):
+        self.run_identifier = run_identifier
+        self.downloaded_files = downloaded_files
+        self.output_files = output_files
+        self.skip_download_and_extraction = skip_download_and_extraction
+        self.output_location_factory = output_location_factory
+        self.output_format_possibilities = output_format_possibilities
+        self.unsorted = unsorted
+        self.stdout = stdout
+        self.extraction_threads = extraction_threads
+        self.output_directory = output_directory
+        self.run_state = run_state
+        self.metrics = metrics if metrics is not None else MetricsRecorder()
+        self.conversion_engine = conversion_engine
+        self.extraction_slices = extraction_slices
+        self.num_spots = num_spots
+        # Subsampling still to be done at extraction, if any
+        self.subsample = subsample
+        # Held from the start of the download until extraction finishes
+        self.run_lock = None
+
 
 def download_and_extract_one_run(run_identifier, **kwargs):
+    downloaded_run = _download_one_run(run_identifier, **kwargs)
+    if downloaded_run is None:
+        return []
+    return _extract_downloaded_run(downloaded_run)
+
+def _download_one_run(run_identifier, **kwargs):
+    '''Download a run. With lock_runs, its lock in the output directory is
+    held while doing so, so that other processes sharing the directory do
+    not download it at the same time. Returns None if another process holds
+    the lock, adding the run to locked_runs if that is given.'''
+    lock_runs = kwargs.pop('lock_runs', False)
+    locked_runs = kwargs.pop('locked_runs', None)
+    run_lock = None
+    if lock_runs and not kwargs.get('stdout', False):
+        run_lock = RunLock(OutputLocation(kwargs.get('output_directory', '.')).output_directory, run_identifier)
+        if not run_lock.acquire():
+            logging.warning("Skipping run {} as another process is downloading or extracting it, "
+                "according to lock file {}".format(run_identifier, run_lock.path))
+            if locked_runs is not None:
+                locked_runs.append(run_identifier)
+            return None
+    downloaded_run = None
+    try:
+        with tracing.span('download {}'.format(run_identifier), 'run'):
+            downloaded_run = _download_one_run_locked(run_identifier, **kwargs)
+    finally:
+        # Otherwise the lock is released once the run is extracted
+        if downloaded_run is None and run_lock is not None:
+            run_lock.release()
+    downloaded_run.run_lock = run_lock
+    return downloaded_run
+
+def _download_one_run_locked(run_identifier, **kwargs):
     logging.debug("kwargs in download_and_extract_one_run: {}".format(kwargs))
     download_methods = kwargs.pop('download_methods')
     output_format_possibilities = kwargs.pop('output_format_possibilities',
@@ -90,15 +348,29 @@ def download_and_extract_one_run(run_identifier, **kwargs):
     ascp_ssh_key = kwargs.pop('ascp_ssh_key', DEFAULT_ASPERA_SSH_KEY)
     ascp_args = kwargs.pop('ascp_args', DEFAULT_ASCP_ARGS)
     download_threads = kwargs.pop('download_threads', DEFAULT_DOWNLOAD_THREADS)
+    http_downloader = kwargs.pop('http_downloader', DEFAULT_HTTP_DOWNLOADER)
     extraction_threads = kwargs.pop('extraction_threads', DEFAULT_THREADS)
+    conversion_engine = kwargs.pop('conversion_engine', DEFAULT_CONVERSION_ENGINE)
+    extraction_slices = kwargs.pop('extraction_slices', 1)
+    run_spots = kwargs.pop('run_spots', None)
+    subsample = kwargs.pop('subsample', None)
     hide_download_progress = kwargs.pop('hide_download_progress', False)
     prefetch_max_size = kwargs.pop('prefetch_max_size',None)
     check_md5sums = kwargs.pop('check_md5sums', False)
     output_directory = kwargs.pop('output_directory', '.')
+    location_cache = kwargs.pop('location_cache', None)
+    ena_downloader = kwargs.pop('ena_downloader', None)
+    run_state = kwargs.pop('run_state', None)
+    metrics = kwargs.pop('metrics', None)
 
     if len(kwargs) > 0:
         raise Exception("Unexpected arguments detected: %s" % kwargs)
 
+    if ena_downloader is None:
+        ena_downloader = EnaDownloader()
+    if metrics is None:
+        metrics = MetricsRecorder()
+
     if guess_aws_location and check_md5sums:
         logging.warning("Guessing AWS location is not compatible with checking md5sums. Not carrying out md5sum checks for downloads from AWS.")
 
@@ -122,12 +394,67 @@ def download_and_extract_one_run(run_identifier, **kwargs):
     if gcp_project and gcp_user_key_file:
         raise Exception("--gcp-project is incompatible with --gcp-user-key-file. The project specified in the key file will be used when gcp_project is not specified.")
 
-    if stdout and not unsorted:
-        raise Exception("Currently --stdout must be used with --unsorted")
+    if stdout and output_format_possibilities[0] == 'sra':
+        raise Exception("Cannot output .sra format to STDOUT")
+    if subsample is not None and (unsorted or extraction_slices > 1):
+        raise Exception("Subsampling cannot be used with --unsorted or extraction in slices")
 
     output_location_factory = OutputLocation(output_directory)
     output_files = []
     ncbi_locations = None
+    # Cleared when the download itself subsamples the run
+    subsample_on_extraction = subsample
+
+    # SRA-lite objects have had their quality scores removed, so are smaller
+    # to download and quicker to extract. Prefer them when no output format
+    # requires quality scores, falling back to the full object.
+    if all([f in ('fasta', 'fasta.gz') for f in output_format_possibilities]):
+        sra_object_types = [NcbiLocationJson.OBJECT_TYPE_SRA_NOQUAL, NcbiLocationJson.OBJECT_TYPE_SRA]
+    else:
+        sra_object_types = [NcbiLocationJson.OBJECT_TYPE_SRA]
+
+    def downloaded_run(downloaded_files):
+        return DownloadedRun(
+            run_identifier = run_identifier,
+            downloaded_files = downloaded_files,
+            output_files = output_files,
+            skip_download_and_extraction = skip_download_and_extraction,
+            output_location_factory = output_location_factory,
+            output_format_possibilities = output_format_possibilities,
+            unsorted = unsorted,
+            stdout = stdout,
+            extraction_threads = extraction_threads,
+            output_directory = output_directory,
+            run_state = run_state,
+            metrics = metrics,
+            conversion_engine = conversion_engine,
+            extraction_slices = extraction_slices,
+            num_spots = run_spots.get(run_identifier) if run_spots is not None else None,
+            subsample = subsample_on_extraction,
+        )
+
+    # Consult the run state database before looking for existing files, so
+    # that finished runs are skipped without looking for each possible output
+    # file.
+    if run_state is not None:
+        if force:
+            run_state.forget(run_identifier)
+        else:
+            state = run_state.get(run_identifier)
+            if state is not None and state.phase == RunStateDatabase.PHASE_EXTRACTED:
+                logging.info("Skipping download/extraction of {} as it was completed previously, according to {}".format(
+                    run_identifier, run_state.path))
+                skip_download_and_extraction = True
+                output_files = state.output_files
+                return downloaded_run(None)
+            elif state is not None and state.phase in (RunStateDatabase.PHASE_DOWNLOADED, RunStateDatabase.PHASE_VERIFIED) \
+                    and (not check_md5sums or state.phase == RunStateDatabase.PHASE_VERIFIED) \
+                    and all([os.path.exists(f) and not DownloadJournal.is_incomplete(f) for f in state.downloaded_files]):
+                logging.info("Run {} was downloaded previously, according to {}, so only extracting it".format(
+                    run_identifier, run_state.path))
+                skip_download_and_extraction = False
+                output_files = []
+                return downloaded_run(state.downloaded_files)
 
     # Checking for already existing files
     if stdout:
@@ -136,13 +463,42 @@ def download_and_extract_one_run(run_identifier, **kwargs):
         skip_download_and_extraction, output_files = _check_for_existing_files(
             output_location_factory, run_identifier, output_format_possibilities, force
         )
+        if skip_download_and_extraction and run_state is not None:
+            run_state.record(run_identifier, RunStateDatabase.PHASE_EXTRACTED, output_files=output_files)
 
     downloaded_files = None
+    # md5sums of the downloaded files which have been checked
+    verified_md5sums = []
     if not skip_download_and_extraction:
         # Download phase
         worked = False
+        download_start = time.time()
         for method in download_methods:
             logging.info("Attempting download method {} for run {} ..".format(method, run_identifier))
+            if run_state is not None:
+                run_state.record(run_identifier, RunStateDatabase.PHASE_RESOLVED, method=method)
+
+            # Find where to download from before the download starts, so that
+            # the two are timed separately.
+            if ncbi_locations is None and (
+                    (method == 'aws-http' and not guess_aws_location) or method == 'aws-cp' or
+                    (method == 'gcp-cp' and 'gcp' in allowable_sources)):
+                with metrics.phase(run_identifier, PHASE_RESOLVE, method):
+                    ncbi_locations = Location.get_ncbi_locations(run_identifier, cache=location_cache)
+            elif method in ('ena-ascp', 'ena-ftp'):
+                ena_report = False
+                try:
+                    with metrics.phase(run_identifier, PHASE_RESOLVE, method) as record:
+                        ena_report = ena_downloader.get_ftp_download_urls(run_identifier)
+                        if ena_report is False:
+                            record.fail("No ENA FTP download URLs found")
+                except Exception as e:
+                    logging.warning("Failed to query ENA for the FTP paths of {}: {}".format(run_identifier, e))
+                if ena_report is False:
+                    logging.warning("Method {} failed: No ENA FTP download URLs could be found".format(method))
+                    continue
+            download_record = PhaseRecord(run_identifier, PHASE_DOWNLOAD, method)
+
             if method == 'prefetch':
                 output_path = output_location_factory.output_stem('{}.sra'.format(run_identifier))
                 try:
@@ -150,7 +506,7 @@ def download_and_extract_one_run(run_identifier, **kwargs):
                         prefetch_max_size_argument = '--max-size 0G'
                     else:
                         prefetch_max_size_argument = '--max-size {}'.format(prefetch_max_size)
-                    extern.run("prefetch {} -o {} {}".format(
+                    tracing.run("prefetch {} -o {} {}".format(
                         prefetch_max_size_argument, output_path, run_identifier))
                     if os.path.exists(output_path):
                         downloaded_files = [output_path]
@@ -163,24 +519,40 @@ def download_and_extract_one_run(run_identifier, **kwargs):
                         os.remove(output_path)
                 
             elif method == 'aws-http':
-                def download_from_aws(odp_link, run_identifier, download_threads, method):
+                def download_from_aws(odp_link, run_identifier, download_threads, method, expected_size=None, md5sum=None):
                     output_path = output_location_factory.output_stem('{}.sra'.format(run_identifier))
+                    journal = DownloadJournal(output_path)
+                    observed_md5sum = None
                     try:
-                        if download_threads > 1:
+                        if http_downloader == 'builtin':
+                            resume = journal.prepare(odp_link, 'builtin', expected_size, md5sum,
+                                resume_requires=RangedHttpDownloader.progress_path(output_path))
+                            logging.info(
+                                "Downloading .SRA file from AWS Open Data Program HTTP link using the builtin downloader ..")
+                            _, observed_md5sum = RangedHttpDownloader(
+                                download_threads, show_progress=not hide_download_progress).download(
+                                    odp_link, output_path, resume=resume,
+                                    calculate_md5=check_md5sums and md5sum is not None)
+                        elif download_threads > 1:
+                            resume = journal.prepare(odp_link, 'aria2c', expected_size, md5sum,
+                                resume_requires='{}.aria2'.format(output_path))
                             logging.info(
                                 "Downloading .SRA file from AWS Open Data Program HTTP link using aria2c ..")
                             verbosity_flag = '--quiet' if hide_download_progress else ''
+                            continue_flag = '--continue=true' if resume else ''
                             # Redirect aria2c stdout to stderr so all logging of kingfisher is on stderr.
                             # aria2c does not handle absolute paths properly, so we have to use a relative path.
-                            cmd = "aria2c {} -x{} -o {} '{}' 1>&2".format(
-                                verbosity_flag, download_threads, os.path.relpath(output_path), odp_link)
-                            subprocess.check_call(cmd, shell=True)
+                            cmd = "aria2c {} {} -x{} -o {} '{}' 1>&2".format(
+                                verbosity_flag, continue_flag, download_threads, os.path.relpath(output_path), odp_link)
+                            tracing.check_call(cmd, shell=True)
                         else:
+                            resume = journal.prepare(odp_link, 'curl', expected_size, md5sum)
                             logging.info(
                                 "Downloading .SRA file from AWS Open Data Program HTTP link using curl ..")
                             verbosity_flag = '--silent --show-error' if hide_download_progress else ''
-                            cmd = "curl {} -o {} '{}'".format(verbosity_flag, output_path, odp_link)
-                            subprocess.check_call(cmd, shell=True)
+                            continue_flag = '-C -' if resume else ''
+                            cmd = "curl {} {} -o {} '{}'".format(verbosity_flag, continue_flag, output_path, odp_link)
+                            tracing.check_call(cmd, shell=True)
                         logging.info("Download finished, validating ..")
                         # A download with curl of a bad AWS address does not
                         # result in a non-zero exitstatus. Instead an XML
@@ -191,15 +563,30 @@ def download_and_extract_one_run(run_identifier, **kwargs):
 
                         if aws_failed:
                             logging.info("The file downloaded from AWS appears not to be a .sra file, deleting it, this download method failed")
-                            os.remove(output_path)
+                            journal.discard()
                             return None
-                        else:
-                            return [output_path]
-                    except subprocess.CalledProcessError as e:
+
+                        download_record.seconds = time.time() - download_record.start_time
+                        if check_md5sums and md5sum is not None:
+                            with metrics.phase(run_identifier, PHASE_VERIFY, method) as verify_record:
+                                md5_ok = _downloaded_md5sum_ok(output_path, md5sum, observed_md5sum)
+                                if observed_md5sum is None:
+                                    verify_record.add_file_sizes([output_path])
+                                if not md5_ok:
+                                    verify_record.fail("MD5sum check failed")
+                            if md5_ok:
+                                logging.info("MD5sum OK for {}".format(output_path))
+                                verified_md5sums.append(md5sum)
+                            else:
+                                logging.warning("MD5sum check failed for {}, deleting it, this download method failed".format(output_path))
+                                journal.discard()
+                                return None
+
+                        journal.complete()
+                        return [output_path]
+                    except (subprocess.CalledProcessError, DownloadMethodFailed) as e:
                         logging.warning("Method {} failed when downloading from {}: Error was: {}".format(method, odp_link, e))
-                        if os.path.exists(output_path):
-                            logging.info("Removing file {} because download failed ..".format(output_path))
-                            os.remove(output_path)
+                        journal.keep_partial()
                         return None
 
                 if guess_aws_location:
@@ -209,9 +596,9 @@ def download_and_extract_one_run(run_identifier, **kwargs):
                     downloaded_files = download_from_aws(guessed_location, run_identifier, download_threads, method)
                 else:
                     if ncbi_locations is None:
-                        ncbi_locations = Location.get_ncbi_locations(run_identifier)
-                    odp_http_locations = ncbi_locations.object_locations(
-                        NcbiLocationJson.OBJECT_TYPE_SRA, NcbiLocationJson.AWS_SERVICE, False
+                        ncbi_locations = Location.get_ncbi_locations(run_identifier, cache=location_cache)
+                    odp_http_locations = ncbi_locations.object_locations_of_types(
+                        sra_object_types, NcbiLocationJson.AWS_SERVICE, False
                     )
 
                     if len(odp_http_locations) > 0:
@@ -219,24 +606,19 @@ def download_and_extract_one_run(run_identifier, **kwargs):
                             logging.debug("Found ODP link {}".format(odp_http_location))
                             logging.info("Found ODP link {}".format(odp_http_location.link()))
                             odp_link = odp_http_location.link()
-                            downloaded_files = download_from_aws(odp_link, run_identifier, download_threads, method)
-                            if downloaded_files is not None and check_md5sums:
-                                for downloaded_file in downloaded_files:
-                                    # Is there always just 1 .sra file? There is only 1 md5sum
-                                    logging.info("Checking md5sum of downloaded file {} ..".format(downloaded_file))
-                                    if MD5.check_md5sum(downloaded_file, odp_http_location.md5sum()):
-                                        logging.info("MD5sum OK for {}".format(downloaded_file))
-                                    else:
-                                        logging.warning("MD5sum check failed for {}".format(downloaded_file))
+                            downloaded_files = download_from_aws(odp_link, run_identifier, download_threads, method,
+                                expected_size=odp_http_location.size(), md5sum=odp_http_location.md5sum())
+                            if downloaded_files is not None:
+                                break
                     else:
                         logging.warning("Method {} failed: No ODP URL could be found".format(method))
 
             elif method == 'aws-cp':
                 if ncbi_locations is None:
-                    ncbi_locations = Location.get_ncbi_locations(run_identifier)
+                    ncbi_locations = Location.get_ncbi_locations(run_identifier, cache=location_cache)
 
-                s3_locations = ncbi_locations.object_locations(
-                    NcbiLocationJson.OBJECT_TYPE_SRA,
+                s3_locations = ncbi_locations.object_locations_of_types(
+                    sra_object_types,
                     NcbiLocationJson.AWS_SERVICE,
                     's3' in allowable_sources
                 )
@@ -258,7 +640,7 @@ def download_and_extract_one_run(run_identifier, **kwargs):
                                 os.environ['AWS_SECRET_ACCESS_KEY'] = aws_user_key_secret
                             logging.info("Downloading from S3..")
                             try:
-                                extern.run(command)
+                                tracing.run(command)
                                 downloaded_files = [output_path]
                             except ExternCalledProcessError as e:
                                 logging.warning("Method {} failed: Error was: {}".format(method, e))
@@ -269,6 +651,8 @@ def download_and_extract_one_run(run_identifier, **kwargs):
                             if os.path.exists(output_path):
                                 logging.info("Removing file {} because download failed ..".format(output_path))
                                 os.remove(output_path)
+                        if downloaded_files is not None:
+                            break
                 else:
                     logging.warning("Method {} failed: No S3 location could be found".format(method))
                     if os.path.exists(output_path):
@@ -279,9 +663,9 @@ def download_and_extract_one_run(run_identifier, **kwargs):
                 output_path = output_location_factory.output_stem('{}.sra'.format(run_identifier))
                 if 'gcp' in allowable_sources:
                     if ncbi_locations is None:
-                        ncbi_locations = Location.get_ncbi_locations(run_identifier)
-                    locations = ncbi_locations.object_locations(
-                        NcbiLocationJson.OBJECT_TYPE_SRA, NcbiLocationJson.GCP_SERVICE, True
+                        ncbi_locations = Location.get_ncbi_locations(run_identifier, cache=location_cache)
+                    locations = ncbi_locations.object_locations_of_types(
+                        sra_object_types, NcbiLocationJson.GCP_SERVICE, True
                     )
                     if len(locations) > 0:
                         for loc in locations:
@@ -293,14 +677,14 @@ def download_and_extract_one_run(run_identifier, **kwargs):
                                     if 'project_id' not in j:
                                         raise Exception("Unexpectedly could not find project_id in GCP user key JSON file")
                                     gcp_project = j['project_id']
-                                extern.run('gcloud auth activate-service-account --key-file={}'.format(gcp_user_key_file))
+                                tracing.run('gcloud auth activate-service-account --key-file={}'.format(gcp_user_key_file))
 
                             failed = False
                             if gcp_project:
                                 command = command + " -u {}".format(gcp_project)
                             else:
                                 logging.info("Finding Google cloud project to charge")
-                                project_id = extern.run('gcloud config get-value project').strip()
+                                project_id = tracing.run('gcloud config get-value project').strip()
                                 if project_id == '':
                                     logging.warning("Method gcp-cp failed: Could not find a GCP project to charge, cannot continue. "\
                                         "Expected a project from 'gcloud config get-value project' or specified with --gcp-user-key-file or --gcp-project")
@@ -316,7 +700,7 @@ def download_and_extract_one_run(run_identifier, **kwargs):
                                     )
                                     logging.info("Downloading from GCP..")
                                     try:
-                                        extern.run(command)
+                                        tracing.run(command)
                                         downloaded_files = [output_path]
                                     except ExternCalledProcessError as e:
                                         logging.warning("Method {} failed: Error was: {}".format(method, e))
@@ -328,44 +712,122 @@ def download_and_extract_one_run(run_identifier, **kwargs):
                                     if os.path.exists(output_path):
                                         logging.info("Removing file {} because download failed ..".format(output_path))
                                         os.remove(output_path)
+                            if downloaded_files is not None:
+                                break
                     else:
                         logging.warning("Method {} failed: No GCP location could be found".format(method))
                 else:
                     logging.warning("Not using method gcp-cp as --allow-paid was not specified")
 
             elif method == 'ena-ascp':
-                result = EnaDownloader().download_with_aspera(run_identifier, output_directory,
+                result = ena_downloader.download_with_aspera(run_identifier, output_directory,
                     ascp_args=ascp_args,
                     ssh_key=ascp_ssh_key,
                     check_md5sums=check_md5sums)
+                download_record.seconds = time.time() - download_record.start_time
                 if result is not False:
-                    gzip_test_files(result)
+                    with metrics.phase(run_identifier, PHASE_VERIFY, method) as verify_record:
+                        verify_record.add_file_sizes(result)
+                        gzip_test_files(result)
                     downloaded_files = result
+                    if check_md5sums:
+                        verified_md5sums.extend(ena_report.md5sums)
 
             elif method == 'ena-ftp':
-                result = EnaDownloader().download_with_curl(
-                    run_identifier,
-                    download_threads,
-                    output_directory,
-                    check_md5sums=check_md5sums)
+                # Only the start of each file is needed when keeping the first
+                # reads, so stop downloading once they have been read.
+                partial = subsample is not None and subsample.is_prefix()
+                if check_md5sums and (partial or stdout):
+                    logging.warning("Not checking md5sums of files downloaded from ENA, as they are not downloaded in full to disk")
+                if stdout:
+                    # Forward the reads as they arrive, leaving no files to
+                    # extract
+                    streamed = ena_downloader.stream_interleaved(
+                        run_identifier, sys.stdout.buffer, output_format_possibilities[0], subsample)
+                    result = False if streamed is False else []
+                elif partial:
+                    result = ena_downloader.download_subsample(run_identifier, output_directory, subsample)
+                else:
+                    result = ena_downloader.download_with_curl(
+                        run_identifier,
+                        download_threads,
+                        output_directory,
+                        check_md5sums=check_md5sums,
+                        http_downloader=http_downloader,
+                        show_progress=not hide_download_progress)
+                download_record.seconds = time.time() - download_record.start_time
                 if result is not False:
-                    gzip_test_files(result)
+                    with metrics.phase(run_identifier, PHASE_VERIFY, method) as verify_record:
+                        verify_record.add_file_sizes(result)
+                        gzip_test_files(result)
                     downloaded_files = result
+                    if partial or stdout:
+                        subsample_on_extraction = None
+                    elif check_md5sums:
+                        verified_md5sums.extend(ena_report.md5sums)
 
             else:
                 raise Exception("Unknown method: {}".format(method))
             
             if downloaded_files is not None:
+                download_record.add_file_sizes(downloaded_files)
+                metrics.record(download_record)
                 logging.info("Method {} worked.".format(method))
                 break
             else:
+                download_record.fail("Method {} failed".format(method))
+                metrics.record(download_record)
                 logging.warning("Method {} failed".format(method))
 
         if downloaded_files is None:
             raise Exception("No more specified download methods, cannot continue")
 
+        if run_state is not None and not stdout:
+            run_state.record(run_identifier,
+                RunStateDatabase.PHASE_VERIFIED if len(verified_md5sums) > 0 else RunStateDatabase.PHASE_DOWNLOADED,
+                method = method,
+                downloaded_files = downloaded_files,
+                downloaded_bytes = sum([os.path.getsize(f) for f in downloaded_files]),
+                md5sums = verified_md5sums if len(verified_md5sums) > 0 else None,
+                download_seconds = time.time() - download_start)
+
+    return downloaded_run(downloaded_files)
+
+def _downloaded_md5sum_ok(path, md5sum, observed_md5sum=None):
+    '''Return True if the md5sum of a downloaded file matches md5sum. If it
+    was not calculated during the download, as it is not by aria2c or curl,
+    the file is read again in a background thread, which is waited for so
+    that a corrupt file is never extracted.'''
+    if observed_md5sum is not None:
+        # Calculated during the download, so no need to read the file again
+        return observed_md5sum == md5sum
+    logging.info("Checking md5sum of downloaded file {} ..".format(path))
+    return MD5.check_md5sum_in_background(path, md5sum).result()
+
+def _extract_downloaded_run(downloaded_run):
+    try:
+        with tracing.span('extract {}'.format(downloaded_run.run_identifier), 'run'):
+            return _extract_downloaded_run_locked(downloaded_run)
+    finally:
+        if downloaded_run.run_lock is not None:
+            downloaded_run.run_lock.release()
+
+def _extract_downloaded_run_locked(downloaded_run):
+    run_identifier = downloaded_run.run_identifier
+    downloaded_files = downloaded_run.downloaded_files
+    output_files = downloaded_run.output_files
+    output_location_factory = downloaded_run.output_location_factory
+    output_format_possibilities = downloaded_run.output_format_possibilities
+    unsorted = downloaded_run.unsorted
+    stdout = downloaded_run.stdout
+    extraction_threads = downloaded_run.extraction_threads
+    output_directory = downloaded_run.output_directory
+    metrics = downloaded_run.metrics
+    conversion_engine = downloaded_run.conversion_engine
+    extraction_start = time.time()
+
     # Extraction/conversion phase
-    if not skip_download_and_extraction:
+    if not downloaded_run.skip_download_and_extraction:
         if downloaded_files == [output_location_factory.output_stem('{}.sra'.format(run_identifier))]:
             sra_file = downloaded_files[0]
             if 'sra' not in output_format_possibilities:
@@ -376,14 +838,24 @@ def download_and_extract_one_run(run_identifier, **kwargs):
                     stdout = stdout,
                     threads = extraction_threads,
                     output_directory = output_directory,
+                    metrics = metrics,
+                    extraction_slices = downloaded_run.extraction_slices,
+                    num_spots = downloaded_run.num_spots,
+                    subsample = downloaded_run.subsample,
                 )
                 os.remove(sra_file)
             else:
                 output_files.append(sra_file)
         else:
             if stdout:
-                raise Exception("--stdout currently must be via download of a .sra format file, rather than a download from ENA. I imagine this will be fixed in future.")
-            if 'fastq.gz' in output_format_possibilities:
+                # Files downloaded with ena-ftp have already been streamed, so
+                # there are none here
+                _interleave_downloaded_fastq(run_identifier, downloaded_files,
+                    output_format_possibilities[0], downloaded_run.subsample, metrics)
+            elif downloaded_run.subsample is not None:
+                output_files = _subsample_downloaded_fastq(run_identifier, downloaded_files,
+                    output_format_possibilities, downloaded_run.subsample, metrics)
+            elif 'fastq.gz' in output_format_possibilities:
                 output_files = downloaded_files
             else:
                 for fq in ['x_1.fastq.gz','x_2.fastq.gz','x.fastq.gz']:
@@ -393,22 +865,20 @@ def download_and_extract_one_run(run_identifier, **kwargs):
                         if 'fasta' in output_format_possibilities:
                             logging.info("Converting {} to FASTA ..".format(f))
                             out_here = f.replace('.fastq.gz','.fasta')
-                            extern.run("pigz -p {} -cd {} |awk '{{print \">\" substr($0,2);getline;print;getline;getline}}' >{}".format(
-                                extraction_threads, f, out_here
-                            ))
+                            _convert_fastq_to_fasta(run_identifier, f, out_here, conversion_engine, extraction_threads, metrics)
                             os.remove(f)
                             output_files.append(out_here)
                         elif 'fasta.gz' in output_format_possibilities:
-                            logging.info("Converting {} to FASTA and compressing with pigz ..".format(f))
+                            logging.info("Converting {} to FASTA and compressing ..".format(f))
                             out_here = f.replace('.fastq.gz','.fasta.gz')
-                            extern.run("pigz -cd {} |awk '{{print \">\" substr($0,2);getline;print;getline;getline}}' |pigz -p {} >{}".format(
-                                f, extraction_threads, out_here
-                            ))
+                            _convert_fastq_to_fasta(run_identifier, f, out_here, conversion_engine, extraction_threads, metrics)
                             os.remove(f)
                             output_files.append(out_here)
                         elif 'fastq' in output_format_possibilities:
                             logging.info("Decompressing {} with pigz ..".format(f))
-                            extern.run("pigz -p {} -d {}".format(extraction_threads, f))
+                            with metrics.phase(run_identifier, PHASE_CONVERT, 'pigz') as record:
+                                tracing.run("pigz -p {} -d {}".format(extraction_threads, f))
+                                record.add_file_sizes([f.replace('.fastq.gz','.fastq')])
                             output_files.append(f.replace('.fastq.gz','.fastq'))
                         else:
                             raise Exception("Programming error")
@@ -416,7 +886,13 @@ def download_and_extract_one_run(run_identifier, **kwargs):
     if not stdout and len(output_files) == 0:
         raise Exception("No output files found, something went amiss, unsure what.")
 
+    if downloaded_run.run_state is not None and not downloaded_run.skip_download_and_extraction:
+        downloaded_run.run_state.record(run_identifier, RunStateDatabase.PHASE_EXTRACTED,
+            output_files = output_files,
+            extraction_seconds = time.time() - extraction_start)
+
     logging.info("Output files: {}".format(', '.join(output_files)))
+    return output_files
 
     
 def extract(**kwargs):
@@ -428,12 +904,31 @@ def extract(**kwargs):
     stdout = kwargs.pop('stdout', False)
     threads = kwargs.pop('threads',DEFAULT_THREADS)
     output_directory = kwargs.pop('output_directory', '.')
+    metrics = kwargs.pop('metrics', None)
+    extraction_slices = kwargs.pop('extraction_slices', 1)
+    num_spots = kwargs.pop('num_spots', None)
+    subsample = kwargs.pop('subsample', None)
+    max_reads = kwargs.pop('max_reads', None)
+    fraction = kwargs.pop('fraction', None)
+    reservoir_reads = kwargs.pop('reservoir_reads', None)
+    seed = kwargs.pop('seed', None)
 
     if len(kwargs) > 0:
         raise Exception("Unexpected arguments detected: %s" % kwargs)
 
-    if stdout and not unsorted:
-        raise Exception("Currently --stdout must be used with --unsorted")
+    if metrics is None:
+        metrics = MetricsRecorder()
+    if subsample is None:
+        subsample = Subsample.from_options(max_reads, fraction, reservoir_reads, seed)
+
+    if extraction_slices < 1:
+        raise Exception("The number of extraction slices must be at least 1")
+    if extraction_slices > 1 and unsorted:
+        raise Exception("Extraction in slices cannot be used with --unsorted")
+    if extraction_slices > 1 and stdout:
+        raise Exception("Extraction in slices cannot be used with --stdout")
+    if subsample is not None and (unsorted or extraction_slices > 1):
+        raise Exception("Subsampling cannot be used with --unsorted or extraction in slices")
 
     run_identifier = os.path.basename(sra_file)
     if sra_file.endswith(".sra"):
@@ -467,20 +962,22 @@ def extract(**kwargs):
         else:
             raise Exception("Cannot extract with --stdout --unsorted format {}".format(format))
         logging.debug("Running command {}".format(cmd))
-        try:
-            subprocess.check_call(cmd, shell=True, stderr=subprocess.PIPE)
-        except subprocess.CalledProcessError as e:
-            raise Exception("Extraction of .sra to fasta format failed. Command run was '{}'. STDERR was '{}'".format(
-                cmd, e.stderr
-            ))
+        with metrics.phase(run_identifier, PHASE_CONVERT, 'sracat'):
+            try:
+                tracing.check_call(cmd, shell=True, stderr=subprocess.PIPE)
+            except subprocess.CalledProcessError as e:
+                raise Exception("Extraction of .sra to fasta format failed. Command run was '{}'. STDERR was '{}'".format(
+                    cmd, e.stderr
+                ))
             
     elif unsorted and not stdout:
         def run_command(cmd):
             logging.debug("Running command {}".format(cmd))
-            try:
-                subprocess.check_call(cmd, shell=True, stderr=subprocess.PIPE)
-            except subprocess.CalledProcessError as e:
-                raise Exception(f"Extraction of .sra to format unsorted {format} failed. Command run was '{cmd}'. STDERR was '{e.stderr}'")
+            with metrics.phase(run_identifier, PHASE_CONVERT, 'sracat'):
+                try:
+                    tracing.check_call(cmd, shell=True, stderr=subprocess.PIPE)
+                except subprocess.CalledProcessError as e:
+                    raise Exception(f"Extraction of .sra to format unsorted {format} failed. Command run was '{cmd}'. STDERR was '{e.stderr}'")
 
         # By default, we want separate outputs for forward and reverse.
         format = output_format_possibilities[0]
@@ -520,9 +1017,10 @@ def extract(**kwargs):
                 # arrives to terminate the pigz process.
                 logging.debug("Running echo to make sure at least one EOF arrived on the pipe")
                 subprocess.Popen(['bash','-c',f'cat {fifo} > /dev/null'])
-                extern.run(f'echo -n >> {fifo}')
+                tracing.run(f'echo -n >> {fifo}')
                 
-                ret = c.wait()
+                with tracing.span('pigz', 'process', command=' '.join(c.args)):
+                    ret = c.wait()
                 if ret != 0:
                     raise subprocess.SubprocessError(f"Command {c.args} returned with non-zero exitstatus {ret}")
                 logging.debug("Process finished")
@@ -564,52 +1062,234 @@ def extract(**kwargs):
         else:
             raise Exception("Cannot extract with --unsorted format {}".format(format))
 
+    elif stdout:
+        # Interleave the reads of each spot on stdout, in the order of the
+        # .sra file.
+        format = output_format_possibilities[0]
+        if format not in ('fastq', 'fastq.gz', 'fasta', 'fasta.gz'):
+            raise Exception("Cannot extract with --stdout format {}".format(format))
+        sra_file_abs = os.path.abspath(sra_file)
+        dumper, dump_command = _spot_dump_command(sra_file_abs, threads, subsample)
+        cmd = "set -o pipefail; {} |{}".format(dump_command, interleave_spots_command(format, threads, subsample))
+        logging.info("Extracting .sra file with {} to STDOUT in {} format ..".format(dumper, format))
+        logging.debug("Running command {}".format(cmd))
+        with metrics.phase(run_identifier, PHASE_CONVERT, dumper + '+awk'):
+            try:
+                tracing.check_call(cmd, shell=True, executable='/bin/bash')
+            except subprocess.CalledProcessError:
+                raise Exception("Extraction of .sra to STDOUT failed. Command run was '{}'".format(cmd))
+
     else:
         if not skip_download_and_extraction:
-            logging.info("Extracting .sra file with fasterq-dump ..")
-
-            # Change directory to the output directory using a "with", so that fasterq-dump outputs there, not here.
+            # Change directory to the output directory within the shell, so
+            # that fasterq-dump outputs there, not here. This is done rather
+            # than changing the working directory of this process, so that
+            # several runs can be extracted concurrently.
             sra_file_abs = os.path.abspath(sra_file)
-            with bird_tool_utils.in_working_directory(output_directory):
-                extern.run("fasterq-dump --threads {} {}".format(threads, sra_file_abs))
-
-                if 'fastq' not in output_format_possibilities:
-                    for fq in ['x_1.fastq','x_2.fastq','x.fastq']:
-                        f = output_location_factory.output_stem(fq.replace('x',run_identifier))
-                        if os.path.exists(f):
-                            # Do the least work, currently we have FASTQ.
-                            if 'fasta' in output_format_possibilities:
-                                logging.info("Converting {} to FASTA ..".format(f))
-                                out_here = output_location_factory.output_stem(re.sub('.fastq$','.fasta',f))
-                                extern.run("awk '{{print \">\" substr($0,2);getline;print;getline;getline}}' {} >{}".format(
-                                    f, out_here
-                                ))
-                                os.remove(f)
-                                output_files.append(out_here)
-                            elif 'fasta.gz' in output_format_possibilities:
-                                logging.info("Converting {} to FASTA and compressing with pigz ..".format(f))
-                                out_here = output_location_factory.output_stem(re.sub('.fastq$','.fasta.gz',f))
-                                extern.run("awk '{{print \">\" substr($0,2);getline;print;getline;getline}}' {} |pigz -p {} >{}".format(
-                                    f, threads, out_here
-                                ))
-                                os.remove(f)
-                                output_files.append(out_here)
-                            elif 'fastq.gz' in output_format_possibilities:
-                                out_here = os.path.abspath(output_location_factory.output_stem(f'{f}.gz'))
-                                logging.info("Compressing {} with pigz into {} ..".format(f, out_here))
-                                extern.run("pigz -c -p {} {} > {}".format(threads, f, out_here))
-                                os.remove(f)
-                                output_files.append(out_here)
-                            else:
-                                raise Exception("Programming error")
-                else:
-                    for fq in ['x_1.fastq','x_2.fastq','x.fastq']:
-                        f = fq.replace('x',run_identifier)
-                        if os.path.exists(f):
-                            output_files.append(f)
+            if 'fastq' in output_format_possibilities:
+                format = 'fastq'
+            elif 'fasta' in output_format_possibilities:
+                format = 'fasta'
+            elif 'fasta.gz' in output_format_possibilities:
+                format = 'fasta.gz'
+            elif 'fastq.gz' in output_format_possibilities:
+                format = 'fastq.gz'
+            else:
+                raise Exception("Programming error")
+            output_paths = [output_location_factory.output_stem('{}.{}'.format(name.replace('x',run_identifier), format))
+                for name in ['x_1','x_2','x']]
+
+            if extraction_slices > 1:
+                if num_spots is None:
+                    num_spots = _sra_spot_count(sra_file_abs)
+                _extract_spot_slices(run_identifier, sra_file_abs, format, num_spots, extraction_slices,
+                    threads, output_location_factory, metrics)
+            elif format == 'fastq' and subsample is None:
+                logging.info("Extracting .sra file with fasterq-dump ..")
+                with metrics.phase(run_identifier, PHASE_CONVERT, 'fasterq-dump') as record:
+                    tracing.run("cd '{}' && fasterq-dump --threads {} {}".format(
+                        output_location_factory.output_directory, threads, sra_file_abs))
+                    record.add_file_sizes(output_paths)
+            else:
+                # Stream the reads of each spot from fasterq-dump, splitting
+                # them into files by read number as --split-3 does, and
+                # converting and compressing on the way, so that uncompressed
+                # FASTQ is never written to disk. When only the first reads
+                # are kept, fastq-dump is used instead as it can stop there.
+                dumper, dump_command = _spot_dump_command(sra_file_abs, threads, subsample)
+                logging.info("Extracting .sra file with {}, streaming into {} format ..".format(dumper, format))
+                phase, method = (PHASE_COMPRESS, dumper + '+awk+pigz') if format.endswith('.gz') \
+                    else (PHASE_CONVERT, dumper + '+awk')
+                with metrics.phase(run_identifier, phase, method) as record:
+                    tracing.run("cd '{}' && {} |{}".format(
+                        output_location_factory.output_directory, dump_command,
+                        split_spots_command(output_location_factory.output_stem(run_identifier), format, threads, subsample)))
+                    record.add_file_sizes(output_paths)
+
+            for f in output_paths:
+                if os.path.exists(f):
+                    output_files.append(f)
 
     return output_files
 
+def _spot_dump_command(sra_file, threads, subsample):
+    '''Return the name of the dumper and a shell command writing the reads of
+    the .sra file to stdout, those of each spot consecutive. When only the
+    first reads are kept, fastq-dump is used as it can stop there, with the
+    same deflines as fasterq-dump.'''
+    if subsample is not None and subsample.is_prefix():
+        return 'fastq-dump', "fastq-dump --split-spot --skip-technical {} --stdout -X {} {}".format(
+            FASTQ_DUMP_DEFLINE_OPTIONS, subsample.max_reads, sra_file)
+    return 'fasterq-dump', "fasterq-dump --split-spot --stdout --threads {} {}".format(threads, sra_file)
+
+def _sra_spot_count(sra_file):
+    '''Return the number of spots in an .sra file, according to sra-stat.'''
+    output = tracing.run("sra-stat --quick --xml '{}'".format(sra_file))
+    matches = re.search(r'spot_count="(\d+)"', output)
+    if matches is None:
+        raise Exception("Unable to determine the number of spots in {} from the output of sra-stat".format(sra_file))
+    return int(matches.group(1))
+
+def _spot_ranges(num_spots, num_slices):
+    '''Split spots 1 to num_spots into at most num_slices contiguous ranges of
+    near equal size, returned as (first, last) tuples, inclusive. There are
+    no ranges if there are no spots.'''
+    if num_spots < 1:
+        return []
+    num_slices = max(1, min(num_slices, num_spots))
+    ranges = []
+    first = 1
+    for i in range(num_slices):
+        last = num_spots * (i + 1) // num_slices
+        ranges.append((first, last))
+        first = last + 1
+    return ranges
+
+def _spot_slice_dump_command(sra_file, first, last):
+    '''Return a shell command writing spots first to last of the .sra file
+    to stdout, those of each spot consecutive, as fasterq-dump --split-spot
+    would, skipping technical reads as fasterq-dump does by default.'''
+    return "fastq-dump --split-spot --skip-technical {} --stdout -N {} -X {} {}".format(
+        FASTQ_DUMP_DEFLINE_OPTIONS, first, last, sra_file)
+
+def _extract_spot_slices(run_identifier, sra_file, format, num_spots, num_slices, threads,
+    output_location_factory, metrics):
+    '''Extract an .sra file by splitting its spots into ranges, extracting
+    each with fastq-dump concurrently, then concatenating the outputs of each
+    range in order. Compressed outputs are concatenated as they are, since a
+    series of gzip members is itself a valid gzip file.'''
+    ranges = _spot_ranges(num_spots, num_slices)
+    if len(ranges) == 0:
+        logging.warning("No spots to extract from {}".format(sra_file))
+        return
+    slice_threads = max(1, threads // len(ranges))
+    logging.info("Extracting .sra file in {} slices of about {} spots each, streaming into {} format ..".format(
+        len(ranges), ranges[0][1], format))
+    names = ['x_1','x_2','x']
+    slice_stems = [output_location_factory.output_stem('{}.slice{}'.format(run_identifier, i+1)) for i in range(len(ranges))]
+
+    def extract_slice(i):
+        first, last = ranges[i]
+        tracing.run("cd '{}' && {} |{}".format(
+            output_location_factory.output_directory, _spot_slice_dump_command(sra_file, first, last),
+            split_spots_command(slice_stems[i], format, slice_threads)))
+
+    phase = PHASE_COMPRESS if format.endswith('.gz') else PHASE_CONVERT
+    with metrics.phase(run_identifier, phase, 'fastq-dump-slices') as record:
+        try:
+            with ThreadPoolExecutor(len(ranges)) as pool:
+                for future in [pool.submit(extract_slice, i) for i in range(len(ranges))]:
+                    future.result()
+
+            for name in names:
+                parts = [stem + name[1:] + '.' + format for stem in slice_stems]
+                parts = [p for p in parts if os.path.exists(p)]
+                if len(parts) == 0:
+                    continue
+                output = output_location_factory.output_stem('{}.{}'.format(name.replace('x',run_identifier), format))
+                logging.debug("Concatenating {} slices into {}".format(len(parts), output))
+                with open(output, 'wb') as out:
+                    for part in parts:
+                        with open(part, 'rb') as f:
+                            shutil.copyfileobj(f, out)
+                        os.remove(part)
+                record.add_file_sizes([output])
+        finally:
+            for stem in slice_stems:
+                for name in names:
+                    part = stem + name[1:] + '.' + format
+                    if os.path.exists(part):
+                        os.remove(part)
+
+def _subsample_downloaded_fastq(run_identifier, downloaded_files, output_format_possibilities, subsample, metrics):
+    '''Subsample FASTQ.GZ files downloaded from ENA, writing the reads kept
+    straight into the preferred output format. Returns the output files.'''
+    if 'fastq.gz' in output_format_possibilities:
+        format = 'fastq.gz'
+    elif 'fasta' in output_format_possibilities:
+        format = 'fasta'
+    elif 'fasta.gz' in output_format_possibilities:
+        format = 'fasta.gz'
+    elif 'fastq' in output_format_possibilities:
+        format = 'fastq'
+    else:
+        raise Exception("Programming error")
+    logging.info("Subsampling reads of {} into {} format ..".format(run_identifier, format))
+    with metrics.phase(run_identifier, PHASE_CONVERT, 'subsample') as record:
+        groups = paired_groups(downloaded_files)
+        output_groups = [[re.sub(r'\.fastq\.gz$', '.' + format, f) for f in group] for group in groups]
+        subsample_fastq_files(groups, output_groups, subsample)
+        for (f, output) in zip([f for group in groups for f in group], [o for group in output_groups for o in group]):
+            if f != output and os.path.exists(f):
+                os.remove(f)
+        output_files = [o for group in output_groups for o in group if os.path.exists(o)]
+        record.add_file_sizes(output_files)
+    return output_files
+
+
+def _interleave_downloaded_fastq(run_identifier, downloaded_files, output_format, subsample, metrics):
+    '''Write the reads of downloaded FASTQ.GZ files to stdout, with those of
+    each pair consecutive, removing the files afterwards.'''
+    if len(downloaded_files) == 0:
+        return
+    logging.info("Writing reads of {} to STDOUT in {} format ..".format(run_identifier, output_format))
+    with metrics.phase(run_identifier, PHASE_CONVERT, 'interleave'):
+        inputs = []
+        def open_groups():
+            for group in paired_groups(downloaded_files):
+                streams = [gzip.open(f, 'rb') for f in group]
+                inputs.extend(streams)
+                yield streams
+        try:
+            interleave_fastq_streams(open_groups(), sys.stdout.buffer, output_format, subsample)
+        finally:
+            for f in inputs:
+                f.close()
+        for f in downloaded_files:
+            os.remove(f)
+
+
+def _convert_fastq_to_fasta(run_identifier, fastq_file, fasta_file, conversion_engine, threads, metrics):
+    '''Convert a FASTQ file to FASTA. The FASTQ file is decompressed if it
+    ends in .gz, and the FASTA file is compressed if it does.'''
+    phase = PHASE_COMPRESS if fasta_file.endswith('.gz') else PHASE_CONVERT
+    if conversion_engine == 'builtin':
+        with metrics.phase(run_identifier, phase, 'builtin') as record:
+            with tracing.span('fastq_to_fasta', 'convert', input=fastq_file, output=fasta_file):
+                fastq_to_fasta(fastq_file, fasta_file, threads)
+            record.add_file_sizes([fasta_file])
+    else:
+        awk = "awk '{print \">\" substr($0,2);getline;print;getline;getline}'"
+        if fastq_file.endswith('.gz'):
+            cmd = "pigz -p {} -cd {} |{}".format(threads, fastq_file, awk)
+        else:
+            cmd = "{} {}".format(awk, fastq_file)
+        if fasta_file.endswith('.gz'):
+            cmd += " |pigz -p {}".format(threads)
+        with metrics.phase(run_identifier, phase, 'awk+pigz' if fasta_file.endswith('.gz') else 'awk') as record:
+            tracing.run("{} >{}".format(cmd, fasta_file))
+            record.add_file_sizes([fasta_file])
+
 def gzip_test_files(gzip_files):
     """
     Run "pigz -t" on each result file, to check that it is a valid gzip file.
@@ -618,7 +1298,11 @@ def gzip_test_files(gzip_files):
     """
     for f in gzip_files:
         logging.info("Verifying gzip file {} ..".format(f))
-        extern.run("pigz -t '{}'".format(f))
+        tracing.run("pigz -t '{}'".format(f))
+
+
+# Columns output by annotate unless others are asked for
+DEFAULT_ANNOTATE_COLUMNS = [RUN_ACCESSION_KEY,BIOPROJECT_ACCESSION_KEY,'Gbp','library_strategy','library_selection','model',SAMPLE_NAME_KEY,'taxon_name']
 
 
 def annotate(**kwargs):
@@ -629,6 +1313,7 @@ def annotate(**kwargs):
     output_file = kwargs.pop('output_file')
     output_format = kwargs.pop('output_format')
     all_columns = kwargs.pop('all_columns')
+    columns = kwargs.pop('columns', None)
 
     if bioproject_accession and bioproject_accessions is None:
         bioproject_accessions = [bioproject_accession]
@@ -643,6 +1328,9 @@ def annotate(**kwargs):
     if bioproject_accessions is not None:
         run_identifiers = SraMetadata().fetch_runs_from_bioprojects(bioproject_accessions)
         logging.debug("Found {} run(s) to annotate".format(len(run_identifiers)))
+        if len(run_identifiers) == 0:
+            logging.error("No runs to annotate")
+            sys.exit(1)
     if run_identifiers_file is not None:
         with open(run_identifiers_file) as f:
             run_identifiers = list([r.strip() for r in f.readlines()])
@@ -650,16 +1338,26 @@ def annotate(**kwargs):
     if len(kwargs) > 0:
         raise Exception("Unexpected arguments detected: %s" % kwargs)
 
-    metadata = SraMetadata().efetch_sra_from_accessions(run_identifiers)
+    if all_columns:
+        parse_columns = None
+    else:
+        # Only parse the columns output, which is much quicker for many runs
+        parse_columns = [BASES_KEY if c == 'Gbp' else c for c in (columns or DEFAULT_ANNOTATE_COLUMNS)]
+    metadata = SraMetadata().efetch_sra_from_accessions(run_identifiers, columns=parse_columns)
     if metadata is None:
         logging.error("No runs to annotate")
         sys.exit(1)
-    _output_formatted_metadata(metadata, output_file, output_format, all_columns)
+    _output_formatted_metadata(metadata, output_file, output_format, all_columns, columns)
 
 
-def _output_formatted_metadata(metadata, output_file, output_format, all_columns):
-    # NOTE: If changing this default set, also need to change the default set in human readable output below too.
-    default_columns = [RUN_ACCESSION_KEY,BIOPROJECT_ACCESSION_KEY,'Gbp','library_strategy','library_selection','model',SAMPLE_NAME_KEY,'taxon_name']
+def _output_formatted_metadata(metadata, output_file, output_format, all_columns, columns=None):
+    '''Write metadata in output_format. The columns given are output in that
+    order, or DEFAULT_ANNOTATE_COLUMNS if columns is None, followed by all
+    other columns if all_columns is set.'''
+    default_columns = list(columns) if columns is not None else DEFAULT_ANNOTATE_COLUMNS
+    missing_columns = [c for c in default_columns if c not in metadata.columns and not (c == 'Gbp' and BASES_KEY in metadata.columns)]
+    if len(missing_columns) > 0:
+        logging.warning("No run has metadata for column(s): {}".format(', '.join(missing_columns)))
 
     def prepare_for_tsv_csv(metadata, default_columns, all_columns):
         metadata_sorted = metadata.sort_values(RUN_ACCESSION_KEY)
@@ -673,10 +1371,10 @@ def _output_formatted_metadata(metadata, output_file, output_format, all_columns
         metadata_sorted = pd.concat(
             [
                 metadata_sorted,
-                pd.DataFrame({'Gbp': [
-                    round(bases/1e9, 3) if bases is not None else None for bases in metadata_sorted[BASES_KEY]]})
-            ],
+                pd.DataFrame({'Gbp': (metadata_sorted[BASES_KEY].astype('Float64') / 1e9).round(3)})
+            ] if BASES_KEY in metadata_sorted.columns else [metadata_sorted],
             axis=1)
+        metadata_sorted = metadata_sorted.reindex(columns=list(metadata_sorted.columns) + missing_columns)
         if all_columns:
             # Re-order columns to be consistent with human format output
             column_order = default_columns + [c for c in metadata_sorted.columns if c not in default_columns]
@@ -688,23 +1386,24 @@ def _output_formatted_metadata(metadata, output_file, output_format, all_columns
     output_path = sys.stdout if output_file is None else output_file
 
     if output_format == 'human':
-        to_print = []
-        for value in metadata[RUN_ACCESSION_KEY]:
-            to_print.append({RUN_ACCESSION_KEY: value})
-        for i, value in enumerate(metadata[BIOPROJECT_ACCESSION_KEY]):
-            to_print[i][BIOPROJECT_ACCESSION_KEY] = value
-        for i, value in enumerate(metadata[BASES_KEY]):
-            to_print[i]['Gbp'] = "%.3f" % (value/1e9) if value is not None else None
-        # for column in ['LibraryStrategy','LibrarySelection','Model','SampleName','ScientificName']:
-        for column in ['library_strategy','library_selection','model',SAMPLE_NAME_KEY,'taxon_name']:
-            for i, value in enumerate(metadata[column]):
-                to_print[i][column] = value
+        to_print = [{} for _ in range(len(metadata))]
+        for column in default_columns:
+            if column == 'Gbp' and BASES_KEY in metadata.columns:
+                for i, value in enumerate(metadata[BASES_KEY]):
+                    to_print[i]['Gbp'] = "%.3f" % (value/1e9) if not pd.isna(value) else None
+            elif column in metadata.columns:
+                for i, value in enumerate(metadata[column]):
+                    to_print[i][column] = value if not pd.isna(value) else None
+            else:
+                for row in to_print:
+                    row[column] = None
         if all_columns:
             for col in metadata.columns:
                 if col not in default_columns:
                     for i, value in enumerate(metadata[col]):
-                        to_print[i][col] = value
-        to_print = sorted(to_print, key=lambda x: x[RUN_ACCESSION_KEY])
+                        to_print[i][col] = value if not pd.isna(value) else None
+        run_accessions = list(metadata[RUN_ACCESSION_KEY])
+        to_print = [row for (_, row) in sorted(zip(run_accessions, to_print), key=lambda x: x[0])]
         if output_path == sys.stdout:
             _printTable(sys.stdout, to_print)
         else:
@@ -747,7 +1446,9 @@ def _check_for_existing_files(output_location_factory, run_identifier, output_fo
         skip_download_and_extraction = False
         final_path = output_location_factory.output_stem(path)
         if os.path.exists(final_path):
-            if force:
+            if DownloadJournal.is_incomplete(final_path):
+                logging.info("Found partial download {}, which will be resumed".format(final_path))
+            elif force:
                 logging.warn("Removing previous file {}".format(final_path))
                 os.remove(final_path)
             else:
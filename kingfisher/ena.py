@@ -1,36 +1,84 @@
 from io import StringIO
+from concurrent.futures import Future
+import gzip
 import subprocess
 import logging
 import os
 import pandas as pd
-
-import extern
-import bird_tool_utils
+import requests
 
 from .md5sum import MD5
+from . import tracing
+from .resume import DownloadJournal
+from .http_downloader import RangedHttpDownloader
+from .exception import DownloadMethodFailed
+from .subsample import paired_groups, subsample_fastq_streams, interleave_fastq_streams
 
 DEFAULT_LINUX_ASPERA_SSH_KEY_LOCATION = os.path.join(os.path.dirname(os.path.realpath(__file__)),'data','asperaweb_id_dsa.openssh')
 
+ENA_PORTAL_API_URL = 'https://www.ebi.ac.uk/ena/portal/api'
+# Schemes used to download the files listed in fastq_ftp, which are given
+# without one. ENA serves the same files over HTTPS as over FTP.
+ENA_FASTQ_HTTP_SCHEME = 'https'
+ENA_FASTQ_FTP_SCHEME = 'ftp'
+ENA_FILE_REPORT_FIELDS = 'run_accession,fastq_ftp,fastq_md5,fastq_bytes'
+# Number of accessions to resolve in each batch request
+ENA_FILE_REPORT_BATCH_SIZE = 500
+
 class EnaFileReport:
-    def __init__(self, file_paths, md5sums):
+    def __init__(self, file_paths, md5sums, file_sizes=None):
         self.file_paths = file_paths
         self.md5sums = md5sums
+        # List of sizes in bytes, or None if unknown
+        self.file_sizes = file_sizes
+
+    @staticmethod
+    def from_row(run_id, row):
+        '''Make a report from a row of an ENA portal API response, returning
+        False if the run has no FASTQ files available.'''
+        # e.g. ERR1346134 at time of writing. See https://github.com/wwood/kingfisher-download/issues/25
+        if pd.isna(row['fastq_ftp']) or row['fastq_ftp'] == '':
+            logging.error("No ENA FTP download URLs found for run {}, cannot continue".format(run_id))
+            return False
+        ftp_urls = row['fastq_ftp'].split(';')
+        md5sums = row['fastq_md5'].split(';')
+        file_sizes = None
+        if 'fastq_bytes' in row and not pd.isna(row['fastq_bytes']):
+            file_sizes = [int(b) for b in row['fastq_bytes'].split(';')]
+            if len(file_sizes) != len(ftp_urls):
+                file_sizes = None
+        logging.debug("Found {} FTP URLs for download: {}".format(
+            len(ftp_urls), ", ".join(ftp_urls)))
+        return EnaFileReport(ftp_urls, md5sums, file_sizes)
+
+    def file_size(self, index):
+        if self.file_sizes is None:
+            return None
+        return self.file_sizes[index]
 
 class EnaDownloader:
+    def __init__(self, file_reports=None):
+        # Reports resolved in advance by prefetch_file_reports, or earlier
+        # queries, by run accession. False for runs ENA has no files for.
+        self.file_reports = {} if file_reports is None else file_reports
+
     def get_ftp_download_urls(self, run_id):
+        if run_id in self.file_reports:
+            logging.debug("Using previously resolved ENA FTP paths for {}".format(run_id))
+            return self.file_reports[run_id]
+
         # Get the textual representation of the run. We specifically need the
         # fastq_ftp bit, and the MD5
         logging.info("Querying ENA for FTP paths for {}..".format(run_id))
-        query_url = "https://www.ebi.ac.uk/ena/portal/api/filereport?accession={}&" \
-            "result=read_run&fields=fastq_ftp,fastq_md5".format(
-            run_id)
+        query_url = "{}/filereport?accession={}&" \
+            "result=read_run&fields={}".format(
+            ENA_PORTAL_API_URL, run_id, ENA_FILE_REPORT_FIELDS)
         logging.debug("Querying '{}'".format(query_url))
-        text = extern.run("curl --silent '{}'".format(query_url))
+        text = tracing.run("curl --silent '{}'".format(query_url))
 
-        header = True
         logging.debug("Found text from ENA API: {}".format(text))
 
-        df = pd.read_csv(StringIO(text), sep='\t', header=0, index_col=False)
+        df = pd.read_csv(StringIO(text), sep='\t', header=0, index_col=False, dtype=str)
 
         # Expect just 1 row
         if len(df) == 0:
@@ -38,28 +86,65 @@ class EnaDownloader:
             logging.error(
                 "No FTP download URLs found for run {}, cannot continue".format(
                     run_id))
-            return False
+            report = False
         elif len(df) != 1:
             logging.error("Expected 1 row from ENA API for accession {}, got {}".format(run_id, len(df)))
-            return False
-
-        for _, row in df.iterrows():
-            # e.g. ERR1346134 at time of writing. See https://github.com/wwood/kingfisher-download/issues/25
-            if isinstance(float("nan"), type(row['fastq_ftp'])):
-                logging.error("No ENA FTP download URLs found for run {}, cannot continue".format(run_id))
-                return False
-            ftp_urls = row['fastq_ftp'].split(';')
-            md5sums = row['fastq_md5'].split(';')
-            logging.debug("Found {} FTP URLs for download: {}".format(
-                len(ftp_urls), ", ".join(ftp_urls)))
+            report = False
+        else:
+            report = EnaFileReport.from_row(run_id, df.iloc[0])
+        # Remember runs ENA has no files for too, so that they are not
+        # queried again e.g. by the next download method
+        self.file_reports[run_id] = report
+        return report
 
-        return EnaFileReport(ftp_urls, md5sums)
+    def prefetch_file_reports(self, run_ids):
+        '''Resolve the FTP paths, md5sums and sizes of the files of many runs
+        with a few batch requests, so that downloading each run does not need
+        a request of its own. Failures are not fatal, since runs which are not
+        resolved here are looked up individually when they are downloaded.'''
+        to_fetch = [r for r in run_ids if r not in self.file_reports]
+        if len(to_fetch) == 0:
+            return
+        logging.info("Querying ENA for FTP paths of {} run(s) in batches of {} ..".format(
+            len(to_fetch), ENA_FILE_REPORT_BATCH_SIZE))
+        for i in range(0, len(to_fetch), ENA_FILE_REPORT_BATCH_SIZE):
+            batch = to_fetch[i:i+ENA_FILE_REPORT_BATCH_SIZE]
+            try:
+                res = tracing.http_request('POST',
+                    '{}/search'.format(ENA_PORTAL_API_URL),
+                    data={
+                        'result': 'read_run',
+                        'includeAccessions': ','.join(batch),
+                        'fields': ENA_FILE_REPORT_FIELDS,
+                        'format': 'tsv',
+                        'limit': 0,
+                    })
+                if not res.ok:
+                    raise Exception("HTTP status {}: {}".format(res.status_code, res.text))
+                reports = EnaDownloader.parse_file_reports(res.text)
+            except Exception as e:
+                logging.warning("Failed to query ENA for a batch of FTP paths, will query them individually: {}".format(e))
+                continue
+            self.file_reports.update(reports)
+        logging.debug("Resolved ENA FTP paths for {} of {} run(s)".format(
+            len([r for r in to_fetch if r in self.file_reports]), len(to_fetch)))
 
-    def _clean_incomplete_files(self, paths):
-        for path in paths:
-            if os.path.exists(path):
-                logging.info("Removing file that is either incomplete or part of an incomplete pair: {}".format(path))
-                os.remove(path)
+    @staticmethod
+    def parse_file_reports(text):
+        '''Parse a TSV response from the ENA portal API with one row per
+        run, returning a dict of run accession to EnaFileReport. Runs without
+        FASTQ files are omitted.'''
+        if text.strip() == '':
+            return {}
+        df = pd.read_csv(StringIO(text), sep='\t', header=0, index_col=False, dtype=str)
+        reports = {}
+        for _, row in df.iterrows():
+            run_id = row['run_accession']
+            if pd.isna(row['fastq_ftp']) or row['fastq_ftp'] == '':
+                logging.debug("No ENA FTP download URLs found for run {}".format(run_id))
+                continue
+            reports[run_id] = EnaFileReport.from_row(run_id, row)
+        return reports
 
     def download_with_aspera(self, run_id, output_directory, quiet=False, ascp_args='', ssh_key=None, check_md5sums=False):
         if ssh_key is None:
@@ -82,12 +167,19 @@ class EnaDownloader:
             len(ftp_urls), ", ".join(ftp_urls)))
 
         output_files = []
-        for url, md5 in zip(ftp_urls, md5sums):
+        journals = []
+        md5_checks = []
+        for i, (url, md5) in enumerate(zip(ftp_urls, md5sums)):
             quiet_args = ''
             if quiet:
                 quiet_args = ' -Q'
             output_file = os.path.join(output_directory, os.path.basename(url))
             logging.debug("Getting output file {}".format(output_file))
+            # ascp resumes partial files itself when given -k (as it is by
+            # default), so there is no need to tell it to.
+            journal = DownloadJournal(output_file)
+            journal.prepare(url, 'ascp', expected_size=report.file_size(i), md5sum=md5)
+            journals.append(journal)
             cmd = "ascp{} -T -l 300m -P33001 {} -i {} era-fasp@fasp.sra.ebi.ac.uk:{} {}".format(
                 quiet_args,
                 ascp_args,
@@ -96,52 +188,188 @@ class EnaDownloader:
                 output_directory)
             logging.info("Running command: {}".format(cmd))
             try:
-                extern.run(cmd)
+                tracing.run(cmd)
             except Exception as e:
                 logging.warn("Error downloading from ENA with ASCP: {}".format(e))
-                self._clean_incomplete_files(output_files+[output_file])
+                self._keep_partial_files(journals)
                 return False
             if check_md5sums:
-                if MD5.check_md5sum(output_file, md5):
-                    logging.info("MD5sum OK for {}".format(output_file))
-                else:
-                    logging.error("MD5sum failed for {}".format(output_file))
-                    self._clean_incomplete_files(output_files+[output_file])
-                    return False
+                # Check in the background while the next file downloads
+                md5_checks.append((journal, MD5.check_md5sum_in_background(output_file, md5)))
             output_files.append(output_file)
+        if not self._md5_checks_passed(md5_checks, journals):
+            return False
+        self._complete(journals)
         return output_files
 
-    def download_with_curl(self, run_id, num_threads, output_directory, check_md5sums=False):
-        with bird_tool_utils.in_working_directory(output_directory):
-            report = self.get_ftp_download_urls(run_id)
-            if report is False:
-                return False
-            ftp_urls = report.file_paths
-            md5sums = report.md5sums
-
-            downloaded = []
-            for url, md5 in zip(ftp_urls, md5sums):
-                logging.info("Downloading {} ..".format(url))
-                output_file = os.path.basename(url)
-                if num_threads > 1:
-                    cmd = "aria2c -x{} -o {} 'ftp://{}'".format(
-                        num_threads, output_file, url)
-                else:
-                    cmd = "curl -L '{}' -o {}".format(url, output_file)
+    def download_with_curl(self, run_id, num_threads, output_directory, check_md5sums=False, http_downloader='external', show_progress=True):
+        report = self.get_ftp_download_urls(run_id)
+        if report is False:
+            return False
+        ftp_urls = report.file_paths
+        md5sums = report.md5sums
+
+        downloaded = []
+        journals = []
+        md5_checks = []
+        for i, (url, md5) in enumerate(zip(ftp_urls, md5sums)):
+            logging.info("Downloading {} ..".format(url))
+            expected_size = report.file_size(i)
+            output_file = os.path.join(output_directory, os.path.basename(url))
+            journal = DownloadJournal(output_file)
+            journals.append(journal)
+            # Run the download from within the output directory via the cwd
+            # argument rather than changing the working directory of this
+            # process, so several runs can be downloaded concurrently.
+            if http_downloader == 'builtin':
+                https_url = '{}://{}'.format(ENA_FASTQ_HTTP_SCHEME, url)
+                resume = journal.prepare(https_url, 'builtin', expected_size=expected_size, md5sum=md5,
+                    resume_requires=RangedHttpDownloader.progress_path(output_file))
+                try:
+                    _, observed_md5 = RangedHttpDownloader(num_threads, show_progress=show_progress).download(
+                        https_url, output_file, resume=resume, calculate_md5=check_md5sums)
+                except DownloadMethodFailed as e:
+                    logging.warning("Method ena-ftp failed, error was {}".format(e))
+                    self._keep_partial_files(journals)
+                    return False
+                if check_md5sums:
+                    # Calculated during the download, so no need to read the
+                    # file again.
+                    md5_check = Future()
+                    md5_check.set_result(observed_md5 == md5)
+                    md5_checks.append((journal, md5_check))
+                cmd = None
+            elif num_threads > 1:
+                resume = journal.prepare(url, 'aria2c', expected_size=expected_size, md5sum=md5,
+                    resume_requires='{}.aria2'.format(output_file))
+                cmd = "aria2c {} -x{} -o {} '{}://{}'".format(
+                    '--continue=true' if resume else '', num_threads, os.path.basename(url), ENA_FASTQ_FTP_SCHEME, url)
+            else:
+                resume = journal.prepare(url, 'curl', expected_size=expected_size, md5sum=md5)
+                cmd = "curl {} -L '{}' -o {}".format(
+                    '-C -' if resume else '', url, os.path.basename(url))
+            if cmd is not None:
                 try:
-                    subprocess.check_call(cmd, shell=True)
+                    tracing.check_call(cmd, shell=True, cwd=output_directory)
                 except subprocess.CalledProcessError as e:
                     logging.warning("Method ena-ftp failed, error was {}".format(e))
-                    self._clean_incomplete_files(downloaded+[output_file])
+                    self._keep_partial_files(journals)
                     return False
-                
                 if check_md5sums:
-                    if MD5.check_md5sum(output_file, md5):
-                        logging.info("MD5sum OK for {}".format(output_file))
-                    else:
-                        logging.error("MD5sum failed for {}".format(output_file))
-                        self._clean_incomplete_files(downloaded+[output_file])
-                        return False
-                downloaded.append(os.path.join(output_directory, output_file))
+                    # Check in the background while the next file downloads
+                    md5_checks.append((journal, MD5.check_md5sum_in_background(output_file, md5)))
+            downloaded.append(output_file)
+        if not self._md5_checks_passed(md5_checks, journals):
+            return False
+        self._complete(journals)
         return downloaded
 
+    def download_subsample(self, run_id, output_directory, subsample):
+        '''Download only the first subsample.max_reads spots of a run. The
+        files of a pair are streamed over HTTP together, decompressing them as
+        they arrive, and the connections closed once enough reads have been
+        read, so that the rest of each file is never downloaded. The reads
+        kept are written to files of the usual names in output_directory.
+        Returns the list of files written, or False if the download failed.'''
+        report = self.get_ftp_download_urls(run_id)
+        if report is False:
+            return False
+        urls = dict([(os.path.join(output_directory, os.path.basename(url)), url) for url in report.file_paths])
+
+        groups = paired_groups(list(urls.keys()))
+        logging.info("Downloading the first {} reads of {} ..".format(subsample.max_reads, ', '.join(urls.keys())))
+        responses = []
+        def open_groups():
+            # Later groups are only requested if earlier ones have too few
+            # reads, since max_reads is counted across the whole run
+            for group in groups:
+                group_responses = self._streaming_responses([urls[f] for f in group])
+                responses.extend(group_responses)
+                yield [gzip.GzipFile(fileobj=res.raw) for res in group_responses]
+        try:
+            with tracing.span('GET first reads of {}'.format(run_id), 'http', max_reads=subsample.max_reads) as args:
+                args['reads'] = subsample_fastq_streams(open_groups(), groups, subsample)
+        except (requests.RequestException, OSError, EOFError) as e:
+            # Reads are only renamed to their final names once all have
+            # been written, so nothing partial is left behind
+            logging.warning("Method ena-ftp failed, error was {}".format(e))
+            return False
+        finally:
+            for res in responses:
+                res.close()
+        return [f for group in groups for f in group if os.path.exists(f)]
+
+    def stream_interleaved(self, run_id, output_stream, output_format, subsample=None):
+        '''Stream the files of a run over HTTP, decompressing them and
+        writing the reads to output_stream as they arrive, with the reads of
+        each pair consecutive. Pairs are written before unpaired reads.
+        Returns the number of spots written, or False if the download could
+        not be started. Failures after reads have been written raise an
+        exception, since other download methods cannot then take over.'''
+        report = self.get_ftp_download_urls(run_id)
+        if report is False:
+            return False
+        urls = dict([(os.path.basename(url), url) for url in report.file_paths])
+
+        responses = []
+        def open_groups():
+            for group in paired_groups(list(urls.keys())):
+                logging.info("Streaming {} to stdout ..".format(', '.join(group)))
+                group_responses = self._streaming_responses([urls[f] for f in group])
+                responses.extend(group_responses)
+                yield [gzip.GzipFile(fileobj=res.raw) for res in group_responses]
+        try:
+            with tracing.span('GET {}'.format(', '.join(urls.keys())), 'http') as args:
+                args['reads'] = interleave_fastq_streams(open_groups(), output_stream, output_format, subsample)
+        except requests.RequestException as e:
+            if len(responses) > 0:
+                raise Exception("Failed to download {} after some of its reads were output: {}".format(run_id, e))
+            logging.warning("Method ena-ftp failed, error was {}".format(e))
+            return False
+        except (OSError, EOFError) as e:
+            raise Exception("Failed to download {} after some of its reads were output: {}".format(run_id, e))
+        finally:
+            for res in responses:
+                res.close()
+        return args['reads']
+
+    def _streaming_responses(self, urls):
+        '''Start streaming HTTP downloads of the files at urls, which are
+        FTP paths without a scheme as in file reports. Returns the responses,
+        which the caller must close.'''
+        responses = []
+        try:
+            for url in urls:
+                res = requests.get('{}://{}'.format(ENA_FASTQ_HTTP_SCHEME, url), stream=True, timeout=60)
+                responses.append(res)
+                res.raise_for_status()
+        except requests.RequestException:
+            for res in responses:
+                res.close()
+            raise
+        return responses
+
+    def _md5_checks_passed(self, md5_checks, journals):
+        '''Wait for md5sum checks to finish. Files which fail are removed,
+        others are kept as partial downloads. Returns True if all passed.'''
+        all_passed = True
+        for journal, md5_check in md5_checks:
+            if md5_check.result():
+                logging.info("MD5sum OK for {}".format(journal.output_path))
+            else:
+                logging.error("MD5sum failed for {}".format(journal.output_path))
+                journal.discard()
+                all_passed = False
+        if not all_passed:
+            self._keep_partial_files(journals)
+        return all_passed
+
+    def _keep_partial_files(self, journals):
+        # Files of a pair that downloaded OK are kept too, but remain marked as
+        # incomplete until all files of the run have been downloaded.
+        for journal in journals:
+            journal.keep_partial()
+
+    def _complete(self, journals):
+        for journal in journals:
+            journal.complete()
@@ -0,0 +1,223 @@
+import collections
+import gzip
+import logging
+import shlex
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_BLOCK_SIZE = 16 * 1024 * 1024
+# Same as the default of gzip and pigz
+COMPRESSION_LEVEL = 6
+
+# Splits a stream of FASTQ in which the reads of each spot are consecutive,
+# as output by fasterq-dump --split-spot, into a file per read number, as
+# fasterq-dump --split-3 does: spots with 2 or more reads are written to
+# stem_1, stem_2 etc, and spots with only 1 read to stem. Output is
+# converted to FASTA if fasta=1, and piped to pigz if compress=1. Records of
+# a spot are recognised by the first word of the defline, which contains
+# the spot ID. With interleave=1, the reads are instead all written to
+# stdout, those of each spot consecutively.
+#
+# Spots may be subsampled as described by kingfisher.subsample.Subsample:
+# keeping at most max_reads spots (0 for no limit), each with probability
+# fraction, or a reservoir sample of reservoir spots (0 for none), kept in
+# their original order.
+SPLIT_SPOTS_AWK_PROGRAM = r'''
+BEGIN { srand(seed) }
+function write_spot(count, records,    i, out, cmd) {
+    for (i = 1; i <= count; i++) {
+        out = (count == 1) ? (stem suffix) : (stem "_" i suffix)
+        if (compress) {
+            cmd = "pigz -p " threads (interleave ? "" : " >\"" out "\"")
+            print records[i] | cmd
+            cmds[cmd] = 1
+        } else if (interleave) {
+            print records[i]
+        } else {
+            print records[i] > out
+            files[out] = 1
+        }
+    }
+}
+function flush(    i, j, slot) {
+    if (n == 0) return
+    num_spots++
+    if (reservoir) {
+        if (num_filled < reservoir) {
+            slot = ++num_filled
+        } else {
+            j = int(rand() * num_spots) + 1
+            slot = (j <= reservoir) ? j : 0
+        }
+        if (slot) {
+            kept_count[slot] = n
+            kept_spot[slot] = num_spots
+            for (i = 1; i <= n; i++) kept[slot, i] = rec[i]
+        }
+    } else if (!(max_reads && num_kept >= max_reads) && (fraction >= 1 || rand() < fraction)) {
+        num_kept++
+        write_spot(n, rec)
+    }
+    n = 0
+}
+function write_reservoir(    gap, i, j, t, records) {
+    for (i = 1; i <= num_filled; i++) order[i] = i
+    # Shell sort the reservoir into the original order of the spots
+    for (gap = int(num_filled / 2); gap > 0; gap = int(gap / 2)) {
+        for (i = gap + 1; i <= num_filled; i++) {
+            t = order[i]
+            for (j = i; j > gap && kept_spot[order[j - gap]] > kept_spot[t]; j -= gap) order[j] = order[j - gap]
+            order[j] = t
+        }
+    }
+    for (i = 1; i <= num_filled; i++) {
+        for (j = 1; j <= kept_count[order[i]]; j++) records[j] = kept[order[i], j]
+        write_spot(kept_count[order[i]], records)
+    }
+}
+NR % 4 == 1 { if ($1 != spot) { flush(); spot = $1 }; header = $0; next }
+NR % 4 == 2 { sequence = $0; next }
+NR % 4 == 3 { plus = $0; next }
+{ n++; rec[n] = fasta ? (">" substr(header, 2) "\n" sequence) : (header "\n" sequence "\n" plus "\n" $0) }
+END {
+    if (NR % 4 != 0) { print "Truncated FASTQ input" > "/dev/stderr"; exit 1 }
+    flush()
+    if (reservoir) write_reservoir()
+    for (f in files) close(f)
+    for (c in cmds) if (close(c) != 0) { print "Command failed: " c > "/dev/stderr"; exit 1 }
+}
+'''
+
+
+def _record_boundary(block):
+    '''Return the offset just after the last complete 4-line FASTQ record in
+    block, or 0 if there is none.'''
+    num_lines = block.count(b'\n')
+    excess = num_lines % 4
+    if num_lines - excess == 0:
+        return 0
+    position = block.rfind(b'\n')
+    for _ in range(excess):
+        position = block.rfind(b'\n', 0, position)
+    return position + 1
+
+
+def fastq_blocks(stream, block_size=DEFAULT_BLOCK_SIZE):
+    '''Yield blocks of about block_size bytes read from a binary stream of
+    FASTQ, each made of whole 4-line records.'''
+    remainder = b''
+    while True:
+        data = stream.read(block_size)
+        if len(data) == 0:
+            break
+        block = remainder + data if len(remainder) > 0 else data
+        boundary = _record_boundary(block)
+        if boundary > 0:
+            yield block[:boundary]
+        remainder = block[boundary:]
+    if len(remainder) > 0:
+        if not remainder.endswith(b'\n'):
+            remainder += b'\n'
+        yield remainder
+
+
+def fastq_block_to_fasta(block, compress=False):
+    '''Convert a block of whole 4-line FASTQ records to FASTA, optionally as
+    a gzip member. The work is done by operations on the whole block, rather
+    than record by record, so that little time is spent in Python itself.'''
+    if len(block) == 0:
+        fasta = b''
+    else:
+        lines = block.split(b'\n')
+        # The block ends with a newline, so the last element is empty
+        num_records = (len(lines) - 1) // 4
+        if len(lines) % 4 != 1 or not block.startswith(b'@'):
+            raise Exception("Unexpected FASTQ format, perhaps the file is truncated, or sequences span multiple lines")
+        fasta_lines = [None] * (2 * num_records)
+        fasta_lines[0::2] = lines[0:-1:4]
+        fasta_lines[1::2] = lines[1:-1:4]
+        joined = b'\n'.join(fasta_lines)
+        # Sequence lines never start with '@', so each occurrence is a header
+        if joined.count(b'\n@') != num_records - 1:
+            raise Exception("Unexpected FASTQ format, expected each record to start with '@'")
+        fasta = b'>' + joined[1:].replace(b'\n@', b'\n>') + b'\n'
+    if compress:
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 31)
+        return compressor.compress(fasta) + compressor.flush()
+    return fasta
+
+
+def fastq_to_fasta(input_path, output_path, threads=1, block_size=DEFAULT_BLOCK_SIZE):
+    '''Convert a FASTQ file to FASTA, as the awk pipeline does. The input is
+    decompressed if its path ends in .gz, and the output compressed if its
+    path does. When threads > 1, blocks are converted (and compressed) in
+    that many threads, and written in order. Compressed output is made of
+    one gzip member per block, which gzip and pigz read as a single stream.
+
+    Threads are used rather than processes since zlib releases the GIL while
+    compressing, which takes most of the time, and the conversion itself is a
+    few operations on whole blocks, so there is little to gain from
+    processes but the cost of copying each block to and from them.'''
+    compress = output_path.endswith('.gz')
+    logging.debug("Converting {} to FASTA in {} with {} thread(s)".format(input_path, output_path, threads))
+    opener = gzip.open if input_path.endswith('.gz') else open
+    with opener(input_path, 'rb') as input_stream, open(output_path, 'wb') as output_stream:
+        blocks = fastq_blocks(input_stream, block_size)
+        num_blocks = 0
+        if threads <= 1:
+            for block in blocks:
+                output_stream.write(fastq_block_to_fasta(block, compress))
+                num_blocks += 1
+        else:
+            with ThreadPoolExecutor(threads) as pool:
+                # Limit the blocks in flight, and so the memory used
+                pending = collections.deque()
+                for block in blocks:
+                    pending.append(pool.submit(fastq_block_to_fasta, block, compress))
+                    num_blocks += 1
+                    if len(pending) >= 2 * threads:
+                        output_stream.write(pending.popleft().result())
+                while len(pending) > 0:
+                    output_stream.write(pending.popleft().result())
+        if num_blocks == 0 and compress:
+            # Write a valid, empty gzip file, as pigz does
+            output_stream.write(fastq_block_to_fasta(b'', True))
+
+
+def split_spots_command(output_stem, output_format, threads, subsample=None):
+    '''Return a shell command which reads FASTQ with the reads of each spot
+    consecutive on stdin, and writes output_stem_1.<output_format>,
+    output_stem_2.<output_format> and output_stem.<output_format> as
+    fasterq-dump --split-3 would, converting and compressing according to
+    output_format, without writing uncompressed FASTQ anywhere. If subsample
+    is given, only the spots it selects are written.'''
+    return _split_spots_awk_command(output_stem, output_format, threads, subsample, interleave=False)
+
+
+def interleave_spots_command(output_format, threads, subsample=None):
+    '''Return a shell command like split_spots_command, but which writes
+    the reads to stdout in the order they are read, so that the reads of
+    each spot are consecutive.'''
+    return _split_spots_awk_command('', output_format, threads, subsample, interleave=True)
+
+
+def _split_spots_awk_command(output_stem, output_format, threads, subsample, interleave):
+    if output_format not in ('fastq', 'fastq.gz', 'fasta', 'fasta.gz'):
+        raise Exception("Unexpected output format: {}".format(output_format))
+    variables = {
+        'stem': output_stem,
+        'suffix': '.' + output_format,
+        'fasta': 1 if output_format.startswith('fasta') else 0,
+        'compress': 1 if output_format.endswith('.gz') else 0,
+        'interleave': 1 if interleave else 0,
+        'threads': threads,
+        'max_reads': 0,
+        'fraction': 1,
+        'reservoir': 0,
+        'seed': 0,
+    }
+    if subsample is not None:
+        variables.update(subsample.awk_variables())
+    return "awk {} {}".format(
+        ' '.join(['-v {}={}'.format(k, shlex.quote(str(v))) for (k, v) in variables.items()]),
+        shlex.quote(SPLIT_SPOTS_AWK_PROGRAM))
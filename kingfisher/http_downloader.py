@@ -0,0 +1,212 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+
+from .exception import DownloadMethodFailed
+from .md5sum import FollowingMD5
+from . import tracing
+
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+NUM_CHUNK_ATTEMPTS = 3
+REQUEST_TIMEOUT_SECONDS = 60
+
+
+class RangedHttpDownloader:
+    '''Download a file over HTTP(S) within this process. The file is split into
+    byte ranges which are fetched concurrently over a pool of keep-alive
+    connections and written straight into place in a preallocated output
+    file.
+
+    Completed ranges are recorded in a progress file next to the output, so
+    that an interrupted download can be resumed by fetching only the ranges
+    which are missing.'''
+
+    PROGRESS_SUFFIX = '.kingfisher-chunks'
+
+    def __init__(self, num_connections, chunk_size=DEFAULT_CHUNK_SIZE, show_progress=True):
+        if num_connections < 1:
+            raise Exception("The number of connections must be at least 1")
+        self.num_connections = num_connections
+        self.chunk_size = chunk_size
+        self.show_progress = show_progress
+
+        self.session = requests.Session()
+        # Byte ranges refer to the file as stored, so ask for it unencoded.
+        self.session.headers['Accept-Encoding'] = 'identity'
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=num_connections)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @staticmethod
+    def progress_path(output_path):
+        return output_path + RangedHttpDownloader.PROGRESS_SUFFIX
+
+    def _probe(self, url):
+        '''Return the size of the file at url and whether the server accepts
+        range requests. The size is None if the server does not say.'''
+        try:
+            with tracing.span('HEAD', 'http', url=url):
+                res = self.session.head(url, allow_redirects=True, timeout=REQUEST_TIMEOUT_SECONDS)
+        except requests.RequestException as e:
+            raise DownloadMethodFailed("Failed to query {}: {}".format(url, e))
+        if not res.ok:
+            raise DownloadMethodFailed("Failed to query {}: HTTP status {}".format(url, res.status_code))
+        size = res.headers.get('Content-Length')
+        size = int(size) if size is not None else None
+        accepts_ranges = res.headers.get('Accept-Ranges', '').lower() == 'bytes'
+        return size, accepts_ranges
+
+    def download(self, url, output_path, resume=False, calculate_md5=False):
+        '''Download url to output_path, returning a tuple of the number of
+        bytes downloaded and, if calculate_md5 is True, the md5sum of the file
+        calculated as it was downloaded (otherwise None). Raises
+        DownloadMethodFailed if the download fails. When resume is True, ranges
+        recorded as complete by a previous attempt are not downloaded again.'''
+        size, accepts_ranges = self._probe(url)
+        start_time = time.time()
+
+        if size is None or not accepts_ranges or size == 0:
+            logging.info("Server does not support range requests for {}, downloading with a single connection ..".format(url))
+            md5sum = self._download_whole(url, output_path, size, calculate_md5)
+            total_bytes = os.path.getsize(output_path)
+        else:
+            md5sum = self._download_ranges(url, output_path, size, resume, calculate_md5)
+            total_bytes = size
+
+        elapsed = time.time() - start_time
+        logging.info("Downloaded {} bytes in {:.1f} seconds ({:.1f} MB/s)".format(
+            total_bytes, elapsed, total_bytes / 1e6 / elapsed if elapsed > 0 else 0))
+        return total_bytes, md5sum
+
+    def _download_whole(self, url, output_path, size, calculate_md5):
+        hash_md5 = hashlib.md5() if calculate_md5 else None
+        try:
+            with tracing.span('GET', 'http', url=url), \
+                    self.session.get(url, stream=True, timeout=REQUEST_TIMEOUT_SECONDS) as res:
+                if not res.ok:
+                    raise DownloadMethodFailed("Failed to download {}: HTTP status {}".format(url, res.status_code))
+                with open(output_path, 'wb') as f, self._progress_bar(size, 0) as progress:
+                    for data in res.iter_content(READ_SIZE):
+                        f.write(data)
+                        if hash_md5 is not None:
+                            hash_md5.update(data)
+                        progress.update(len(data))
+        except requests.RequestException as e:
+            raise DownloadMethodFailed("Failed to download {}: {}".format(url, e))
+        return hash_md5.hexdigest() if hash_md5 is not None else None
+
+    def _download_ranges(self, url, output_path, size, resume, calculate_md5):
+        ranges = [(start, min(start + self.chunk_size, size) - 1) for start in range(0, size, self.chunk_size)]
+
+        progress_path = RangedHttpDownloader.progress_path(output_path)
+        completed = set()
+        if resume and os.path.exists(progress_path):
+            with open(progress_path) as f:
+                for line in f:
+                    start, end = line.strip().split('-')
+                    completed.add((int(start), int(end)))
+            logging.info("Resuming download, {} of {} ranges are already complete".format(
+                len([r for r in ranges if r in completed]), len(ranges)))
+        else:
+            if os.path.exists(progress_path):
+                os.remove(progress_path)
+            if os.path.exists(output_path):
+                os.remove(output_path)
+        todo = [r for r in ranges if r not in completed]
+
+        # Opened for reading too, so that the md5sum can be calculated as the
+        # download proceeds.
+        fd = os.open(output_path, os.O_RDWR | os.O_CREAT)
+        progress_lock = threading.Lock()
+        md5_follower = None
+        try:
+            os.ftruncate(fd, size)
+            if hasattr(os, 'posix_fallocate'):
+                try:
+                    os.posix_fallocate(fd, 0, size)
+                except OSError:
+                    # Not supported by all filesystems, and not required.
+                    pass
+
+            if calculate_md5:
+                md5_follower = FollowingMD5(fd, ranges)
+                for (i, (start, end)) in enumerate(ranges):
+                    if (start, end) in completed:
+                        md5_follower.update(i, end + 1)
+
+            logging.info("Downloading {} bytes in {} ranges using {} connections ..".format(
+                size, len(todo), self.num_connections))
+            with open(progress_path, 'a') as progress_file, \
+                    self._progress_bar(size, size - sum([e - s + 1 for (s, e) in todo])) as progress:
+                def fetch(range_index):
+                    byte_range = ranges[range_index]
+                    def on_write(offset):
+                        if md5_follower is not None:
+                            md5_follower.update(range_index, offset)
+                    self._fetch_range(url, fd, byte_range, progress, progress_lock, on_write)
+                    with progress_lock:
+                        progress_file.write('{}-{}\n'.format(*byte_range))
+                        progress_file.flush()
+
+                with ThreadPoolExecutor(max_workers=self.num_connections) as executor:
+                    # Iterate over results so that any exception is raised here
+                    for _ in executor.map(fetch, [i for (i, r) in enumerate(ranges) if r not in completed]):
+                        pass
+            md5sum = md5_follower.hexdigest() if md5_follower is not None else None
+            md5_follower = None
+        finally:
+            if md5_follower is not None:
+                # Download failed, stop hashing before the file is closed
+                md5_follower.hexdigest()
+            os.close(fd)
+
+        os.remove(progress_path)
+        return md5sum
+
+    def _fetch_range(self, url, fd, byte_range, progress, progress_lock, on_write):
+        start, end = byte_range
+        offset = start
+        chunk_start_time = time.time()
+        for attempt in range(NUM_CHUNK_ATTEMPTS):
+            try:
+                headers = {'Range': 'bytes={}-{}'.format(offset, end)}
+                with tracing.span('GET range', 'http', url=url, range=headers['Range']), \
+                        self.session.get(url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT_SECONDS) as res:
+                    if res.status_code != 206:
+                        raise DownloadMethodFailed("Unexpected HTTP status {} when requesting range {}-{} of {}".format(
+                            res.status_code, offset, end, url))
+                    for data in res.iter_content(READ_SIZE):
+                        if offset + len(data) > end + 1:
+                            raise DownloadMethodFailed("Server returned more data than requested for range {}-{} of {}".format(
+                                start, end, url))
+                        os.pwrite(fd, data, offset)
+                        offset += len(data)
+                        on_write(offset)
+                        with progress_lock:
+                            progress.update(len(data))
+                if offset != end + 1:
+                    raise DownloadMethodFailed("Connection closed early when downloading range {}-{} of {}".format(
+                        start, end, url))
+                break
+            except (requests.RequestException, DownloadMethodFailed) as e:
+                if attempt == NUM_CHUNK_ATTEMPTS - 1:
+                    raise DownloadMethodFailed("Failed to download range {}-{} of {} after {} attempts: {}".format(
+                        start, end, url, NUM_CHUNK_ATTEMPTS, e))
+                logging.warning("Retrying download of range {}-{} from byte {} after error: {}".format(
+                    start, end, offset, e))
+
+        elapsed = time.time() - chunk_start_time
+        logging.debug("Downloaded range {}-{} ({} bytes) in {:.2f} seconds ({:.1f} MB/s)".format(
+            start, end, end - start + 1, elapsed, (end - start + 1) / 1e6 / elapsed if elapsed > 0 else 0))
+
+    def _progress_bar(self, total, initial):
+        return tqdm(total=total, initial=initial, unit='B', unit_scale=True, unit_divisor=1024,
+            disable=not self.show_progress)
@@ -1,27 +1,159 @@
 import logging
 import json
+import os
 import re
-
-import extern
+import tempfile
+import time
+import datetime
 
 from .exception import DownloadMethodFailed
+from . import tracing
+
+NCBI_LOCATION_API_URL = 'https://locate.ncbi.nlm.nih.gov/sdl/2/retrieve'
+# Number of accessions to resolve in each batch request
+LOCATION_BATCH_SIZE = 100
+# Treat signed links as expired this many seconds before they actually do, so
+# that there is time to download them.
+SIGNED_LINK_EXPIRY_MARGIN_SECONDS = 3600
 
 
 class Location:
     @staticmethod
-    def get_ncbi_locations(run_id):
-        json_location_string = 'https://locate.ncbi.nlm.nih.gov/sdl/2/retrieve?&acc={}&accept-alternate-locations=yes'.format(
-            run_id)
-        json_response = extern.run('curl -q \'{}\''.format(json_location_string))
+    def get_ncbi_locations(run_id, cache=None):
+        if cache is not None:
+            j = cache.get(run_id)
+            if j is not None:
+                logging.debug("Using cached location JSON for {}".format(run_id))
+                return NcbiLocationJson(j)
+
+        json_location_string = '{}?&acc={}&accept-alternate-locations=yes'.format(
+            NCBI_LOCATION_API_URL, run_id)
+        json_response = tracing.run('curl -q \'{}\''.format(json_location_string))
         logging.debug("Got location JSON: {}".format(json_response))
 
         j = json.loads(json_response)
         if 'version' not in j or j['version'] != '2':
             raise Exception(
                 "Unexpected json location string returned: {}", json_location_string)
+        if cache is not None:
+            cache.put(run_id, j)
         # TODO: Assumes there is only 1 result, which is all I've ever seen
         return NcbiLocationJson(j)
 
+    @staticmethod
+    def prefetch_ncbi_locations(run_ids, cache):
+        '''Resolve the locations of many runs with a few batch requests,
+        storing them in the cache so that later calls to get_ncbi_locations do
+        not need a request each. Runs already in the cache are not looked up
+        again. Failures are not fatal, since each run is looked up on its own
+        later if it is not in the cache.'''
+        to_fetch = [r for r in run_ids if cache.get(r) is None]
+        if len(to_fetch) == 0:
+            return
+        logging.info("Resolving NCBI locations of {} run(s) in batches of {} ..".format(
+            len(to_fetch), LOCATION_BATCH_SIZE))
+        for i in range(0, len(to_fetch), LOCATION_BATCH_SIZE):
+            batch = to_fetch[i:i+LOCATION_BATCH_SIZE]
+            try:
+                res = tracing.http_request('POST',
+                    NCBI_LOCATION_API_URL,
+                    data=[('acc', acc) for acc in batch] + [('accept-alternate-locations', 'yes')])
+                if not res.ok:
+                    raise Exception("HTTP status {}: {}".format(res.status_code, res.text))
+                j = res.json()
+                if 'version' not in j or j['version'] != '2':
+                    raise Exception("Unexpected json returned: {}".format(j))
+            except Exception as e:
+                logging.warning("Failed to resolve a batch of NCBI locations, will resolve them individually: {}".format(e))
+                continue
+            for result in j['result']:
+                if 'bundle' in result:
+                    cache.put(result['bundle'], {'version': j['version'], 'result': [result]})
+
+
+class LocationCache:
+    '''On-disk cache of NCBI location API responses, keyed by accession. A
+    cached response is used until it is older than the TTL, or until any
+    signed link within it is about to expire.'''
+    def __init__(self, directory, ttl_hours):
+        self.directory = directory
+        self.ttl_seconds = ttl_hours * 3600
+        # Set once the cache cannot be written to e.g. because HOME is
+        # read-only, after which locations are not cached.
+        self.unwritable = False
+
+    @staticmethod
+    def default_directory():
+        cache_home = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+        return os.path.join(cache_home, 'kingfisher', 'ncbi_locations')
+
+    def _path(self, run_id):
+        # Split into subdirectories so no single directory gets too large
+        return os.path.join(self.directory, run_id[:6], '{}.json'.format(run_id))
+
+    def get(self, run_id):
+        '''Return the cached location JSON for run_id, or None if it is not
+        cached or has expired.'''
+        path = self._path(run_id)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        now = time.time()
+        if now - entry['fetched'] > self.ttl_seconds:
+            logging.debug("Cached location JSON for {} has expired".format(run_id))
+            return None
+        expiry = LocationCache._earliest_link_expiry(entry['response'])
+        if expiry is not None and expiry - now < SIGNED_LINK_EXPIRY_MARGIN_SECONDS:
+            logging.debug("Cached location JSON for {} contains a signed link that is about to expire".format(run_id))
+            return None
+        return entry['response']
+
+    def put(self, run_id, j):
+        # Only cache responses that contain files, since others may be due to
+        # transient errors.
+        if not all(['files' in result for result in j.get('result', [])]):
+            return
+        if self.unwritable:
+            return
+        path = self._path(run_id)
+        temp_path = None
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temporary file and then rename, so that concurrent
+            # readers never see a partially written file.
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'fetched': time.time(), 'response': j}, f)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logging.warning("Unable to write to the NCBI location cache in {}, continuing without it: {}".format(
+                self.directory, e))
+            self.unwritable = True
+            if temp_path is not None and os.path.exists(temp_path):
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+
+    @staticmethod
+    def _earliest_link_expiry(j):
+        earliest = None
+        for result in j.get('result', []):
+            for obj in result.get('files', []):
+                for loc in obj.get('locations', []):
+                    if 'expirationDate' in loc:
+                        try:
+                            expiry = datetime.datetime.fromisoformat(
+                                loc['expirationDate'].replace('Z', '+00:00')).timestamp()
+                        except ValueError:
+                            logging.debug("Unable to parse expirationDate {}".format(loc['expirationDate']))
+                            continue
+                        if earliest is None or expiry < earliest:
+                            earliest = expiry
+        return earliest
+
 
 class AwsLocation:
     def __init__(self, object_json, location_json):
@@ -63,6 +195,13 @@ class AwsLocation:
                 # }
                 # => That link is currently not available
             
+        elif self.is_noqual() and self.service() in ('s3-odp', 's3-sars-cov2'):
+            # SRA-lite objects are not at the same path as the full object, so
+            # work out the path from the link.
+            m = re.match(r'https://(.*?)\.s3\.amazonaws\.com/(.*)', self.j['link'])
+            if m is None:
+                raise DownloadMethodFailed("Unexpected S3 link for SRA-lite object: {}".format(self.j))
+            return 'aws s3 cp --no-sign-request s3://{}/{}'.format(m[1], m[2])
         elif self.service() == 's3-odp':
             # Use --no-sign-request to avoid the AWS CLI signing into an
             # account, avoiding potential usage charges. There is a possibility
@@ -77,9 +216,15 @@ class AwsLocation:
     def link(self):
         return self.j['link']
 
+    def is_noqual(self):
+        return self.object_json['name'].endswith('.noqual')
+
     def md5sum(self):
         return self.object_json['md5']
 
+    def size(self):
+        return self.object_json.get('size')
+
 
 class GcpLocation:
     def __init__(self, object_json, location_json):
@@ -156,4 +301,12 @@ class NcbiLocationJson:
                         logging.debug("Location has the wrong service")
                 else:
                     logging.debug("Discarding location as unsuitable: {}".format(loc))
-        return passable_objects_and_locations
\ No newline at end of file
+        return passable_objects_and_locations
+
+    def object_locations_of_types(self, object_types, service, allow_paid):
+        '''Like object_locations, but for several object types, returning the
+        locations of each type in the order the types are given.'''
+        locations = []
+        for object_type in object_types:
+            locations.extend(self.object_locations(object_type, service, allow_paid))
+        return locations
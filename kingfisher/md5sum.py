@@ -1,18 +1,111 @@
 import logging
 import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Read in large blocks that are a multiple of the page size. hashlib releases
+# the GIL when hashing blocks this large, so checks in background threads run
+# in parallel with other work.
+READ_SIZE = 4 * 1024 * 1024
 
 class MD5:
     @staticmethod
-    def check_md5sum(file_path, expected_md5sum):
-        logging.debug("Checking md5sum for {} ..".format(file_path))
-        
+    def md5sum(file_path):
         hash_md5 = hashlib.md5()
-        with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
+        buffer = bytearray(READ_SIZE)
+        view = memoryview(buffer)
+        with open(file_path, "rb", buffering=0) as f:
+            while True:
+                num_read = f.readinto(buffer)
+                if num_read == 0:
+                    break
+                hash_md5.update(view[:num_read])
         return hash_md5.hexdigest()
 
-        if hash_md5 == expected_md5sum:
+    @staticmethod
+    def check_md5sum(file_path, expected_md5sum):
+        logging.debug("Checking md5sum for {} ..".format(file_path))
+        observed = MD5.md5sum(file_path)
+        if observed == expected_md5sum:
             return True
         else:
-            return False
\ No newline at end of file
+            logging.debug("Expected md5sum {} for {}, found {}".format(expected_md5sum, file_path, observed))
+            return False
+
+    @staticmethod
+    def check_md5sum_in_background(file_path, expected_md5sum):
+        '''Start checking the md5sum of a file in a background thread, returning
+        a concurrent.futures.Future whose result() is True if the md5sum
+        matches, False otherwise.'''
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='kingfisher-md5')
+        future = executor.submit(MD5.check_md5sum, file_path, expected_md5sum)
+        executor.shutdown(wait=False)
+        return future
+
+
+class FollowingMD5:
+    '''Calculate the md5sum of a file while it is being downloaded into
+    byte ranges which complete out of order. Since the ranges arrive out of
+    order, the bytes cannot be hashed as they are received. Instead a
+    background thread reads the file back with pread up to the end of the
+    contiguous prefix written so far, shortly after it is written and so
+    usually from the page cache, rather than in a second pass over the file
+    once the download has finished.
+
+    Ranges are given as a list of (start, end) tuples, where end is
+    inclusive, which together cover the whole file in order.'''
+
+    def __init__(self, fd, ranges):
+        self.fd = fd
+        self.ranges = ranges
+        self.range_offsets = [start for (start, _) in ranges]
+        self.hashed_upto = 0
+        self.current_range = 0
+        self.hash_md5 = hashlib.md5()
+        self.condition = threading.Condition()
+        self.finished = False
+        self.thread = threading.Thread(target=self._follow, daemon=True, name='kingfisher-md5-follower')
+        self.thread.start()
+
+    def update(self, range_index, offset):
+        '''Record that the range with index range_index has been written up to
+        (but not including) byte offset.'''
+        with self.condition:
+            self.range_offsets[range_index] = offset
+            self.condition.notify()
+
+    def _watermark(self):
+        # Called with the condition held
+        while self.current_range < len(self.ranges) and \
+                self.range_offsets[self.current_range] == self.ranges[self.current_range][1] + 1:
+            self.current_range += 1
+        if self.current_range == len(self.ranges):
+            return self.ranges[-1][1] + 1 if len(self.ranges) > 0 else 0
+        return self.range_offsets[self.current_range]
+
+    def _follow(self):
+        while True:
+            with self.condition:
+                while self._watermark() == self.hashed_upto and not self.finished:
+                    self.condition.wait()
+                watermark = self._watermark()
+                if watermark == self.hashed_upto and self.finished:
+                    return
+            while self.hashed_upto < watermark:
+                data = os.pread(self.fd, min(READ_SIZE, watermark - self.hashed_upto), self.hashed_upto)
+                if len(data) == 0:
+                    raise Exception("Programming error: unexpectedly reached the end of the file when hashing it")
+                self.hash_md5.update(data)
+                self.hashed_upto += len(data)
+
+    def hexdigest(self):
+        '''Wait for hashing to finish and return the md5sum. Must be called
+        before the file descriptor is closed. If called before all ranges have
+        been written, hashing stops at the end of the contiguous prefix
+        written so far.'''
+        with self.condition:
+            self.finished = True
+            self.condition.notify()
+        self.thread.join()
+        return self.hash_md5.hexdigest()
@@ -0,0 +1,153 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+PHASE_RESOLVE = 'resolve'
+PHASE_DOWNLOAD = 'download'
+PHASE_VERIFY = 'verify'
+PHASE_CONVERT = 'convert'
+PHASE_COMPRESS = 'compress'
+PHASES = [PHASE_RESOLVE, PHASE_DOWNLOAD, PHASE_VERIFY, PHASE_CONVERT, PHASE_COMPRESS]
+
+STATUS_OK = 'ok'
+STATUS_FAILED = 'failed'
+
+
+class PhaseRecord:
+    '''The outcome of one phase of one run, filled in as the phase
+    proceeds.'''
+    def __init__(self, run_identifier, phase, method):
+        self.run_identifier = run_identifier
+        self.phase = phase
+        self.method = method
+        self.num_bytes = None
+        self.status = STATUS_OK
+        self.exit_status = None
+        self.error = None
+        self.start_time = time.time()
+        self.seconds = None
+
+    def add_file_sizes(self, paths):
+        '''Add the sizes of the given files, where they exist, to the bytes
+        processed by this phase.'''
+        sizes = [os.path.getsize(p) for p in paths if os.path.exists(p)]
+        self.num_bytes = (self.num_bytes or 0) + sum(sizes)
+
+    def fail(self, error=None, exit_status=None):
+        self.status = STATUS_FAILED
+        self.error = error
+        self.exit_status = exit_status
+
+    def to_dict(self):
+        return {
+            'run': self.run_identifier,
+            'phase': self.phase,
+            'method': self.method,
+            'status': self.status,
+            'exit_status': self.exit_status,
+            'error': self.error,
+            'bytes': self.num_bytes,
+            'start_time': self.start_time,
+            'wall_seconds': self.seconds,
+            'throughput_mb_per_second': self.num_bytes / 1e6 / self.seconds
+                if self.num_bytes is not None and self.seconds else None,
+        }
+
+
+class MetricsRecorder:
+    '''Record the wall time, bytes processed and outcome of each phase of each
+    run. Records are appended as JSON lines to metrics_file, and totals per
+    phase, method and status are written in the Prometheus text format to
+    prometheus_file, which can be collected by the textfile collector of the
+    node exporter. Either may be None, in which case nothing is written
+    there.
+
+    Safe to use from several threads.'''
+
+    def __init__(self, metrics_file=None, prometheus_file=None):
+        self.metrics_file = metrics_file
+        self.prometheus_file = prometheus_file
+        self.lock = threading.Lock()
+        self.metrics_stream = open(metrics_file, 'a') if metrics_file is not None else None
+        # (phase, method, status) => [count, seconds, bytes]
+        self.totals = {}
+        # (phase, method) => bytes per second of the last successful phase
+        self.last_throughputs = {}
+
+    @contextmanager
+    def phase(self, run_identifier, phase, method=None):
+        '''Context manager timing a phase, yielding a PhaseRecord. The phase
+        is recorded as failed if an exception is raised within it, or if
+        fail() is called on the record.'''
+        record = PhaseRecord(run_identifier, phase, method)
+        try:
+            yield record
+        except Exception as e:
+            record.fail(str(e).strip(), getattr(e, 'returncode', None))
+            raise
+        finally:
+            if record.status == STATUS_OK and record.exit_status is None:
+                record.exit_status = 0
+            self.record(record)
+
+    def record(self, record):
+        if record.seconds is None:
+            record.seconds = time.time() - record.start_time
+        if self.metrics_stream is None and self.prometheus_file is None:
+            return
+        with self.lock:
+            if self.metrics_stream is not None:
+                self.metrics_stream.write(json.dumps(record.to_dict()) + '\n')
+                self.metrics_stream.flush()
+            if self.prometheus_file is not None:
+                key = (record.phase, record.method or '', record.status)
+                totals = self.totals.setdefault(key, [0, 0.0, 0])
+                totals[0] += 1
+                totals[1] += record.seconds
+                totals[2] += record.num_bytes or 0
+                if record.status == STATUS_OK and record.num_bytes is not None and record.seconds > 0:
+                    self.last_throughputs[(record.phase, record.method or '')] = record.num_bytes / record.seconds
+                self._write_prometheus_file()
+
+    def _write_prometheus_file(self):
+        # Called with the lock held
+        def labels(phase, method, status=None):
+            l = 'phase="{}",method="{}"'.format(phase, method)
+            if status is not None:
+                l += ',status="{}"'.format(status)
+            return '{' + l + '}'
+
+        lines = []
+        for (name, index, description) in [
+                ('kingfisher_phase_runs_total', 0, 'Number of runs which have finished each phase.'),
+                ('kingfisher_phase_seconds_total', 1, 'Wall time spent in each phase.'),
+                ('kingfisher_phase_bytes_total', 2, 'Bytes processed in each phase.')]:
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} counter'.format(name))
+            for (key, totals) in sorted(self.totals.items()):
+                lines.append('{}{} {}'.format(name, labels(*key), totals[index]))
+        name = 'kingfisher_phase_last_throughput_bytes_per_second'
+        lines.append('# HELP {} Throughput of the most recent successful run of each phase.'.format(name))
+        lines.append('# TYPE {} gauge'.format(name))
+        for (key, throughput) in sorted(self.last_throughputs.items()):
+            lines.append('{}{} {}'.format(name, labels(*key), throughput))
+        lines.append('# HELP kingfisher_last_update_timestamp_seconds Time these metrics were last updated.')
+        lines.append('# TYPE kingfisher_last_update_timestamp_seconds gauge')
+        lines.append('kingfisher_last_update_timestamp_seconds {}'.format(time.time()))
+
+        # Write atomically, so the node exporter never reads a partial file.
+        directory = os.path.dirname(os.path.abspath(self.prometheus_file))
+        with tempfile.NamedTemporaryFile('w', dir=directory, prefix='.kingfisher-metrics', delete=False) as f:
+            f.write('\n'.join(lines) + '\n')
+        os.chmod(f.name, 0o644)
+        os.replace(f.name, self.prometheus_file)
+
+    def close(self):
+        if self.metrics_stream is not None:
+            self.metrics_stream.close()
+            self.metrics_stream = None
+        logging.debug("Finished recording metrics")
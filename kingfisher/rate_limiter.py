@@ -0,0 +1,37 @@
+import threading
+import time
+
+
+class TokenBucket:
+    '''Limits the rate of events, such as requests to a web service, shared
+    between threads. Tokens accrue at rate per second, up to capacity, and
+    each call to acquire takes one, waiting until it is available.'''
+
+    def __init__(self, rate, capacity=1, clock=time.monotonic, sleep=time.sleep):
+        if rate <= 0:
+            raise Exception("The rate of a token bucket must be positive")
+        if capacity < 1:
+            raise Exception("The capacity of a token bucket must be at least 1")
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = capacity
+        self._last = clock()
+
+    def acquire(self):
+        '''Take a token, waiting until one is available. Returns the number of
+        seconds waited.'''
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # Reserve the token now, even if it has not accrued yet, so that
+            # waiting threads are served in the order they arrived without
+            # holding the lock while they sleep.
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            self._sleep(wait)
+        return wait
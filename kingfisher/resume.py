@@ -0,0 +1,96 @@
+import json
+import logging
+import os
+
+
+class DownloadJournal:
+    '''A sidecar file next to a download recording where it came from, so that
+    a partial download can be resumed on a retry or later invocation, rather
+    than started again from byte zero. While the journal exists, the file it
+    describes is considered incomplete.'''
+
+    SUFFIX = '.kingfisher-journal'
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.journal_path = output_path + DownloadJournal.SUFFIX
+
+    @staticmethod
+    def is_incomplete(output_path):
+        return os.path.exists(output_path + DownloadJournal.SUFFIX)
+
+    def read(self):
+        if not os.path.exists(self.journal_path):
+            return None
+        try:
+            with open(self.journal_path) as f:
+                return json.load(f)
+        except ValueError:
+            logging.warning("Ignoring unreadable download journal {}".format(self.journal_path))
+            return None
+
+    def prepare(self, url, downloader, expected_size=None, md5sum=None, resume_requires=None):
+        '''Record that a download of url into output_path is about to start.
+        Returns True if a partial download from the same source with the same
+        downloader already exists and so can be resumed. Otherwise any
+        existing file is removed so the download starts afresh, and False is
+        returned.
+
+        resume_requires is an optional path to a file the downloader needs in
+        order to resume e.g. the control file of aria2c, which preallocates
+        the whole output file and so cannot resume from its length alone.'''
+        previous = self.read()
+        resumable = False
+        if os.path.exists(self.output_path):
+            current_size = os.path.getsize(self.output_path)
+            if previous is None:
+                logging.info("Removing file {} as it is not known where it was downloaded from".format(
+                    self.output_path))
+            elif previous['url'] != url or previous['downloader'] != downloader:
+                logging.info("Removing partial download {} as it came from {} using {}, not {} using {}".format(
+                    self.output_path, previous['url'], previous['downloader'], url, downloader))
+            elif md5sum is not None and previous['md5sum'] is not None and md5sum != previous['md5sum']:
+                logging.info("Removing partial download {} as the file to be downloaded has changed".format(
+                    self.output_path))
+            elif expected_size is not None and current_size > expected_size:
+                logging.info("Removing partial download {} as it is larger than the expected {} bytes".format(
+                    self.output_path, expected_size))
+            elif resume_requires is not None and not os.path.exists(resume_requires):
+                logging.info("Removing partial download {} as {} is needed to resume it, but does not exist".format(
+                    self.output_path, resume_requires))
+            else:
+                resumable = True
+            if resumable:
+                logging.info("Resuming download of {} from {} bytes ..".format(self.output_path, current_size))
+            else:
+                os.remove(self.output_path)
+        if not resumable and resume_requires is not None and os.path.exists(resume_requires):
+            os.remove(resume_requires)
+
+        with open(self.journal_path, 'w') as f:
+            json.dump({
+                'url': url,
+                'downloader': downloader,
+                'expected_size': expected_size,
+                'md5sum': md5sum,
+            }, f)
+        return resumable
+
+    def keep_partial(self):
+        '''Called when a download fails, leaving the partial file and this
+        journal in place for a later resume.'''
+        if os.path.exists(self.output_path):
+            logging.info("Keeping partial download {} so that it can be resumed".format(self.output_path))
+
+    def discard(self):
+        '''Remove the partial download and this journal, e.g. because the
+        downloaded data is known to be bad.'''
+        for path in (self.output_path, self.journal_path):
+            if os.path.exists(path):
+                logging.info("Removing file {} ..".format(path))
+                os.remove(path)
+
+    def complete(self):
+        '''Mark the download as complete by removing the journal.'''
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
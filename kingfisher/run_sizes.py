@@ -0,0 +1,114 @@
+import logging
+import re
+
+import pandas as pd
+
+from .sra_metadata import SraMetadata, RUN_ACCESSION_KEY, BASES_KEY
+
+SPOTS_KEY = 'spots'
+RUN_SIZE_KEY = 'run_size'
+
+# Bytes of FASTQ output per spot other than the sequence and quality strings
+# i.e. the header and '+' lines and newlines, assuming paired reads.
+FASTQ_OVERHEAD_BYTES_PER_SPOT = 100
+# Bytes of FASTA output per spot other than the sequence i.e. the header
+# lines and newlines, assuming paired reads.
+FASTA_OVERHEAD_BYTES_PER_SPOT = 50
+# fasterq-dump writes temporary files to the output directory which are
+# about as large as the FASTQ it outputs, whether it writes that FASTQ to
+# files or streams it to be converted.
+FASTERQ_DUMP_TEMPORARY_FACTOR = 1.0
+# Size of gzipped reads relative to the uncompressed reads, which is
+# typically between a quarter and a third.
+GZIP_COMPRESSION_RATIO = 0.3
+
+SIZE_UNITS = {
+    '': 1,
+    'K': 1024,
+    'M': 1024**2,
+    'G': 1024**3,
+    'T': 1024**4,
+}
+
+
+def parse_size(size_string):
+    '''Parse a human readable size such as "500G" into a number of bytes.
+    Units are powers of 1024.'''
+    matches = re.match(r'^\s*([0-9]*\.?[0-9]+)\s*([KMGT]?)i?B?\s*$', size_string, re.IGNORECASE)
+    if matches is None:
+        raise Exception("Unable to parse size '{}', expected e.g. 500G".format(size_string))
+    return int(float(matches.group(1)) * SIZE_UNITS[matches.group(2).upper()])
+
+
+class RunSize:
+    '''The size of a run according to its SRA metadata. Any of run_size (the
+    size of the .sra file in bytes), bases and spots may be None if
+    unknown.'''
+    def __init__(self, run_identifier, run_size, bases, spots):
+        self.run_identifier = run_identifier
+        self.run_size = run_size
+        self.bases = bases
+        self.spots = spots
+
+    def scratch_bytes(self, output_format_possibilities):
+        '''Estimate the most scratch space needed at any one time to download
+        and extract the run, or None if it is unknown. The .sra file is
+        assumed to be extracted by fasterq-dump to the format extract()
+        would choose, unless the .sra file itself is an acceptable output.
+        Only plain FASTQ is written uncompressed by fasterq-dump; other
+        formats are streamed from it into conversion and compression, so
+        only the final output takes space alongside its temporary files.'''
+        if self.run_size is None:
+            return None
+        if 'sra' in output_format_possibilities:
+            return self.run_size
+        if self.bases is None or self.spots is None:
+            return None
+        fastq_bytes = 2 * self.bases + FASTQ_OVERHEAD_BYTES_PER_SPOT * self.spots
+        fasta_bytes = self.bases + FASTA_OVERHEAD_BYTES_PER_SPOT * self.spots
+        # In the order of preference of extract()
+        if 'fastq' in output_format_possibilities:
+            output_bytes = fastq_bytes
+        elif 'fasta' in output_format_possibilities:
+            output_bytes = fasta_bytes
+        elif 'fasta.gz' in output_format_possibilities:
+            output_bytes = fasta_bytes * GZIP_COMPRESSION_RATIO
+        else:
+            output_bytes = fastq_bytes * GZIP_COMPRESSION_RATIO
+        return int(self.run_size + fastq_bytes * FASTERQ_DUMP_TEMPORARY_FACTOR + output_bytes)
+
+
+def fetch_run_sizes(run_identifiers):
+    '''Return a dict of run identifier to RunSize, from the SRA metadata of
+    the runs. Runs without metadata are omitted.'''
+    logging.info("Fetching the sizes of {} run(s) from NCBI ..".format(len(run_identifiers)))
+    metadata = SraMetadata().efetch_sra_from_accessions(
+        run_identifiers, columns=[RUN_SIZE_KEY, BASES_KEY, SPOTS_KEY])
+    sizes = {}
+    if metadata is None or len(metadata) == 0:
+        logging.warning("Unable to find the sizes of any runs")
+        return sizes
+
+    def value(row, key):
+        if key not in row or pd.isna(row[key]):
+            return None
+        return int(row[key])
+
+    for _, row in metadata.iterrows():
+        sizes[row[RUN_ACCESSION_KEY]] = RunSize(
+            row[RUN_ACCESSION_KEY], value(row, RUN_SIZE_KEY), value(row, BASES_KEY), value(row, SPOTS_KEY))
+    num_missing = len([r for r in run_identifiers if r not in sizes])
+    if num_missing > 0:
+        logging.warning("Unable to find the sizes of {} run(s)".format(num_missing))
+    return sizes
+
+
+def order_largest_first(run_identifiers, run_sizes, output_format_possibilities):
+    '''Sort runs by decreasing expected scratch space, which approximates
+    decreasing download and extraction time. Runs of unknown size go last,
+    in their original order.'''
+    def key(run_identifier):
+        run_size = run_sizes.get(run_identifier)
+        scratch = run_size.scratch_bytes(output_format_possibilities) if run_size is not None else None
+        return (0, -scratch) if scratch is not None else (1, 0)
+    return sorted(run_identifiers, key=key)
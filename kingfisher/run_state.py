@@ -0,0 +1,98 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+
+class RunState:
+    '''The recorded state of a single run.'''
+    def __init__(self, row):
+        (self.run_identifier, self.phase, self.method, self.downloaded_files, self.downloaded_bytes,
+            self.md5sums, self.output_files, self.download_seconds, self.extraction_seconds,
+            self.updated) = row
+        self.downloaded_files = json.loads(self.downloaded_files) if self.downloaded_files is not None else None
+        self.md5sums = json.loads(self.md5sums) if self.md5sums is not None else None
+        self.output_files = json.loads(self.output_files) if self.output_files is not None else None
+
+
+class RunStateDatabase:
+    '''An SQLite database in the output directory recording how far each run
+    has got, so that a restarted batch job can skip runs which are already
+    finished without looking for each of their possible output files, and can
+    extract runs which were downloaded but not extracted without downloading
+    them again.
+
+    A single connection is shared between threads, with access serialised by
+    a lock. Each update is committed straight away.'''
+
+    FILENAME = '.kingfisher-state.sqlite3'
+
+    PHASE_RESOLVED = 'resolved'
+    PHASE_DOWNLOADED = 'downloaded'
+    PHASE_VERIFIED = 'verified'
+    PHASE_EXTRACTED = 'extracted'
+
+    COLUMNS = ['run_identifier', 'phase', 'method', 'downloaded_files', 'downloaded_bytes',
+        'md5sums', 'output_files', 'download_seconds', 'extraction_seconds', 'updated']
+    JSON_COLUMNS = ['downloaded_files', 'md5sums', 'output_files']
+
+    def __init__(self, output_directory):
+        self.path = os.path.join(output_directory, RunStateDatabase.FILENAME)
+        logging.debug("Using run state database {}".format(self.path))
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self.lock:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS runs ('
+                'run_identifier TEXT PRIMARY KEY, '
+                'phase TEXT NOT NULL, '
+                'method TEXT, '
+                'downloaded_files TEXT, '
+                'downloaded_bytes INTEGER, '
+                'md5sums TEXT, '
+                'output_files TEXT, '
+                'download_seconds REAL, '
+                'extraction_seconds REAL, '
+                'updated REAL NOT NULL)')
+            self.connection.commit()
+
+    def get(self, run_identifier):
+        '''Return the RunState of a run, or None if nothing is recorded.'''
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT {} FROM runs WHERE run_identifier = ?'.format(', '.join(RunStateDatabase.COLUMNS)),
+                (run_identifier,)).fetchone()
+        return RunState(row) if row is not None else None
+
+    def record(self, run_identifier, phase, **kwargs):
+        '''Record that a run has reached phase. Other columns may be given as
+        keyword arguments, and are left unchanged if not given.'''
+        for column in kwargs:
+            if column not in RunStateDatabase.COLUMNS or column in ('run_identifier', 'phase', 'updated'):
+                raise Exception("Unexpected run state column: {}".format(column))
+        values = dict([(column, json.dumps(value) if column in RunStateDatabase.JSON_COLUMNS else value)
+            for (column, value) in kwargs.items()])
+        values['phase'] = phase
+        values['updated'] = time.time()
+        columns = sorted(values.keys())
+
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR IGNORE INTO runs (run_identifier, phase, updated) VALUES (?, ?, ?)',
+                (run_identifier, phase, values['updated']))
+            self.connection.execute(
+                'UPDATE runs SET {} WHERE run_identifier = ?'.format(
+                    ', '.join(['{} = ?'.format(c) for c in columns])),
+                [values[c] for c in columns] + [run_identifier])
+            self.connection.commit()
+
+    def forget(self, run_identifier):
+        with self.lock:
+            self.connection.execute('DELETE FROM runs WHERE run_identifier = ?', (run_identifier,))
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,179 @@
+import logging
+import queue
+import threading
+
+
+class RunFailure:
+    def __init__(self, run_identifier, phase, exception):
+        self.run_identifier = run_identifier
+        self.phase = phase
+        self.exception = exception
+
+    def __str__(self):
+        return "{} ({}): {}".format(self.run_identifier, self.phase, self.exception)
+
+
+class RunScheduler:
+    '''Download and extract many runs concurrently. Downloads and extractions
+    are carried out by separate, bounded pools of worker threads, so that a
+    slow or failing run does not hold up the others. Failures are collected
+    and reported together once every run has been attempted.
+
+    download_function is called with a run identifier and should return an
+    object to be passed to extract_function, or None if there is nothing to
+    extract.
+
+    Completed downloads wait for extraction in a queue. When queue_depth is
+    not None, at most that many downloaded runs may be waiting at any one time,
+    and downloads pause until extraction catches up, capping the scratch space
+    used by downloaded but not yet extracted files.
+
+    When scratch_budget is not None, run_costs gives the scratch space each
+    run is expected to need, from the start of its download until its
+    extraction finishes. A download is only started when its cost fits in
+    what is left of the budget. Runs are otherwise started in the order given,
+    but when the next run does not fit, the first later run which does is
+    started instead, so that when runs are given largest-first, they are
+    packed into the budget first-fit-decreasing. A run whose cost is unknown
+    (None), or larger than the whole budget, is only started when no other run
+    is using scratch space.
+    '''
+    def __init__(self, download_function, extract_function, download_workers, extraction_workers, queue_depth=None,
+        run_costs=None, scratch_budget=None):
+        if download_workers < 1 or extraction_workers < 1:
+            raise Exception("The number of download and extraction workers must each be at least 1")
+        if queue_depth is not None and queue_depth < 1:
+            raise Exception("The extraction queue depth must be at least 1")
+        if scratch_budget is not None and run_costs is None:
+            raise Exception("Run costs are required when there is a scratch budget")
+        self.download_function = download_function
+        self.extract_function = extract_function
+        self.download_workers = download_workers
+        self.extraction_workers = extraction_workers
+        self.queue_depth = queue_depth
+        self.run_costs = run_costs
+        self.scratch_budget = scratch_budget
+
+    def run(self, run_identifiers):
+        '''Process each run, returning a list of RunFailure objects, one for
+        each run that failed. run_identifiers may be an iterator, which is
+        only read as runs are started. If reading it raises an exception, no
+        further runs are started, and the exception is raised once those
+        already started have finished.'''
+        run_iter = iter(run_identifiers)
+        run_iter_lock = threading.Lock()
+        # Runs not yet started, and the scratch space reserved by started
+        # runs, when there is a scratch budget
+        pending = list(run_identifiers) if self.scratch_budget is not None else None
+        reserved = {}
+        scratch_condition = threading.Condition(run_iter_lock)
+        extraction_queue = queue.Queue(maxsize=0 if self.queue_depth is None else self.queue_depth)
+        failures = []
+        failures_lock = threading.Lock()
+        run_order = {}
+        input_errors = []
+
+        def record_failure(run_identifier, phase, e):
+            logging.error("Run {} failed during {}: {}".format(run_identifier, phase, e))
+            with failures_lock:
+                failures.append(RunFailure(run_identifier, phase, e))
+
+        def next_run():
+            with run_iter_lock:
+                if pending is None:
+                    if len(input_errors) > 0:
+                        return None
+                    try:
+                        run_identifier = next(run_iter)
+                    except StopIteration:
+                        return None
+                    except Exception as e:
+                        # e.g. the runs of a BioProject could not be fetched
+                        logging.error("Failed to find the next run to process: {}".format(e))
+                        input_errors.append(e)
+                        return None
+                else:
+                    run_identifier = next_run_within_budget()
+                    if run_identifier is None:
+                        return None
+                run_order[run_identifier] = len(run_order)
+                return run_identifier
+
+        def next_run_within_budget():
+            # Called with the lock held
+            while len(pending) > 0:
+                in_use = sum(reserved.values())
+                for (i, run_identifier) in enumerate(pending):
+                    cost = self.run_costs.get(run_identifier)
+                    if len(reserved) == 0 or (cost is not None and in_use + cost <= self.scratch_budget):
+                        del pending[i]
+                        if len(reserved) == 0 and (cost is None or cost > self.scratch_budget):
+                            logging.warning("Starting run {} on its own, as its scratch space requirement is {}".format(
+                                run_identifier, 'unknown' if cost is None else 'larger than the budget'))
+                            # Block other runs until this one is finished
+                            cost = self.scratch_budget if cost is None else cost
+                        reserved[run_identifier] = cost
+                        logging.debug("Reserved {} bytes of scratch space for run {}, {} bytes now reserved".format(
+                            cost, run_identifier, in_use + cost))
+                        return run_identifier
+                scratch_condition.wait()
+            return None
+
+        def release_scratch(run_identifier):
+            if pending is not None:
+                with scratch_condition:
+                    reserved.pop(run_identifier, None)
+                    scratch_condition.notify_all()
+
+        def download_worker():
+            while True:
+                run_identifier = next_run()
+                if run_identifier is None:
+                    return
+                try:
+                    downloaded = self.download_function(run_identifier)
+                except Exception as e:
+                    record_failure(run_identifier, 'download', e)
+                    release_scratch(run_identifier)
+                    continue
+                if downloaded is not None:
+                    # Blocks when the queue is full
+                    extraction_queue.put((run_identifier, downloaded))
+                else:
+                    release_scratch(run_identifier)
+
+        def extraction_worker():
+            while True:
+                item = extraction_queue.get()
+                if item is None:
+                    return
+                run_identifier, downloaded = item
+                try:
+                    self.extract_function(downloaded)
+                except Exception as e:
+                    record_failure(run_identifier, 'extraction', e)
+                finally:
+                    release_scratch(run_identifier)
+
+        download_threads = [
+            threading.Thread(target=download_worker, daemon=True, name='kingfisher-download-{}'.format(i))
+            for i in range(self.download_workers)]
+        extraction_threads = [
+            threading.Thread(target=extraction_worker, daemon=True, name='kingfisher-extract-{}'.format(i))
+            for i in range(self.extraction_workers)]
+        for t in download_threads + extraction_threads:
+            t.start()
+
+        for t in download_threads:
+            t.join()
+        for _ in extraction_threads:
+            extraction_queue.put(None)
+        for t in extraction_threads:
+            t.join()
+
+        logging.info("Finished processing {} run(s), of which {} failed".format(len(run_order), len(failures)))
+        if len(input_errors) > 0:
+            raise input_errors[0]
+        # Report failures in the order the runs were given, not the order they
+        # happened to fail in.
+        return sorted(failures, key=lambda f: run_order[f.run_identifier])
@@ -0,0 +1,106 @@
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import re
+
+
+def parse_shard(shard_string):
+    '''Parse a shard specification "i/N" into a tuple (i, N), where i is
+    between 1 and N inclusive.'''
+    matches = re.match(r'^\s*(\d+)\s*/\s*(\d+)\s*$', shard_string)
+    if matches is None:
+        raise Exception("Unable to parse shard '{}', expected e.g. 1/4".format(shard_string))
+    shard_index, num_shards = int(matches.group(1)), int(matches.group(2))
+    if num_shards < 1 or shard_index < 1 or shard_index > num_shards:
+        raise Exception("Shard '{}' is out of range, expected i/N where 1 <= i <= N".format(shard_string))
+    return shard_index, num_shards
+
+
+def _hashed_shard(run_identifier, num_shards):
+    # Python's builtin hash() is randomised per process, so it cannot be used
+    # to agree on shards between processes.
+    digest = hashlib.md5(run_identifier.encode()).digest()
+    return int.from_bytes(digest[:8], 'big') % num_shards + 1
+
+
+def shard_by_hash(run_identifiers, shard_index, num_shards):
+    '''Return the runs in shard shard_index of num_shards, in their original
+    order. Each run is assigned to a shard by a hash of its identifier, so
+    the assignment does not depend on the other runs in the list.'''
+    return [r for r in run_identifiers if _hashed_shard(r, num_shards) == shard_index]
+
+
+def shard_by_size(run_identifiers, run_sizes, shard_index, num_shards):
+    '''Return the runs in shard shard_index of num_shards, in their original
+    order, balancing the total size of each shard. run_sizes is a dict of run
+    identifier to size. Runs are assigned largest first to the shard with the
+    smallest total so far, which is deterministic given the same run list and
+    sizes. Runs whose size is unknown (missing or None) are assigned by
+    hash.'''
+    known = sorted(
+        [r for r in set(run_identifiers) if run_sizes.get(r) is not None],
+        key=lambda r: (-run_sizes[r], r))
+    totals = [0] * num_shards
+    shards = {}
+    for run_identifier in known:
+        smallest = min(range(num_shards), key=lambda i: (totals[i], i))
+        totals[smallest] += run_sizes[run_identifier]
+        shards[run_identifier] = smallest + 1
+    logging.debug("Expected sizes of shards: {}".format(totals))
+    return [r for r in run_identifiers
+        if shards.get(r, None) == shard_index or (r not in shards and _hashed_shard(r, num_shards) == shard_index)]
+
+
+class RunLock:
+    '''An advisory lock on a run in an output directory, so that several
+    kingfisher processes writing to the same directory, perhaps on different
+    machines sharing it, do not download or extract the same run at the same
+    time. The lock is held with flock(2) on a lock file, so it is released
+    automatically if the process holding it dies.
+
+    The lock file is removed when the lock is released. Since another process
+    may open the file just before it is removed, a lock is only considered
+    acquired when the locked file is still the one at the lock path.'''
+
+    SUFFIX = '.kingfisher-lock'
+
+    def __init__(self, output_directory, run_identifier):
+        self.path = os.path.join(output_directory, '.{}{}'.format(run_identifier, RunLock.SUFFIX))
+        self.fd = None
+
+    def acquire(self):
+        '''Try to acquire the lock without waiting. Returns True if it was
+        acquired, False if another process holds it.'''
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError as e:
+                os.close(fd)
+                if e.errno in (errno.EWOULDBLOCK, errno.EAGAIN, errno.EACCES):
+                    return False
+                raise
+            try:
+                same_file = os.path.samestat(os.fstat(fd), os.stat(self.path))
+            except FileNotFoundError:
+                same_file = False
+            if same_file:
+                os.ftruncate(fd, 0)
+                os.write(fd, '{}\n'.format(os.getpid()).encode())
+                self.fd = fd
+                return True
+            # The lock file was removed by its previous holder after it was
+            # opened here, so try again with a new one.
+            os.close(fd)
+
+    def release(self):
+        if self.fd is None:
+            return
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        os.close(self.fd)
+        self.fd = None
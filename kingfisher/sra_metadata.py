@@ -4,7 +4,10 @@ import requests
 import xml.etree.ElementTree as ET
 import logging
 import collections
+import re
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from tqdm import tqdm
 
 try:
@@ -14,7 +17,8 @@ except ImportError:
 
 import pandas as pd
 
-from bird_tool_utils import iterable_chunks
+from . import tracing
+from .rate_limiter import TokenBucket
 
 # Define these constants so that they can be referred to in other classes
 # without index errors.
@@ -25,12 +29,222 @@ SAMPLE_NAME_KEY = 'sample_name'
 NCBI_API_KEY_ENV = 'NCBI_API_KEY'
 BIOPROJECT_ACCESSION_KEY = 'bioproject'
 
+# NCBI allows 3 E-utilities requests per second, or 10 with an API key
+NCBI_REQUESTS_PER_SECOND = 3
+NCBI_REQUESTS_PER_SECOND_WITH_API_KEY = 10
+
+# Accessions are queried in chunks, several at once
+EFETCH_CHUNK_SIZE = 500
+EFETCH_MIN_CHUNK_SIZE = 25
+EFETCH_MAX_CHUNK_SIZE = 2000
+# Chunks answered more quickly than this make the next chunks bigger
+EFETCH_FAST_CHUNK_SECONDS = 10
+EFETCH_WORKERS = 4
+EFETCH_CHUNK_ATTEMPTS = 3
+EFETCH_RETRY_SECONDS = 5
+# Experiments of BioProjects are fetched in pages of this many
+BIOPROJECT_PAGE_SIZE = 500
+
+_ncbi_rate_limiter = None
+_ncbi_rate_limiter_lock = threading.Lock()
+
+def ncbi_rate_limiter():
+    '''The TokenBucket shared by all requests to NCBI E-utilities made by this
+    process.'''
+    global _ncbi_rate_limiter
+    with _ncbi_rate_limiter_lock:
+        if _ncbi_rate_limiter is None:
+            if NCBI_API_KEY_ENV in os.environ:
+                _ncbi_rate_limiter = TokenBucket(NCBI_REQUESTS_PER_SECOND_WITH_API_KEY)
+            else:
+                _ncbi_rate_limiter = TokenBucket(NCBI_REQUESTS_PER_SECOND)
+        return _ncbi_rate_limiter
+
+
+def _try_get(func, element):
+    try:
+        return func(element)
+    except AttributeError:
+        return ''
+    except KeyError:
+        return None
+
+def _library_descriptor_text(tag):
+    return lambda pkg: pkg.find('./EXPERIMENT/DESIGN/LIBRARY_DESCRIPTOR/{}'.format(tag)).text
+
+def _submitter(pkg):
+    submitter = ''
+    for k, v in pkg.find('./SUBMISSION').attrib.items():
+        if k not in ('accession','alias'):
+            if submitter == '':
+                submitter = v
+            else:
+                submitter = "{}, {}".format(submitter, v)
+    return submitter
+
+def _contact_name(pkg):
+    first_name = _try_get(lambda p: p.find('./Organization/Contact/Name/First').text, pkg)
+    last_name = _try_get(lambda p: p.find('./Organization/Contact/Name/Last').text, pkg)
+    return "{} {}".format(first_name, last_name)
+
+def _study_links(pkg):
+    study_links_xrefs = pkg.find('./STUDY/STUDY_LINKS')
+    if study_links_xrefs is None:
+        return json.dumps([])
+    # Convert db to lower case because otherwise have PUBMED and pubmed e.g. ERR1914274 and SRR9113719
+    study_links = list([
+        {'db': x.find('DB').text.lower(), 'id': x.find('ID').text}
+        for x in study_links_xrefs.findall('STUDY_LINK/XREF_LINK')])
+    # Record URL links like SRR7051324
+    for x in study_links_xrefs.findall('STUDY_LINK/URL_LINK'):
+        study_links.append({
+            'label': x.find('LABEL').text,
+            'url': x.find('URL').text
+        })
+    return json.dumps(study_links)
+
+# Columns of run metadata found in each EXPERIMENT_PACKAGE of efetch XML, in
+# the order they are output, and how to find them. Sample attributes and the
+# sample name come between the package and study fields.
+_PACKAGE_FIELDS = [
+    ('experiment_accession', lambda pkg: pkg.find('./EXPERIMENT').attrib['accession']),
+    ('experiment_title', lambda pkg: pkg.find('./EXPERIMENT/TITLE').text),
+    ('library_name', _library_descriptor_text('LIBRARY_NAME')),
+    ('library_strategy', _library_descriptor_text('LIBRARY_STRATEGY')),
+    ('library_source', _library_descriptor_text('LIBRARY_SOURCE')),
+    ('library_selection', _library_descriptor_text('LIBRARY_SELECTION')),
+    ('library_layout', lambda pkg: pkg.find('./EXPERIMENT/DESIGN/LIBRARY_DESCRIPTOR/LIBRARY_LAYOUT')[0].tag),
+    ('platform', lambda pkg: pkg.find('./EXPERIMENT/PLATFORM')[0].tag),
+    ('model', lambda pkg: pkg.find('./EXPERIMENT/PLATFORM/')[0].text),
+    ('submitter', _submitter),
+    (STUDY_ACCESSION_KEY, lambda pkg: pkg.find('./STUDY').attrib['accession']),
+    (BIOPROJECT_ACCESSION_KEY, lambda pkg: pkg.find('./STUDY/IDENTIFIERS/EXTERNAL_ID[@namespace="BioProject"]').text),
+    ('study_alias', lambda pkg: pkg.find('./STUDY').attrib['alias']),
+    ('study_centre_project_name', lambda pkg: pkg.find('./STUDY/DESCRIPTOR/CENTER_PROJECT_NAME').text),
+    ('organisation', lambda pkg: pkg.find('./Organization/Name').text),
+    ('organisation_department', lambda pkg: pkg.find('./Organization/Address/Department').text),
+    ('organisation_institution', lambda pkg: pkg.find('./Organization/Address/Institution').text),
+    ('organisation_street', lambda pkg: pkg.find('./Organization/Address/Street').text),
+    ('organisation_city', lambda pkg: pkg.find('./Organization/Address/City').text),
+    ('organisation_country', lambda pkg: pkg.find('./Organization/Address/Country').text),
+    ('organisation_contact_name', _contact_name),
+    ('organisation_contact_email', lambda pkg: pkg.find('./Organization/Contact').attrib['email']),
+    # Remove carriage return from sample description e.g. for SRR1263047
+    ('sample_description', lambda pkg: pkg.find('./SAMPLE/DESCRIPTION').text.replace('\r','')),
+    ('sample_alias', lambda pkg: pkg.find('./SAMPLE').attrib['alias']),
+    ('sample_accession', lambda pkg: pkg.find('./SAMPLE').attrib['accession']),
+    ('biosample', lambda pkg: pkg.find('./SAMPLE/IDENTIFIERS/EXTERNAL_ID[@namespace="BioSample"]').text),
+    ('sample_title', lambda pkg: pkg.find('./SAMPLE/TITLE').text),
+    ('taxon_name', lambda pkg: pkg.find('./SAMPLE/SAMPLE_NAME/SCIENTIFIC_NAME').text),
+]
+_STUDY_FIELDS = [
+    ('study_title', lambda pkg: pkg.find('./STUDY/DESCRIPTOR/STUDY_TITLE').text),
+    ('design_description', lambda pkg: pkg.find('./EXPERIMENT/DESIGN/DESIGN_DESCRIPTION').text),
+    ('study_abstract', lambda pkg: pkg.find('./STUDY/DESCRIPTOR/STUDY_ABSTRACT').text),
+    ('study_links', _study_links),
+]
+_RUN_FIELDS = [
+    ('spots', lambda run: int(run.attrib['total_spots'])),
+    (BASES_KEY, lambda run: int(run.attrib['total_bases'])),
+    ('run_size', lambda run: int(run.attrib['size'])),
+    (RUN_ACCESSION_KEY, lambda run: run.attrib['accession']),
+    ('published', lambda run: run.attrib['published']),
+]
+# Columns other than sample attributes
+_FIXED_COLUMNS = set([name for (name, _) in _PACKAGE_FIELDS + _STUDY_FIELDS + _RUN_FIELDS] +
+    [SAMPLE_NAME_KEY, 'number_of_runs_for_sample'])
+
+# Types of the columns that are not strings. Nullable types are used so that
+# runs without a value do not change the type of the whole column, and fields
+# with few distinct values are categorical, so each value is stored once. Read
+# length averages and stdevs are Int64 if every value is integral, so that e.g.
+# 150 is not output as 150.0, and are otherwise Float64.
+INTEGER_COLUMNS = ['number_of_runs_for_sample', 'spots', BASES_KEY, 'run_size']
+CATEGORICAL_COLUMNS = ['library_strategy', 'library_source', 'library_selection', 'library_layout', 'platform', 'model']
+_READ_LENGTH_COLUMN_REGEX = re.compile(r'^read[0-9]+_length_(average|stdev)$')
+
+def _column_dtype(column):
+    '''Return the dtype of a column of run metadata, or None for strings.'''
+    if column in INTEGER_COLUMNS:
+        return 'Int64'
+    elif column in CATEGORICAL_COLUMNS:
+        return 'category'
+    return None
+
+def _is_read_length_column(column):
+    return _READ_LENGTH_COLUMN_REGEX.match(column) is not None
+
+def _read_length_array(values):
+    '''Return read lengths as an Int64 array if every value is integral,
+    otherwise as Float64.'''
+    array = pd.array(values, dtype='Float64')
+    if all([float(v).is_integer() for v in array[~array.isna()]]):
+        return array.astype('Int64')
+    return array
+
+def _wants_sample_attributes(wanted):
+    '''True unless wanted is a set of columns that are all found without
+    looking at sample attributes, which have arbitrary tags.'''
+    return wanted is None or SAMPLE_NAME_KEY in wanted or \
+        any([c not in _FIXED_COLUMNS and not _is_read_length_column(c) for c in wanted])
+
+def _set_column_types(metadata):
+    '''Return metadata with each column converted to its dtype, for instance
+    after concatenating DataFrames with different categories.'''
+    dtypes = {}
+    read_length_columns = []
+    for column in metadata.columns:
+        if _is_read_length_column(column):
+            if str(metadata[column].dtype) != 'Int64':
+                read_length_columns.append(column)
+            continue
+        dtype = _column_dtype(column)
+        if dtype is not None and str(metadata[column].dtype) != dtype:
+            dtypes[column] = dtype
+    if len(dtypes) == 0 and len(read_length_columns) == 0:
+        return metadata
+    metadata = metadata.astype(dtypes)
+    for column in read_length_columns:
+        metadata[column] = _read_length_array(metadata[column].to_list())
+    return metadata
+
+
+class AdaptiveChunkSize:
+    '''The number of accessions to query at once, which is halved when a
+    query fails, and grows by half when queries are answered quickly, within
+    minimum and maximum.'''
+
+    def __init__(self, initial, minimum, maximum, fast_seconds):
+        self.size = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.fast_seconds = fast_seconds
+        self._lock = threading.Lock()
+
+    def succeeded(self, chunk_size, seconds):
+        with self._lock:
+            # Only chunks of about the current size say whether it is fast
+            if seconds < self.fast_seconds and chunk_size >= self.size:
+                self.size = min(self.maximum, self.size + self.size // 2)
+
+    def failed(self):
+        with self._lock:
+            self.size = max(self.minimum, self.size // 2)
+
+
 class SraMetadata:
     def add_api_key(self, other_params):
         if NCBI_API_KEY_ENV in os.environ:
             other_params['api_key'] = os.environ[NCBI_API_KEY_ENV]
         return other_params
 
+    def _eutils_request(self, method, endpoint, **kwargs):
+        '''Make a request to the NCBI E-utilities endpoint e.g. esearch.fcgi,
+        waiting as needed to keep within NCBI's rate limit.'''
+        ncbi_rate_limiter().acquire()
+        return tracing.http_request(method,
+            url="https://eutils.ncbi.nlm.nih.gov/entrez/eutils/{}".format(endpoint), **kwargs)
+
     def _retry_request(self, description, func):
         '''Retry a reqests.post or requests.get 3 times, returning the request
         when OK, otherwise raising an Exception'''
@@ -62,41 +276,85 @@ class SraMetadata:
 
 
     def fetch_runs_from_bioprojects(self, bioproject_accessions):
-        retmax = 10000
+        '''Return a list of the run accessions of the given BioProjects.'''
+        return [run for page in self.run_pages_from_bioprojects(bioproject_accessions) for run in page]
+
+    def run_pages_from_bioprojects(self, bioproject_accessions, page_size=BIOPROJECT_PAGE_SIZE, num_workers=EFETCH_WORKERS):
+        '''Yield lists of the run accessions of the given BioProjects, one
+        list per page of page_size experiments, in order.
+
+        The search is kept on NCBI's history server, so there is no limit to
+        the number of experiments, and its pages are fetched num_workers at a
+        time. Only that many pages are fetched ahead of those yielded, so runs
+        from the first pages can be used while later ones are fetched.'''
         query_string = " OR ".join(["{}[BioProject]".format(bioproject_accession) for bioproject_accession in bioproject_accessions])
         logging.debug("Querying with string: {}".format(query_string))
-        res = requests.get(
-            url="https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi",
+        res = self._eutils_request('GET', 'esearch.fcgi',
             params=self.add_api_key({
                 "db": "sra",
                 "term": query_string,
                 "tool": "kingfisher",
                 "email": "kingfisher@github.com",
-                "retmax": retmax,
+                # Only the number of results is needed, since pages of them
+                # are fetched from the history server.
+                "retmax": 0,
                 "usehistory": "y",
                 }),
             )
         if not res.ok:
             raise Exception("HTTP Failure when requesting search from bioproject: {}: {}".format(res, res.text))
         root = ET.fromstring(res.text)
-        sra_ids = list([c.text for c in root.find('IdList')])
-        if len(sra_ids) == retmax:
-            logging.warning("Unexpectedly found the maximum number of results for this query, possibly some results will be missing")
+        count = int(root.find('Count').text)
+        if count == 0:
+            logging.warning("No runs found for BioProject(s) {}".format(', '.join(bioproject_accessions)))
+            return
         webenv = root.find('WebEnv').text
-
-        # Now convert the IDs into runs
-        metadata = self.efetch_metadata_from_ids(webenv, None, len(sra_ids))
+        query_key = root.find('QueryKey').text
+        logging.info("Fetching the runs of {} experiment(s) in pages of {}, {} at a time".format(
+            count, page_size, num_workers))
+
+        pool = ThreadPoolExecutor(num_workers)
+        try:
+            # Pages in order, as futures
+            pending = collections.deque()
+            next_start = 0
+            while next_start < count or len(pending) > 0:
+                while next_start < count and len(pending) < num_workers:
+                    pending.append(pool.submit(self._efetch_page, webenv, query_key, next_start, page_size))
+                    next_start += page_size
+                yield pending.popleft().result()
+        finally:
+            # Don't fetch more pages if the caller stops early
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def _efetch_page(self, webenv, query_key, retstart, retmax):
+        '''Return a list of the run accessions of a page of the experiments in
+        the search held on the history server.'''
+        res = self._retry_request(
+            'efetch experiments {} to {}'.format(retstart + 1, retstart + retmax),
+            lambda: self._eutils_request('GET', 'efetch.fcgi',
+                params=self.add_api_key({
+                    "db": "sra",
+                    "tool": "kingfisher",
+                    "email": "kingfisher@github.com",
+                    "webenv": webenv,
+                    "query_key": query_key,
+                    "retstart": retstart,
+                    "retmax": retmax,
+                    }),
+                stream=True,
+                ))
+        metadata = self._parse_efetch_response(res, None, [RUN_ACCESSION_KEY])
+        if RUN_ACCESSION_KEY not in metadata.columns:
+            return []
         return metadata[RUN_ACCESSION_KEY].to_list()
 
-    def efetch_metadata_from_ids(self, webenv, accessions, num_ids):
-        data_frames = []
-
+    def efetch_metadata_from_ids(self, webenv, accessions, num_ids, columns=None):
         retmax = num_ids+10
         logging.debug("Running efetch ..")
         res = self._retry_request(
             'efetch_from_ids',
-            lambda: requests.get(
-                url="https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi",
+            lambda: self._eutils_request('GET', 'efetch.fcgi',
                 params=self.add_api_key({
                     "db": "sra",
                     "tool": "kingfisher",
@@ -104,66 +362,102 @@ class SraMetadata:
                     "webenv": webenv,
                     "query_key": 1
                     }),
+                stream=True,
                 ))
         if not res.ok:
             raise Exception("HTTP Failure when requesting efetch from IDs: {}: {}".format(res, res.text))
 
-        root = ET.fromstring(res.text)
-
-        def try_get(func):
-            try:
-                return func()
-            except AttributeError:
-                return ''
-            except KeyError:
-                return None
-
-        if root.find("ERROR") is not None:
-            logging.error("Error when fetching metadata: {}".format(root.find("ERROR").text))
-
+        return self._parse_efetch_response(res, accessions, columns)
+
+    def _parse_efetch_response(self, res, accessions, columns=None):
+        '''Parse a streamed efetch response as it arrives, rather than reading
+        all of it first.'''
+        try:
+            # Undo any Content-Encoding e.g. gzip
+            res.raw.decode_content = True
+            return self.parse_efetch_metadata_stream(res.raw, accessions, columns)
+        finally:
+            res.close()
+
+    @staticmethod
+    def parse_efetch_metadata(xml_text, accessions=None, columns=None):
+        '''Parse the XML returned by efetch from the sra database into a
+        DataFrame with one row per run. If accessions is not None, only runs
+        with those accessions are included. If columns is not None, only
+        those columns are parsed, along with the run accession, skipping the
+        work of finding the others.'''
+        return SraMetadata.parse_efetch_metadata_stream(StringIO(xml_text), accessions, columns)
+
+    @staticmethod
+    def parse_efetch_metadata_stream(stream, accessions=None, columns=None):
+        '''As parse_efetch_metadata, but reading the XML incrementally from
+        a file object, such as the raw stream of an HTTP response. Each
+        EXPERIMENT_PACKAGE is discarded once it has been parsed, and the
+        DataFrame is built column by column rather than from a dict per run,
+        so that the memory used beyond the DataFrame itself does not grow
+        with the number of packages. Columns are typed as given by
+        INTEGER_COLUMNS and CATEGORICAL_COLUMNS, read lengths are numbers,
+        and other columns are strings.'''
+        values_by_column = collections.OrderedDict()
+        num_rows = 0
+        # Runs of the same study or sample repeat long strings such as the
+        # study abstract, so keep a single copy of each.
+        distinct_strings = {}
+        for row in SraMetadata._iter_efetch_runs(stream, accessions, columns):
+            for (key, value) in row.items():
+                if isinstance(value, str):
+                    value = distinct_strings.setdefault(value, value)
+                if key not in values_by_column:
+                    # Missing values are NaN, as when building a DataFrame
+                    # from a list of dicts
+                    values_by_column[key] = [float('nan')] * num_rows
+                values_by_column[key].append(value)
+            num_rows += 1
+            for values in values_by_column.values():
+                if len(values) < num_rows:
+                    values.append(float('nan'))
+        typed_columns = collections.OrderedDict()
+        for (column, values) in values_by_column.items():
+            if _is_read_length_column(column):
+                typed_columns[column] = _read_length_array(values)
+                continue
+            dtype = _column_dtype(column)
+            typed_columns[column] = values if dtype is None else pd.array(values, dtype=dtype)
+        return pd.DataFrame(typed_columns)
+
+    @staticmethod
+    def _iter_efetch_runs(stream, accessions, columns=None):
+        '''Yield a dict for each run in efetch XML read from stream.'''
         # Some samples such as SAMN13241871 are linked to multiple runs e.g. SRR10489833
         accessions_set = None if accessions is None else set(accessions)
-
-        for pkg in root.findall('EXPERIMENT_PACKAGE'):
-            d = collections.OrderedDict()
-            d['experiment_accession'] = try_get(lambda: pkg.find('./EXPERIMENT').attrib['accession'])
-            d['experiment_title'] = try_get(lambda: pkg.find('./EXPERIMENT/TITLE').text)
-            l = pkg.find('./EXPERIMENT/DESIGN/LIBRARY_DESCRIPTOR')
-            d['library_name'] = try_get(lambda: l.find('LIBRARY_NAME').text)
-            d['library_strategy'] = try_get(lambda: l.find('LIBRARY_STRATEGY').text)
-            d['library_source'] = try_get(lambda: l.find('LIBRARY_SOURCE').text)
-            d['library_selection'] = try_get(lambda: l.find('LIBRARY_SELECTION').text)
-            d['library_layout'] = try_get(lambda: l.find('LIBRARY_LAYOUT')[0].tag)
-            d['platform'] = try_get(lambda: pkg.find('./EXPERIMENT/PLATFORM')[0].tag)
-            d['model'] = try_get(lambda: pkg.find('./EXPERIMENT/PLATFORM/')[0].text)
-            d['submitter'] = ''
-            for k, v in pkg.find('./SUBMISSION').attrib.items():
-                if k not in ('accession','alias'):
-                    if d['submitter'] == '':
-                        d['submitter'] = v
-                    else:
-                        d['submitter'] = "{}, {}".format(d['submitter'], v)
-            d[STUDY_ACCESSION_KEY] = try_get(lambda: pkg.find('./STUDY').attrib['accession'])
-            d[BIOPROJECT_ACCESSION_KEY] = try_get(lambda: pkg.find('./STUDY/IDENTIFIERS/EXTERNAL_ID[@namespace="BioProject"]').text)
-            d['study_alias'] = try_get(lambda: pkg.find('./STUDY').attrib['alias'])
-            d['study_centre_project_name'] = try_get(lambda: pkg.find('./STUDY/DESCRIPTOR/CENTER_PROJECT_NAME').text)
-            d['organisation'] = try_get(lambda: pkg.find('./Organization/Name').text)
-            d['organisation_department'] = try_get(lambda: pkg.find('./Organization/Address/Department').text)
-            d['organisation_institution'] = try_get(lambda: pkg.find('./Organization/Address/Institution').text)
-            d['organisation_street'] = try_get(lambda: pkg.find('./Organization/Address/Street').text)
-            d['organisation_city'] = try_get(lambda: pkg.find('./Organization/Address/City').text)
-            d['organisation_country'] = try_get(lambda: pkg.find('./Organization/Address/Country').text)
-            first_name = try_get(lambda: pkg.find('./Organization/Contact/Name/First').text)
-            last_name = try_get(lambda: pkg.find('./Organization/Contact/Name/Last').text)
-            d['organisation_contact_name'] = "{} {}".format(first_name, last_name)
-            d['organisation_contact_email'] = try_get(lambda: pkg.find('./Organization/Contact').attrib['email'])
-            # Remove carriage return from sample description e.g. for SRR1263047
-            d['sample_description'] = try_get(lambda: pkg.find('./SAMPLE/DESCRIPTION').text.replace('\r',''))
-            d['sample_alias'] = try_get(lambda: pkg.find('./SAMPLE').attrib['alias'])
-            d['sample_accession'] = try_get(lambda: pkg.find('./SAMPLE').attrib['accession'])
-            d['biosample'] = try_get(lambda: pkg.find('./SAMPLE/IDENTIFIERS/EXTERNAL_ID[@namespace="BioSample"]').text)
-            d['sample_title'] = try_get(lambda: pkg.find('./SAMPLE/TITLE').text)
-            d['taxon_name'] = try_get(lambda: pkg.find('./SAMPLE/SAMPLE_NAME/SCIENTIFIC_NAME').text)
+        wanted = None if columns is None else set(columns) | set([RUN_ACCESSION_KEY])
+        root = None
+        for (event, element) in ET.iterparse(stream, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = element
+            elif element.tag == 'EXPERIMENT_PACKAGE':
+                yield from SraMetadata._experiment_package_runs(element, accessions_set, wanted)
+                # Free the package, and any earlier siblings
+                root.clear()
+            elif element.tag == 'ERROR':
+                logging.error("Error when fetching metadata: {}".format(element.text))
+
+    @staticmethod
+    def _experiment_package_runs(pkg, accessions_set, wanted=None):
+        '''Yield a dict for each run of an EXPERIMENT_PACKAGE element with an
+        accession in accessions_set, or every run if it is None. If wanted is
+        not None, only the columns in it are found.'''
+        want = (lambda name: True) if wanted is None else wanted.__contains__
+
+        d = collections.OrderedDict()
+        for (name, func) in _PACKAGE_FIELDS:
+            if want(name):
+                d[name] = _try_get(func, pkg)
+
+        # Sample attributes have arbitrary tags, so are only looked at when
+        # they could be wanted.
+        if _wants_sample_attributes(wanted):
             sample_sample_name = None
             sample_title = None
             if pkg.find('./SAMPLE/SAMPLE_ATTRIBUTES'):
@@ -181,53 +475,44 @@ class SraMetadata:
                             sample_title = value
                         elif tag == 'sample name':
                             sample_sample_name = value
-                        d[tag] = value
-            if sample_sample_name is not None:
-                d[SAMPLE_NAME_KEY] = sample_sample_name
-            elif sample_title is not None:
-                d[SAMPLE_NAME_KEY] = sample_title
-            else:
-                d[SAMPLE_NAME_KEY] = d['library_name'] #default, maybe there's always a title though?
-            d['study_title'] = try_get(lambda: pkg.find('./STUDY/DESCRIPTOR/STUDY_TITLE').text)
-            d['design_description'] = try_get(lambda: pkg.find('./EXPERIMENT/DESIGN/DESIGN_DESCRIPTION').text)
-            d['study_abstract'] = try_get(lambda: pkg.find('./STUDY/DESCRIPTOR/STUDY_ABSTRACT').text)
-            study_links_xrefs = try_get(lambda: pkg.find('./STUDY/STUDY_LINKS'))
-            if study_links_xrefs is not None:
-                # Convert db to lower case because otherwise have PUBMED and pubmed e.g. ERR1914274 and SRR9113719
-                study_links = list([
-                    {'db': x.find('DB').text.lower(), 'id': x.find('ID').text}
-                    for x in study_links_xrefs.findall('STUDY_LINK/XREF_LINK')])
-                # Record URL links like SRR7051324
-                for x in study_links_xrefs.findall('STUDY_LINK/URL_LINK'):
-                    study_links.append({
-                        'label': x.find('LABEL').text,
-                        'url': x.find('URL').text
-                    })
-                d['study_links'] = json.dumps(study_links)
-            else:
-                d['study_links'] = json.dumps([])
-            
-            # Account for the fact that multiple runs may be associated with
-            # this sample
-            d['number_of_runs_for_sample'] = len(pkg.findall('./RUN_SET/RUN'))
-
-            for run in pkg.findall('./RUN_SET/RUN'):
-                accession_here = run.attrib['accession']
-                if accessions_set is None or accession_here in accessions_set:
-                    d2 = d.copy()
-                    d2['spots'] = try_get(lambda: int(run.attrib['total_spots']))
-                    d2[BASES_KEY] = try_get(lambda: int(run.attrib['total_bases']))
-                    d2['run_size'] = try_get(lambda: int(run.attrib['size']))
-                    d2[RUN_ACCESSION_KEY] = try_get(lambda: run.attrib['accession'])
-                    d2['published'] = try_get(lambda: run.attrib['published'])
-                    stats = run.find('Statistics')
-                    if stats is not None:
-                        for (i, r) in enumerate(stats):
-                            d2['read{}_length_average'.format(i+1)] = r.attrib['average']
-                            d2['read{}_length_stdev'.format(i+1)] = r.attrib['stdev']
-                    data_frames.append(d2)
-
-        return pd.DataFrame(data_frames)
+                        if want(tag):
+                            d[tag] = value
+            if want(SAMPLE_NAME_KEY):
+                if sample_sample_name is not None:
+                    d[SAMPLE_NAME_KEY] = sample_sample_name
+                elif sample_title is not None:
+                    d[SAMPLE_NAME_KEY] = sample_title
+                else:
+                    #default, maybe there's always a title though?
+                    d[SAMPLE_NAME_KEY] = _try_get(_library_descriptor_text('LIBRARY_NAME'), pkg)
+
+        for (name, func) in _STUDY_FIELDS:
+            if want(name):
+                d[name] = _try_get(func, pkg)
+
+        runs = pkg.findall('./RUN_SET/RUN')
+        # Account for the fact that multiple runs may be associated with
+        # this sample
+        if want('number_of_runs_for_sample'):
+            d['number_of_runs_for_sample'] = len(runs)
+
+        for run in runs:
+            accession_here = run.attrib['accession']
+            if accessions_set is None or accession_here in accessions_set:
+                d2 = d.copy()
+                for (name, func) in _RUN_FIELDS:
+                    if want(name):
+                        d2[name] = _try_get(func, run)
+                stats = run.find('Statistics')
+                if stats is not None:
+                    for (i, r) in enumerate(stats):
+                        average_key = 'read{}_length_average'.format(i+1)
+                        stdev_key = 'read{}_length_stdev'.format(i+1)
+                        if want(average_key):
+                            d2[average_key] = float(r.attrib['average'])
+                        if want(stdev_key):
+                            d2[stdev_key] = float(r.attrib['stdev'])
+                yield d2
 
     def _print_xml(self, element, prefix):
         if prefix is None or prefix == '':
@@ -241,91 +526,147 @@ class SraMetadata:
         for e in element:
             self.print_xml(e, '{}{}'.format(p2, e.tag))
 
-    def efetch_sra_from_accessions(self, accessions):
-        all_accessions = list(set(accessions))
+    def efetch_sra_from_accessions(self, accessions, num_workers=EFETCH_WORKERS, columns=None):
+        '''Return a DataFrame of the metadata of the runs with the given
+        accessions, sorted by study and run, or None if any chunk of them
+        could not be found at all. If columns is not None, only those
+        columns are parsed, as well as the study and run accessions.
+
+        Accessions are queried in chunks, num_workers of them at once, with
+        requests limited to NCBI's rate for all workers together. The size of
+        the chunks adapts, shrinking when queries fail and growing when they
+        are answered quickly. Each chunk is identified by the position of its
+        first accession, so the result does not depend on the order in which
+        chunks finish.'''
+        # Keep the order given, rather than that of a set, so that the chunks
+        # queried are the same each time
+        all_accessions = list(dict.fromkeys(accessions))
         if len(all_accessions) == 0:
             return []
-
-        metadata_chunks = []
-        chunk_size = 500
-
-        # Complicated calculation here.
-        num_chunks = len(all_accessions)/chunk_size
-        if num_chunks > int(num_chunks):
-            num_chunks = int(num_chunks) + 1
-        num_chunks = int(num_chunks)
-
-        if len(all_accessions) > chunk_size:
-            logging.info("Querying for {} accessions in {} chunks".format(len(all_accessions), num_chunks))
-            accession_iter = tqdm(iterable_chunks(all_accessions, chunk_size), total=num_chunks)
+        if columns is not None:
+            # Needed for sorting
+            columns = list(columns) + [STUDY_ACCESSION_KEY]
+
+        chunk_size = AdaptiveChunkSize(EFETCH_CHUNK_SIZE, EFETCH_MIN_CHUNK_SIZE, EFETCH_MAX_CHUNK_SIZE,
+            EFETCH_FAST_CHUNK_SECONDS)
+        if len(all_accessions) > chunk_size.size:
+            logging.info("Querying for {} accessions in chunks of about {}, {} at a time".format(
+                len(all_accessions), chunk_size.size, num_workers))
+            progress = tqdm(total=len(all_accessions))
         else:
-            accession_iter = [all_accessions]
-
-        for accessions_plus in accession_iter:
-            accessions = [a for a in accessions_plus if a is not None]
-
-            if num_chunks == 1:
-                logging.info("Querying NCBI esearch for {} distinct accessions e.g. {}".format(
-                    len(accessions), accessions[0]))
-            sra_ids = []
+            logging.info("Querying NCBI for {} distinct accessions e.g. {}".format(
+                len(all_accessions), all_accessions[0]))
+            progress = None
+
+        # Chunks that failed, to be retried, as (offset, accessions, attempt)
+        retries = collections.deque()
+        next_offset = 0
+        results = {}
+        all_found = True
+        in_flight = {}
+        try:
+            with ThreadPoolExecutor(num_workers) as pool:
+                while True:
+                    while all_found and len(in_flight) < num_workers and \
+                            (len(retries) > 0 or next_offset < len(all_accessions)):
+                        if len(retries) > 0:
+                            offset, chunk, attempt = retries.popleft()
+                        else:
+                            offset, chunk, attempt = next_offset, all_accessions[next_offset:next_offset+chunk_size.size], 0
+                            next_offset += len(chunk)
+                        in_flight[pool.submit(self._timed_efetch_chunk, chunk, attempt, columns)] = (offset, chunk, attempt)
+                    if len(in_flight) == 0:
+                        break
+
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        offset, chunk, attempt = in_flight.pop(future)
+                        try:
+                            metadata, seconds = future.result()
+                        except Exception as e:
+                            chunk_size.failed()
+                            if attempt + 1 >= EFETCH_CHUNK_ATTEMPTS:
+                                raise Exception("Failed to query NCBI for {} accessions starting with {} after {} attempts: {}".format(
+                                    len(chunk), chunk[0], EFETCH_CHUNK_ATTEMPTS, e))
+                            logging.warning("Query for {} accessions starting with {} failed, retrying in chunks of {}: {}".format(
+                                len(chunk), chunk[0], chunk_size.size, e))
+                            for i in range(0, len(chunk), chunk_size.size):
+                                retries.append((offset + i, chunk[i:i+chunk_size.size], attempt + 1))
+                            continue
+                        chunk_size.succeeded(len(chunk), seconds)
+                        if metadata is None:
+                            logging.warning("Unable to find any accessions, from the list: {}".format(chunk))
+                            all_found = False
+                        else:
+                            results[offset] = metadata
+                        if progress is not None:
+                            progress.update(len(chunk))
+        finally:
+            if progress is not None:
+                progress.close()
+
+        if not all_found:
+            return None
+        metadata = _set_column_types(pd.concat([results[offset] for offset in sorted(results.keys())]))
+        metadata.sort_values([STUDY_ACCESSION_KEY,RUN_ACCESSION_KEY], inplace=True)
 
-            webenv = None
-            request_term = ' OR '.join(["{}[accn]".format(acc) for acc in accessions])
+        return metadata
 
-            retmax = len(accessions)+10
-            params=self.add_api_key({
+    def _timed_efetch_chunk(self, accessions, attempt, columns=None):
+        if attempt > 0:
+            time.sleep(EFETCH_RETRY_SECONDS * 2 ** (attempt - 1))
+        start = time.time()
+        metadata = self._efetch_chunk(accessions, columns)
+        return metadata, time.time() - start
+
+    def _efetch_chunk(self, accessions, columns=None):
+        '''Query esearch then efetch for the metadata of a chunk of
+        accessions, returning a DataFrame, or None if none of them were found.
+        Raises an Exception if either request fails.'''
+        res = self._eutils_request('POST', 'esearch.fcgi',
+            data=self.add_api_key({
                 "db": "sra",
-                "term": request_term,
+                "term": ' OR '.join(["{}[accn]".format(acc) for acc in accessions]),
                 "tool": "kingfisher",
                 "email": "kingfisher@github.com",
-                "retmax": retmax,
+                "retmax": len(accessions)+10,
                 "usehistory": "y",
-                })
-            if webenv is None:
-                params['WebEnv'] = webenv
-
-            res = self._retry_request(
-                "esearch from accessions", 
-                lambda: requests.post(
-                    url="https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi",
-                    data=params))
-
-            root = ET.fromstring(res.text)
-            if webenv is None:
-                webenv = root.find('WebEnv').text
-            id_list_node = root.find('IdList')
-            sra_ids = list(set([c.text for c in id_list_node]))
-
-            if len(sra_ids) == 0:
-                logging.warning("Unable to find any accessions, from the list: {}".format(accessions))
-                return None
-
-            if num_chunks == 1:
-                logging.info("Querying NCBI efetch for {} distinct IDs e.g. {}".format(
-                    len(sra_ids), sra_ids[0]))
-            metadata = self.efetch_metadata_from_ids(webenv, accessions, len(sra_ids))
-
-            # Ensure all hits are found, and trim results to just those that are real hits
-            if RUN_ACCESSION_KEY not in metadata.columns:
-                raise Exception("No metadata could be retrieved")
-
-            if len(metadata) != len(accessions):
-                found_runs = set(metadata[RUN_ACCESSION_KEY].to_list())
-                not_found = list([a for a in accessions if a not in found_runs])
-                logging.warning("Unable to find all accessions. The {} missing ones were: {}".format(
-                    len(not_found), not_found
-                ))
-            metadata_chunks.append(metadata)
-
-        metadata = pd.concat(metadata_chunks)
-        metadata.sort_values([STUDY_ACCESSION_KEY,RUN_ACCESSION_KEY], inplace=True)
+                }))
+        if not res.ok:
+            raise Exception("HTTP Failure when requesting esearch from accessions: {}: {}".format(res, res.text))
+        root = ET.fromstring(res.text)
+        webenv = root.find('WebEnv').text
+        sra_ids = list(set([c.text for c in root.find('IdList')]))
+        if len(sra_ids) == 0:
+            return None
 
+        res = self._eutils_request('GET', 'efetch.fcgi',
+            params=self.add_api_key({
+                "db": "sra",
+                "tool": "kingfisher",
+                "email": "kingfisher@github.com",
+                "webenv": webenv,
+                "query_key": 1
+                }),
+            stream=True)
+        if not res.ok:
+            raise Exception("HTTP Failure when requesting efetch from IDs: {}: {}".format(res, res.text))
+        metadata = self._parse_efetch_response(res, accessions, columns)
+
+        # Ensure all hits are found, and trim results to just those that are real hits
+        if RUN_ACCESSION_KEY not in metadata.columns:
+            raise Exception("No metadata could be retrieved")
+        if len(metadata) != len(accessions):
+            found_runs = set(metadata[RUN_ACCESSION_KEY].to_list())
+            not_found = list([a for a in accessions if a not in found_runs])
+            logging.warning("Unable to find all accessions. The {} missing ones were: {}".format(
+                len(not_found), not_found
+            ))
         return metadata
-    
+
     def fetch_pubmed_ids_from_term(self, term):
         retmax = 10000
-        res = requests.get(
-            url="https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi",
+        res = self._eutils_request('GET', 'esearch.fcgi',
             params=self.add_api_key({
                 "db": "pubmed",
                 "term": term,
@@ -349,7 +690,7 @@ class SraMetadata:
 
         # Search for the title using the ENA rest API. Found it to be superior to the NCBI esearch e.g. the query 'Metagenomics of Urban Sewage Identifies an Extensively Shared Antibiotic Resistome in China' hits on the PubMed website, but not in the NCBI esearch - unsure why. Worked out of the box with the ENA rest API.
 
-        res = requests.get(
+        res = tracing.http_request('GET',
             url="https://www.ebi.ac.uk/europepmc/webservices/rest/search",
             params={
                 "query": title,
@@ -371,7 +712,7 @@ class SraMetadata:
 
     def fetch_citations_from_query_bioproject(self, bioproject):
 
-        res = requests.get(
+        res = tracing.http_request('GET',
             url="https://www.ebi.ac.uk/europepmc/webservices/rest/search",
             params={
                 "query": bioproject,
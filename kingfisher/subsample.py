@@ -0,0 +1,252 @@
+import gzip
+import logging
+import os
+import random
+
+DEFAULT_SEED = 42
+
+
+class Subsample:
+    '''Which spots of a run to keep. A spot is a single read, or a pair of
+    reads, so that pairs are kept or discarded together. Either the first
+    max_reads spots are kept, of those chosen with probability fraction if
+    that is given, or with reservoir_reads, a uniformly random sample of
+    that many spots, in their original order. Spots are counted across the
+    whole run, whether its reads come as one stream or as several files.
+    Random choices are reproducible given the same seed, but only within a
+    method: the awk program used when extracting from SRA files draws from
+    the random number generator of the installed awk, not Python's, so the
+    same seed chooses different spots when reads are downloaded from ENA.'''
+
+    def __init__(self, max_reads=None, fraction=None, reservoir_reads=None, seed=DEFAULT_SEED):
+        if max_reads is not None and max_reads < 1:
+            raise Exception("The maximum number of reads must be at least 1")
+        if fraction is not None and not 0 < fraction <= 1:
+            raise Exception("The fraction of reads to keep must be greater than 0 and at most 1")
+        if reservoir_reads is not None:
+            if reservoir_reads < 1:
+                raise Exception("The number of reads to sample must be at least 1")
+            if max_reads is not None or fraction is not None:
+                raise Exception("Reservoir sampling cannot be combined with a maximum number or fraction of reads")
+        self.max_reads = max_reads
+        self.fraction = fraction
+        self.reservoir_reads = reservoir_reads
+        self.seed = seed if seed is not None else DEFAULT_SEED
+
+    @staticmethod
+    def from_options(max_reads=None, fraction=None, reservoir_reads=None, seed=None):
+        '''Return a Subsample, or None if no subsampling was asked for.'''
+        if max_reads is None and fraction is None and reservoir_reads is None:
+            return None
+        return Subsample(max_reads, fraction, reservoir_reads, seed)
+
+    def is_prefix(self):
+        '''True if the spots kept can be chosen without reading the whole run
+        i.e. only the first max_reads of the run are needed.'''
+        return self.max_reads is not None and self.fraction is None
+
+    def awk_variables(self):
+        '''Variables for SPLIT_SPOTS_AWK_PROGRAM, as a dict.'''
+        return {
+            'max_reads': self.max_reads or 0,
+            'fraction': self.fraction if self.fraction is not None else 1,
+            'reservoir': self.reservoir_reads or 0,
+            'seed': self.seed,
+        }
+
+    def select(self, spots):
+        '''Yield the spots to keep from an iterable of spots, in their
+        original order. Stops reading spots once max_reads have been kept.'''
+        rng = random.Random(self.seed)
+        if self.reservoir_reads is not None:
+            reservoir = []
+            for (i, spot) in enumerate(spots):
+                if i < self.reservoir_reads:
+                    reservoir.append((i, spot))
+                else:
+                    j = rng.randrange(i + 1)
+                    if j < self.reservoir_reads:
+                        reservoir[j] = (i, spot)
+            for (_, spot) in sorted(reservoir, key=lambda x: x[0]):
+                yield spot
+            return
+
+        num_kept = 0
+        for spot in spots:
+            if self.fraction is not None and rng.random() >= self.fraction:
+                continue
+            yield spot
+            num_kept += 1
+            if self.max_reads is not None and num_kept >= self.max_reads:
+                return
+
+
+def fastq_records(stream):
+    '''Yield each 4-line record of a binary FASTQ stream, as bytes.'''
+    while True:
+        header = stream.readline()
+        if len(header) == 0:
+            return
+        sequence = stream.readline()
+        plus = stream.readline()
+        quality = stream.readline()
+        if len(quality) == 0 or not header.startswith(b'@'):
+            raise Exception("Unexpected FASTQ format, perhaps the file is truncated")
+        yield header + sequence + plus + (quality if quality.endswith(b'\n') else quality + b'\n')
+
+
+def _spots(streams):
+    '''Yield tuples of the records of each stream, one tuple per spot.'''
+    iterators = [fastq_records(s) for s in streams]
+    while True:
+        spot = tuple(next(it, None) for it in iterators)
+        if all(r is None for r in spot):
+            return
+        if any(r is None for r in spot):
+            raise Exception("Paired FASTQ files have different numbers of reads")
+        yield spot
+
+
+def _run_spots(stream_groups):
+    '''Yield (group index, spot) for each spot of a run, reading the groups
+    of stream_groups, each a list of the streams of a pair or a single
+    unpaired file, one after the other. stream_groups may be a generator,
+    so that later groups are only opened once earlier ones are read.'''
+    for (i, streams) in enumerate(stream_groups):
+        for spot in _spots(streams):
+            yield (i, spot)
+
+
+def _to_fasta(record):
+    header, sequence, _ = record.split(b'\n', 2)
+    return b'>' + header[1:] + b'\n' + sequence + b'\n'
+
+
+def _temporary_path(path):
+    '''Return the path to write output to before it is complete. The
+    extension is kept, since it determines the output format.'''
+    return os.path.join(os.path.dirname(path), 'kingfisher-subsample.{}'.format(os.path.basename(path)))
+
+
+def subsample_fastq_streams(stream_groups, output_groups, subsample):
+    '''Subsample the FASTQ of a run read from stream_groups, each a list of
+    the binary streams of a pair or of a single unpaired file, writing the
+    spots kept to the paths of the corresponding list of output_groups.
+    Spots are counted across the whole run, as when the spots of a run are
+    split by kingfisher.fastx.split_spots_command, so that max_reads limits
+    the total kept. Outputs are only written if spots of their group are
+    kept, and any existing file of a group without spots kept is removed.
+    Outputs are written under temporary names and renamed once all spots
+    have been written, so an interrupted subsample never leaves a truncated
+    output. Each output is written as FASTA if its path ends in .fasta or
+    .fasta.gz, and compressed if it ends in .gz. Returns the number of spots
+    kept.'''
+    outputs = {}
+    completed = False
+    try:
+        num_kept = 0
+        for (i, spot) in subsample.select(_run_spots(stream_groups)):
+            if i not in outputs:
+                outputs[i] = []
+                for path in output_groups[i]:
+                    temporary = _temporary_path(path)
+                    outputs[i].append((
+                        gzip.open(temporary, 'wb', compresslevel=6) if path.endswith('.gz') else open(temporary, 'wb'),
+                        path.endswith('.fasta') or path.endswith('.fasta.gz')))
+            for (record, (output, to_fasta)) in zip(spot, outputs[i]):
+                output.write(_to_fasta(record) if to_fasta else record)
+            num_kept += 1
+        completed = True
+    finally:
+        for group in outputs.values():
+            for (output, _) in group:
+                output.close()
+        if not completed:
+            for i in outputs.keys():
+                for path in output_groups[i]:
+                    if os.path.exists(_temporary_path(path)):
+                        os.remove(_temporary_path(path))
+    for (i, group) in enumerate(output_groups):
+        for path in group:
+            if i in outputs:
+                os.replace(_temporary_path(path), path)
+            elif os.path.exists(path):
+                # Not an output of this subsample, e.g. an input being replaced
+                os.remove(path)
+    return num_kept
+
+
+def interleave_fastq_streams(stream_groups, output_stream, output_format, subsample=None):
+    '''Write the FASTQ of a run read from stream_groups, each a list of the
+    binary streams of a pair or of a single unpaired file, to the binary
+    output_stream in output_format, with the reads of each spot
+    consecutive. Reads are written as they are read, so whatever reads
+    output_stream can start on them immediately. Only the spots selected by
+    subsample are written, if it is given, counting spots across the whole
+    run. Returns the number of spots written.'''
+    if output_format not in ('fastq', 'fastq.gz', 'fasta', 'fasta.gz'):
+        raise Exception("Unexpected output format: {}".format(output_format))
+    to_fasta = output_format.startswith('fasta')
+    output = gzip.GzipFile(fileobj=output_stream, mode='wb', compresslevel=6) \
+        if output_format.endswith('.gz') else output_stream
+    spots = _run_spots(stream_groups)
+    if subsample is not None:
+        spots = subsample.select(spots)
+    num_written = 0
+    for (_, spot) in spots:
+        for record in spot:
+            output.write(_to_fasta(record) if to_fasta else record)
+        num_written += 1
+    if output is not output_stream:
+        # Finishes the gzip member without closing output_stream
+        output.close()
+    output_stream.flush()
+    return num_written
+
+
+def subsample_fastq_files(input_groups, output_groups, subsample):
+    '''Subsample the FASTQ files of a run, given as groups as returned by
+    paired_groups, which are gzipped if their paths end in .gz. Outputs may
+    replace inputs of the same name. Returns the number of spots kept.'''
+    opener = lambda p: gzip.open(p, 'rb') if p.endswith('.gz') else open(p, 'rb')
+    inputs = []
+    def open_groups():
+        for group in input_groups:
+            streams = [opener(p) for p in group]
+            inputs.extend(streams)
+            yield streams
+    try:
+        num_kept = subsample_fastq_streams(open_groups(), output_groups, subsample)
+    finally:
+        for f in inputs:
+            f.close()
+    logging.info("Kept {} spot(s) when subsampling {}".format(
+        num_kept, ', '.join([p for group in input_groups for p in group])))
+    return num_kept
+
+
+def paired_groups(paths):
+    '''Group FASTQ files of a run into lists of the files of a pair (ending
+    in _1 and _2 before the extension), which are read together, followed by
+    lists of single unpaired files.'''
+    def pair_key(path):
+        name = os.path.basename(path)
+        stem = name.split('.')[0]
+        if stem.endswith('_1') or stem.endswith('_2'):
+            return os.path.join(os.path.dirname(path), stem[:-2] + name[len(stem):]), stem[-1]
+        return None, None
+    pairs = {}
+    groups = []
+    unpaired = []
+    for path in paths:
+        key, read = pair_key(path)
+        if key is None:
+            unpaired.append([path])
+        else:
+            pairs.setdefault(key, {})[read] = path
+    for (key, reads) in pairs.items():
+        if len(reads) == 2:
+            groups.append([reads['1'], reads['2']])
+        else:
+            unpaired.extend([[p] for p in reads.values()])
+    return groups + unpaired
@@ -0,0 +1,157 @@
+import json
+import logging
+import os
+import re
+import resource
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+import extern
+import requests
+
+# The tracer in use, or None when not tracing. Module level so that external
+# processes and HTTP requests can be traced wherever they are made, without
+# passing a tracer through every function.
+_tracer = None
+
+
+class Tracer:
+    '''Collect spans in the Chrome trace event format, which can be loaded
+    into chrome://tracing or https://ui.perfetto.dev.
+
+    Spans of external processes record the CPU time used by child processes
+    during the span, from getrusage(RUSAGE_CHILDREN), along with the largest
+    resident set size of any child so far. Child usage is only counted once a
+    child has been waited for, and is shared by the whole process, so when
+    several processes run at once their usage is attributed to whichever
+    spans are open when they finish. Spans of HTTP requests record the CPU
+    time of the calling thread.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.pid = os.getpid()
+        self.start_time = time.time()
+        self.events = []
+        self.thread_ids = set()
+        self.lock = threading.Lock()
+
+    def _timestamp(self, t):
+        # Microseconds since tracing started
+        return (t - self.start_time) * 1e6
+
+    def add_span(self, name, category, start_time, end_time, args):
+        thread = threading.current_thread()
+        with self.lock:
+            if thread.ident not in self.thread_ids:
+                self.thread_ids.add(thread.ident)
+                self.events.append({
+                    'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': thread.ident,
+                    'args': {'name': thread.name}})
+            self.events.append({
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': self._timestamp(start_time),
+                'dur': (end_time - start_time) * 1e6,
+                'pid': self.pid,
+                'tid': thread.ident,
+                'args': args,
+            })
+
+    def write(self):
+        with self.lock:
+            events = list(self.events)
+        with open(self.path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        logging.info("Wrote {} trace events to {}".format(len(events), self.path))
+
+
+def start_tracing(path):
+    global _tracer
+    _tracer = Tracer(path)
+
+
+def stop_tracing():
+    '''Stop tracing and write the trace file.'''
+    global _tracer
+    if _tracer is not None:
+        _tracer.write()
+        _tracer = None
+
+
+def is_tracing():
+    return _tracer is not None
+
+
+@contextmanager
+def span(name, category, **args):
+    '''Context manager recording a span of the given name and category, with
+    args shown alongside it. Does nothing when not tracing.'''
+    tracer = _tracer
+    if tracer is None:
+        yield args
+        return
+    if category == 'process':
+        usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    elif hasattr(resource, 'RUSAGE_THREAD'):
+        usage_before = resource.getrusage(resource.RUSAGE_THREAD)
+    else:
+        usage_before = None
+    start_time = time.time()
+    try:
+        yield args
+    except Exception as e:
+        args['error'] = str(e).strip()
+        raise
+    finally:
+        end_time = time.time()
+        if category == 'process':
+            usage_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            args['child_user_cpu_seconds'] = usage_after.ru_utime - usage_before.ru_utime
+            args['child_system_cpu_seconds'] = usage_after.ru_stime - usage_before.ru_stime
+            args['child_max_rss_kb'] = usage_after.ru_maxrss
+        elif usage_before is not None:
+            usage_after = resource.getrusage(resource.RUSAGE_THREAD)
+            args['thread_user_cpu_seconds'] = usage_after.ru_utime - usage_before.ru_utime
+            args['thread_system_cpu_seconds'] = usage_after.ru_stime - usage_before.ru_stime
+        tracer.add_span(name, category, start_time, end_time, args)
+
+
+def program_names(command):
+    '''Names of the programs run by a shell command e.g. "pigz|awk" for
+    "pigz -cd x.gz |awk ..". Used to name the spans of external processes.'''
+    if isinstance(command, list):
+        command = ' '.join(command)
+    names = []
+    for part in re.split(r'\|\|?|&&|;', command):
+        words = part.split()
+        if len(words) > 0 and words[0] not in ('cd', 'set'):
+            names.append(os.path.basename(words[0]))
+    return '|'.join(names) if len(names) > 0 else command
+
+
+def run(command, **kwargs):
+    '''extern.run, traced.'''
+    with span(program_names(command), 'process', command=command):
+        return extern.run(command, **kwargs)
+
+
+def check_call(command, **kwargs):
+    '''subprocess.check_call, traced.'''
+    with span(program_names(command), 'process', command=command):
+        return subprocess.check_call(command, **kwargs)
+
+
+def http_request(method, url, **kwargs):
+    '''requests.request, traced. With stream=True, the span ends once the
+    headers have arrived, and the body is left unread.'''
+    with span('{} {}'.format(method, re.sub(r'^https?://([^/]*).*', r'\1', url)), 'http', url=url) as args:
+        res = requests.request(method, url, **kwargs)
+        args['status'] = res.status_code
+        if kwargs.get('stream', False):
+            args['bytes'] = res.headers.get('Content-Length')
+        else:
+            args['bytes'] = len(res.content)
+        return res
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+
+
+import unittest
+import os.path
+import sys
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from kingfisher.ena import EnaDownloader
+
+# Tests of ENA file reports that do not contact ENA, unlike those in
+# test_ena.py, which are not run in CI.
+class Tests(unittest.TestCase):
+    maxDiff = None
+
+    def test_parse_file_reports(self):
+        text = "run_accession\tfastq_ftp\tfastq_md5\tfastq_bytes\n" \
+            "SRR12118866\tftp.sra.ebi.ac.uk/vol1/fastq/SRR121/066/SRR12118866/SRR12118866_1.fastq.gz;" \
+            "ftp.sra.ebi.ac.uk/vol1/fastq/SRR121/066/SRR12118866/SRR12118866_2.fastq.gz\t" \
+            "aaa;bbb\t100;200\n" \
+            "ERR1346134\t\t\t\n"
+        reports = EnaDownloader.parse_file_reports(text)
+        self.assertEqual(['SRR12118866'], list(reports.keys()))
+        report = reports['SRR12118866']
+        self.assertEqual(['SRR12118866_1.fastq.gz', 'SRR12118866_2.fastq.gz'],
+            [os.path.basename(p) for p in report.file_paths])
+        self.assertEqual(['aaa', 'bbb'], report.md5sums)
+        self.assertEqual([100, 200], report.file_sizes)
+
+        # Prefetched reports are used without querying ENA again
+        downloader = EnaDownloader(file_reports=reports)
+        self.assertIs(report, downloader.get_ftp_download_urls('SRR12118866'))
+
+
+if __name__ == "__main__":
+    unittest.main()
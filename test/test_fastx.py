@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+
+import unittest
+import os.path
+import sys
+import gzip
+import io
+import shutil
+
+import extern
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from bird_tool_utils import in_tempdir
+
+from kingfisher import _convert_fastq_to_fasta
+from kingfisher.fastx import fastq_to_fasta, fastq_block_to_fasta, fastq_blocks, split_spots_command, interleave_spots_command
+from kingfisher.metrics import MetricsRecorder
+
+FASTQ = b'@SRR1.1 1 length=4\nACGT\n+SRR1.1 1 length=4\nIIII\n' \
+    b'@SRR1.2 2 length=3\nA@C\n+\n@@I\n' \
+    b'@SRR1.3 3 length=0\n\n+\n\n' \
+    b'@SRR1.4 4 length=5\nNNNNN\n+\n#####\n'
+FASTA = b'>SRR1.1 1 length=4\nACGT\n' \
+    b'>SRR1.2 2 length=3\nA@C\n' \
+    b'>SRR1.3 3 length=0\n\n' \
+    b'>SRR1.4 4 length=5\nNNNNN\n'
+
+class Tests(unittest.TestCase):
+    maxDiff = None
+
+    def write(self, path, content):
+        with open(path, 'wb') as f:
+            f.write(content)
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_block_to_fasta(self):
+        self.assertEqual(FASTA, fastq_block_to_fasta(FASTQ))
+        self.assertEqual(FASTA, gzip.decompress(fastq_block_to_fasta(FASTQ, True)))
+        self.assertEqual(b'', fastq_block_to_fasta(b''))
+
+    def test_block_to_fasta_bad_format(self):
+        with self.assertRaises(Exception):
+            fastq_block_to_fasta(b'@SRR1.1\nACGT\n+\n')
+        with self.assertRaises(Exception):
+            fastq_block_to_fasta(b'@SRR1.1\nACGT\n+\nIIII\nSRR1.2\nACGT\n+\nIIII\n')
+
+    def test_blocks_split_at_records(self):
+        for block_size in (1, 7, 30, 1000):
+            blocks = list(fastq_blocks(io.BytesIO(FASTQ), block_size))
+            self.assertEqual(FASTQ, b''.join(blocks))
+            for block in blocks:
+                self.assertEqual(0, block.count(b'\n') % 4)
+
+    def test_missing_final_newline(self):
+        self.assertEqual(FASTQ, b''.join(fastq_blocks(io.BytesIO(FASTQ[:-1]))))
+
+    def test_fastq_to_fasta(self):
+        with in_tempdir():
+            self.write('in.fastq', FASTQ * 100)
+            fastq_to_fasta('in.fastq', 'out.fasta', block_size=50)
+            self.assertEqual(FASTA * 100, self.read('out.fasta'))
+
+    def test_fastq_gz_to_fasta_gz_parallel(self):
+        with in_tempdir():
+            with gzip.open('in.fastq.gz', 'wb') as f:
+                f.write(FASTQ * 1000)
+            fastq_to_fasta('in.fastq.gz', 'out.fasta.gz', threads=2, block_size=1000)
+            with gzip.open('out.fasta.gz') as f:
+                self.assertEqual(FASTA * 1000, f.read())
+
+    def test_empty(self):
+        with in_tempdir():
+            self.write('in.fastq', b'')
+            fastq_to_fasta('in.fastq', 'out.fasta.gz')
+            with gzip.open('out.fasta.gz') as f:
+                self.assertEqual(b'', f.read())
+
+    @unittest.skipIf(shutil.which('awk') is None, 'awk is not installed')
+    def test_same_as_awk(self):
+        with in_tempdir():
+            self.write('in.fastq', FASTQ)
+            metrics = MetricsRecorder()
+            _convert_fastq_to_fasta('SRR1', 'in.fastq', 'awk.fasta', 'awk', 1, metrics)
+            _convert_fastq_to_fasta('SRR1', 'in.fastq', 'builtin.fasta', 'builtin', 1, metrics)
+            self.assertEqual(self.read('awk.fasta'), self.read('builtin.fasta'))
+    def split_spots(self, output_format):
+        # As output by fasterq-dump --split-spot, where spot 2 has only one
+        # read
+        interleaved = b'@SRR1.1 1 length=4\nACGT\n+SRR1.1 1 length=4\nIIII\n' \
+            b'@SRR1.1 1 length=4\nTTTT\n+SRR1.1 1 length=4\nJJJJ\n' \
+            b'@SRR1.2 2 length=3\nAAA\n+SRR1.2 2 length=3\nIII\n' \
+            b'@SRR1.3 3 length=2\nCC\n+SRR1.3 3 length=2\nII\n' \
+            b'@SRR1.3 3 length=2\nGG\n+SRR1.3 3 length=2\nII\n'
+        extern.run(split_spots_command(os.path.abspath('SRR1'), output_format, 2), stdin=interleaved)
+
+    @unittest.skipIf(shutil.which('awk') is None, 'awk is not installed')
+    def test_split_spots_fastq(self):
+        with in_tempdir():
+            self.split_spots('fastq')
+            self.assertEqual(b'@SRR1.1 1 length=4\nACGT\n+SRR1.1 1 length=4\nIIII\n@SRR1.3 3 length=2\nCC\n+SRR1.3 3 length=2\nII\n',
+                self.read('SRR1_1.fastq'))
+            self.assertEqual(b'@SRR1.1 1 length=4\nTTTT\n+SRR1.1 1 length=4\nJJJJ\n@SRR1.3 3 length=2\nGG\n+SRR1.3 3 length=2\nII\n',
+                self.read('SRR1_2.fastq'))
+            self.assertEqual(b'@SRR1.2 2 length=3\nAAA\n+SRR1.2 2 length=3\nIII\n', self.read('SRR1.fastq'))
+
+    @unittest.skipIf(shutil.which('awk') is None, 'awk is not installed')
+    def test_split_spots_fasta(self):
+        with in_tempdir():
+            self.split_spots('fasta')
+            self.assertEqual(b'>SRR1.1 1 length=4\nACGT\n>SRR1.3 3 length=2\nCC\n', self.read('SRR1_1.fasta'))
+            self.assertEqual(b'>SRR1.1 1 length=4\nTTTT\n>SRR1.3 3 length=2\nGG\n', self.read('SRR1_2.fasta'))
+            self.assertEqual(b'>SRR1.2 2 length=3\nAAA\n', self.read('SRR1.fasta'))
+
+    @unittest.skipIf(shutil.which('awk') is None or shutil.which('pigz') is None, 'awk or pigz is not installed')
+    def test_split_spots_fasta_gz(self):
+        with in_tempdir():
+            self.split_spots('fasta.gz')
+            with gzip.open('SRR1_2.fasta.gz') as f:
+                self.assertEqual(b'>SRR1.1 1 length=4\nTTTT\n>SRR1.3 3 length=2\nGG\n', f.read())
+
+    @unittest.skipIf(shutil.which('awk') is None, 'awk is not installed')
+    def test_interleave_spots_fasta(self):
+        with in_tempdir():
+            interleaved = b'@SRR1.1 1 length=4\nACGT\n+SRR1.1 1 length=4\nIIII\n' \
+                b'@SRR1.1 1 length=4\nTTTT\n+SRR1.1 1 length=4\nJJJJ\n' \
+                b'@SRR1.2 2 length=3\nAAA\n+SRR1.2 2 length=3\nIII\n'
+            self.assertEqual(b'>SRR1.1 1 length=4\nACGT\n>SRR1.1 1 length=4\nTTTT\n>SRR1.2 2 length=3\nAAA\n',
+                extern.run(interleave_spots_command('fasta', 1), stdin=interleaved).encode())
+            self.assertEqual(interleaved, extern.run(interleave_spots_command('fastq', 1), stdin=interleaved).encode())
+            self.assertEqual([], os.listdir('.'))
+
+    @unittest.skipIf(shutil.which('awk') is None, 'awk is not installed')
+    def test_split_spots_truncated(self):
+        with in_tempdir():
+            with self.assertRaises(extern.ExternCalledProcessError):
+                extern.run(split_spots_command(os.path.abspath('SRR1'), 'fasta', 1), stdin=b'@SRR1.1\nACGT\n')
+
+if __name__ == "__main__":
+    unittest.main()
@@ -147,21 +147,17 @@ class Tests(unittest.TestCase):
             self.assertFalse(os.path.exists('outdir/SRR12118866.fasta'))
 
     def test_unsorted_extract_file_outputs_fasta_gz(self):
-        sra = f"test/data/SRR12118866.sra"
-
-        if os.path.exists('SRR12118866_1.fasta.gz'):
-            os.remove('SRR12118866_1.fasta.gz')
-        if os.path.exists('SRR12118866_2.fasta.gz'):
-            os.remove('SRR12118866_2.fasta.gz')
-
-        cmd = '{} extract --sra {} --output-format-possibilities fasta.gz --unsorted'.format(kingfisher, sra)
-        # For reasons I don't understand, running this via extern hangs when running this test specifically on b2
-        subprocess.check_call(cmd.split(' ')) 
-        self.assertEqual('fb284c28aac4513249b196ec75dc3c8d  -\n', extern.run('pigz -cd SRR12118866_1.fasta.gz |md5sum'))
-        self.assertEqual('311f8898bd6d575ae3ec6a7188b08836  -\n', extern.run('pigz -cd SRR12118866_2.fasta.gz |md5sum'))
-        self.assertFalse(os.path.exists('SRR12118866.fasta.gz'))
-        os.remove('SRR12118866_1.fasta.gz')
-        os.remove('SRR12118866_2.fasta.gz')
+        sra = os.path.abspath(f"test/data/SRR12118866.sra")
+
+        # The FIFOs and outputs are written to the working directory, so
+        # leave nothing behind in the repository if extraction fails.
+        with in_tempdir():
+            cmd = '{} extract --sra {} --output-format-possibilities fasta.gz --unsorted'.format(kingfisher, sra)
+            # For reasons I don't understand, running this via extern hangs when running this test specifically on b2
+            subprocess.check_call(cmd.split(' ')) 
+            self.assertEqual('fb284c28aac4513249b196ec75dc3c8d  -\n', extern.run('pigz -cd SRR12118866_1.fasta.gz |md5sum'))
+            self.assertEqual('311f8898bd6d575ae3ec6a7188b08836  -\n', extern.run('pigz -cd SRR12118866_2.fasta.gz |md5sum'))
+            self.assertFalse(os.path.exists('SRR12118866.fasta.gz'))
 
     def test_unsorted_extract_file_outputs_fasta_gz_output_directory(self):
         sra = os.path.abspath(f"test/data/SRR12118866.sra")
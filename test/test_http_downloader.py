@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+
+import unittest
+import os.path
+import sys
+import re
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from bird_tool_utils import in_tempdir
+
+from kingfisher.http_downloader import RangedHttpDownloader
+from kingfisher.exception import DownloadMethodFailed
+
+CONTENT = bytes(range(256)) * 1000
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    '''Serves CONTENT, optionally supporting range requests and failing
+    requests for given ranges, as configured on the server by the tests.'''
+    def log_message(self, format, *args):
+        pass
+
+    def _send_headers(self, status, length, content_range=None):
+        self.send_response(status)
+        self.send_header('Content-Length', str(length))
+        if self.server.accept_ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        if content_range is not None:
+            self.send_header('Content-Range', content_range)
+        self.end_headers()
+
+    def do_HEAD(self):
+        self._send_headers(200, len(CONTENT))
+
+    def do_GET(self):
+        range_header = self.headers.get('Range')
+        if range_header is None or not self.server.accept_ranges:
+            self._send_headers(200, len(CONTENT))
+            self.wfile.write(CONTENT)
+            return
+        m = re.match(r'bytes=(\d+)-(\d+)', range_header)
+        start, end = int(m[1]), int(m[2])
+        with self.server.lock:
+            self.server.requested_ranges.append((start, end))
+            fail = start in self.server.fail_starts
+        if fail:
+            self.send_error(500)
+            return
+        self._send_headers(206, end - start + 1, 'bytes {}-{}/{}'.format(start, end, len(CONTENT)))
+        self.wfile.write(CONTENT[start:end+1])
+
+
+class Tests(unittest.TestCase):
+    maxDiff = None
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        self.server.accept_ranges = True
+        self.server.fail_starts = set()
+        self.server.requested_ranges = []
+        self.server.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{}/SRR1'.format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_ranged_download(self):
+        with in_tempdir():
+            downloader = RangedHttpDownloader(4, chunk_size=10000, show_progress=False)
+            self.assertEqual((len(CONTENT), None), downloader.download(self.url, 'SRR1.sra'))
+            self.assertEqual(CONTENT, self.read('SRR1.sra'))
+            self.assertEqual(26, len(self.server.requested_ranges))
+            self.assertFalse(os.path.exists(RangedHttpDownloader.progress_path('SRR1.sra')))
+
+    def test_md5_calculated_during_download(self):
+        with in_tempdir():
+            downloader = RangedHttpDownloader(4, chunk_size=10000, show_progress=False)
+            _, md5sum = downloader.download(self.url, 'SRR1.sra', calculate_md5=True)
+            self.assertEqual(hashlib.md5(CONTENT).hexdigest(), md5sum)
+
+    def test_md5_calculated_without_ranges(self):
+        self.server.accept_ranges = False
+        with in_tempdir():
+            downloader = RangedHttpDownloader(4, chunk_size=10000, show_progress=False)
+            _, md5sum = downloader.download(self.url, 'SRR1.sra', calculate_md5=True)
+            self.assertEqual(hashlib.md5(CONTENT).hexdigest(), md5sum)
+
+    def test_server_without_ranges(self):
+        self.server.accept_ranges = False
+        with in_tempdir():
+            RangedHttpDownloader(4, chunk_size=10000, show_progress=False).download(self.url, 'SRR1.sra')
+            self.assertEqual(CONTENT, self.read('SRR1.sra'))
+            self.assertEqual([], self.server.requested_ranges)
+
+    def test_resume_fetches_only_missing_ranges(self):
+        self.server.fail_starts = set([50000])
+        with in_tempdir():
+            downloader = RangedHttpDownloader(2, chunk_size=10000, show_progress=False)
+            with self.assertRaises(DownloadMethodFailed):
+                downloader.download(self.url, 'SRR1.sra')
+            self.assertTrue(os.path.exists(RangedHttpDownloader.progress_path('SRR1.sra')))
+
+            self.server.fail_starts = set()
+            self.server.requested_ranges = []
+            _, md5sum = downloader.download(self.url, 'SRR1.sra', resume=True, calculate_md5=True)
+            self.assertEqual(CONTENT, self.read('SRR1.sra'))
+            self.assertEqual(hashlib.md5(CONTENT).hexdigest(), md5sum)
+            self.assertIn((50000, 59999), self.server.requested_ranges)
+            self.assertNotIn((0, 9999), self.server.requested_ranges)
+
+
+if __name__ == "__main__":
+    unittest.main()
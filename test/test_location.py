@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+
+import unittest
+import os.path
+import sys
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+import json
+import time
+import datetime
+
+from bird_tool_utils import in_tempdir
+
+from kingfisher.location import NcbiLocationJson, LocationCache
+
+def location_json():
+    return {
+        'version': '2',
+        'result': [{
+            'bundle': 'SRR1',
+            'status': 200,
+            'files': [
+                {
+                    'object': 'srapub_files|SRR1',
+                    'type': 'sra',
+                    'name': 'SRR1',
+                    'size': 1000,
+                    'md5': 'aaa',
+                    'locations': [{
+                        'service': 's3',
+                        'region': 'us-east-1',
+                        'link': 'https://sra-pub-run-odp.s3.amazonaws.com/sra/SRR1/SRR1',
+                    }],
+                },
+                {
+                    'object': 'srapub_files|SRR1.noqual',
+                    'type': 'sra',
+                    'name': 'SRR1.noqual',
+                    'size': 400,
+                    'md5': 'bbb',
+                    'locations': [{
+                        'service': 's3',
+                        'region': 'us-east-1',
+                        'link': 'https://sra-pub-run-odp.s3.amazonaws.com/sra/SRR1/SRR1.lite.1',
+                    }],
+                },
+            ]
+        }]
+    }
+
+class Tests(unittest.TestCase):
+    maxDiff = None
+
+    def test_noqual_preferred(self):
+        locations = NcbiLocationJson(location_json()).object_locations_of_types(
+            [NcbiLocationJson.OBJECT_TYPE_SRA_NOQUAL, NcbiLocationJson.OBJECT_TYPE_SRA],
+            NcbiLocationJson.AWS_SERVICE, False)
+        self.assertEqual(['bbb','aaa'], [l.md5sum() for l in locations])
+        self.assertEqual([True, False], [l.is_noqual() for l in locations])
+        self.assertEqual([400, 1000], [l.size() for l in locations])
+
+    def test_full_object_only(self):
+        locations = NcbiLocationJson(location_json()).object_locations_of_types(
+            [NcbiLocationJson.OBJECT_TYPE_SRA], NcbiLocationJson.AWS_SERVICE, False)
+        self.assertEqual(['aaa'], [l.md5sum() for l in locations])
+
+    def test_s3_command_prefix(self):
+        locations = NcbiLocationJson(location_json()).object_locations_of_types(
+            [NcbiLocationJson.OBJECT_TYPE_SRA_NOQUAL, NcbiLocationJson.OBJECT_TYPE_SRA],
+            NcbiLocationJson.AWS_SERVICE, False)
+        self.assertEqual(
+            'aws s3 cp --no-sign-request s3://sra-pub-run-odp/sra/SRR1/SRR1.lite.1',
+            locations[0].s3_command_prefix('SRR1'))
+        self.assertEqual(
+            'aws s3 cp --no-sign-request s3://sra-pub-run-odp/sra/SRR1/SRR1',
+            locations[1].s3_command_prefix('SRR1'))
+
+    def test_cache(self):
+        with in_tempdir():
+            cache = LocationCache('cache', 1)
+            self.assertIsNone(cache.get('SRR1'))
+            cache.put('SRR1', location_json())
+            self.assertEqual(location_json(), cache.get('SRR1'))
+            self.assertIsNone(cache.get('SRR2'))
+
+    def test_cache_ttl(self):
+        with in_tempdir():
+            cache = LocationCache('cache', 1)
+            cache.put('SRR1', location_json())
+            path = cache._path('SRR1')
+            with open(path) as f:
+                entry = json.load(f)
+            entry['fetched'] = time.time() - 2*3600
+            with open(path, 'w') as f:
+                json.dump(entry, f)
+            self.assertIsNone(cache.get('SRR1'))
+
+    def test_cache_signed_link_expiry(self):
+        with in_tempdir():
+            cache = LocationCache('cache', 24)
+            j = location_json()
+            soon = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(minutes=10)
+            j['result'][0]['files'][0]['locations'][0]['expirationDate'] = soon.strftime('%Y-%m-%dT%H:%M:%SZ')
+            cache.put('SRR1', j)
+            self.assertIsNone(cache.get('SRR1'))
+
+            later = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=1)
+            j['result'][0]['files'][0]['locations'][0]['expirationDate'] = later.strftime('%Y-%m-%dT%H:%M:%SZ')
+            cache.put('SRR1', j)
+            self.assertEqual(j, cache.get('SRR1'))
+
+    def test_cache_ignores_errors(self):
+        with in_tempdir():
+            cache = LocationCache('cache', 1)
+            cache.put('SRR1', {'version': '2', 'result': [{'bundle': 'SRR1', 'status': 404, 'msg': 'not found'}]})
+            self.assertIsNone(cache.get('SRR1'))
+
+
+    def test_cache_unwritable(self):
+        with in_tempdir():
+            # A file where the cache directory should be, which cannot be
+            # created even by root
+            with open('cache', 'w') as f:
+                f.write('not a directory')
+            cache = LocationCache('cache', 1)
+            cache.put('SRR1', location_json())
+            self.assertTrue(cache.unwritable)
+            self.assertIsNone(cache.get('SRR1'))
+
+
+if __name__ == "__main__":
+    unittest.main()
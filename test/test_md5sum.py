@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+
+import unittest
+import os
+import os.path
+import sys
+import hashlib
+import tempfile
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from kingfisher.md5sum import MD5, FollowingMD5
+from kingfisher import _downloaded_md5sum_ok
+
+CONTENT = os.urandom(10 * 1024 * 1024 + 17)
+CONTENT_MD5 = hashlib.md5(CONTENT).hexdigest()
+
+class Tests(unittest.TestCase):
+    maxDiff = None
+
+    def test_check_md5sum(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(CONTENT)
+            f.flush()
+            self.assertTrue(MD5.check_md5sum(f.name, CONTENT_MD5))
+            self.assertFalse(MD5.check_md5sum(f.name, 'd41d8cd98f00b204e9800998ecf8427e'))
+
+    def test_check_md5sum_in_background(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(CONTENT)
+            f.flush()
+            self.assertTrue(MD5.check_md5sum_in_background(f.name, CONTENT_MD5).result())
+            self.assertFalse(MD5.check_md5sum_in_background(f.name, 'wrong').result())
+
+    def test_following_md5_out_of_order(self):
+        ranges = [(0, 999999), (1000000, 4999999), (5000000, len(CONTENT)-1)]
+        with tempfile.TemporaryFile() as f:
+            fd = f.fileno()
+            os.ftruncate(fd, len(CONTENT))
+            follower = FollowingMD5(fd, ranges)
+            for i in [2, 0, 1]:
+                start, end = ranges[i]
+                middle = (start + end) // 2
+                os.pwrite(fd, CONTENT[start:middle], start)
+                follower.update(i, middle)
+                os.pwrite(fd, CONTENT[middle:end+1], middle)
+                follower.update(i, end+1)
+            self.assertEqual(CONTENT_MD5, follower.hexdigest())
+
+    def test_downloaded_md5sum_ok(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(CONTENT)
+            f.flush()
+            # Read again, as after a download with aria2c or curl
+            self.assertTrue(_downloaded_md5sum_ok(f.name, CONTENT_MD5))
+            self.assertFalse(_downloaded_md5sum_ok(f.name, '0' * 32))
+            # Calculated during the download, so not read again
+            self.assertTrue(_downloaded_md5sum_ok('/nonexistent', CONTENT_MD5, CONTENT_MD5))
+            self.assertFalse(_downloaded_md5sum_ok('/nonexistent', CONTENT_MD5, '0' * 32))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+
+import unittest
+import os.path
+import sys
+import json
+import subprocess
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from bird_tool_utils import in_tempdir
+
+import kingfisher
+from kingfisher.ena import EnaDownloader
+from kingfisher.metrics import MetricsRecorder, PhaseRecord
+
+class Tests(unittest.TestCase):
+    maxDiff = None
+
+    def test_json_lines(self):
+        with in_tempdir():
+            with open('SRR1.sra', 'w') as f:
+                f.write('x' * 100)
+            metrics = MetricsRecorder('metrics.jsonl')
+            with metrics.phase('SRR1', 'download', 'aws-http') as record:
+                record.add_file_sizes(['SRR1.sra', 'missing'])
+            with self.assertRaises(subprocess.CalledProcessError):
+                with metrics.phase('SRR1', 'convert', 'fasterq-dump'):
+                    raise subprocess.CalledProcessError(3, 'fasterq-dump')
+            record = PhaseRecord('SRR2', 'download', 'ena-ftp')
+            record.fail('Method ena-ftp failed')
+            metrics.record(record)
+            metrics.close()
+
+            with open('metrics.jsonl') as f:
+                records = [json.loads(line) for line in f]
+            self.assertEqual(3, len(records))
+            self.assertEqual(
+                ('SRR1', 'download', 'aws-http', 'ok', 0, 100),
+                tuple(records[0][k] for k in ['run', 'phase', 'method', 'status', 'exit_status', 'bytes']))
+            self.assertTrue(records[0]['wall_seconds'] >= 0)
+            self.assertEqual(('failed', 3), (records[1]['status'], records[1]['exit_status']))
+            self.assertIsNone(records[1]['throughput_mb_per_second'])
+            self.assertEqual(('SRR2', 'failed', 'Method ena-ftp failed'),
+                (records[2]['run'], records[2]['status'], records[2]['error']))
+
+    def test_prometheus_file(self):
+        with in_tempdir():
+            metrics = MetricsRecorder(prometheus_file='kingfisher.prom')
+            for _ in range(2):
+                with metrics.phase('SRR1', 'download', 'aws-http') as record:
+                    record.num_bytes = 1000
+            with open('kingfisher.prom') as f:
+                lines = f.read().splitlines()
+            self.assertTrue('kingfisher_phase_runs_total{phase="download",method="aws-http",status="ok"} 2' in lines)
+            self.assertTrue('kingfisher_phase_bytes_total{phase="download",method="aws-http",status="ok"} 2000' in lines)
+            self.assertTrue('# TYPE kingfisher_phase_seconds_total counter' in lines)
+            # No temporary files are left behind
+            self.assertEqual(['kingfisher.prom'], os.listdir('.'))
+            metrics.close()
+
+
+    def test_failed_ena_resolve_skips_method(self):
+        with in_tempdir():
+            metrics = MetricsRecorder('metrics.jsonl')
+            # ENA has no files for the run, so ena-ftp is not attempted, and
+            # the next method is tried.
+            with self.assertRaisesRegex(Exception, 'Unknown method'):
+                kingfisher.download_and_extract_one_run('SRR1',
+                    download_methods=['ena-ftp', 'not-a-method'],
+                    ena_downloader=EnaDownloader(file_reports={'SRR1': False}),
+                    metrics=metrics)
+            metrics.close()
+            with open('metrics.jsonl') as f:
+                records = [json.loads(line) for line in f]
+            self.assertEqual([('resolve', 'ena-ftp', 'failed')],
+                [(r['phase'], r['method'], r['status']) for r in records])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+
+
+import unittest
+import os.path
+import sys
+import threading
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from kingfisher.rate_limiter import TokenBucket
+
+
+class FakeClock:
+    '''A clock which only moves when slept on.'''
+    def __init__(self):
+        self.now = 0.0
+        self.lock = threading.Lock()
+
+    def time(self):
+        with self.lock:
+            return self.now
+
+    def sleep(self, seconds):
+        with self.lock:
+            self.now += seconds
+
+
+class Tests(unittest.TestCase):
+    def test_rate(self):
+        clock = FakeClock()
+        bucket = TokenBucket(3, clock=clock.time, sleep=clock.sleep)
+        waits = [bucket.acquire() for _ in range(4)]
+        self.assertEqual(0, waits[0])
+        for w in waits[1:]:
+            self.assertAlmostEqual(1/3, w)
+        self.assertAlmostEqual(1, clock.now)
+
+    def test_tokens_accrue_when_idle(self):
+        clock = FakeClock()
+        bucket = TokenBucket(10, capacity=2, clock=clock.time, sleep=clock.sleep)
+        bucket.acquire()
+        bucket.acquire()
+        clock.sleep(60)
+        # Only capacity tokens accrue however long the wait
+        self.assertEqual([0, 0], [bucket.acquire(), bucket.acquire()])
+        self.assertAlmostEqual(0.1, bucket.acquire())
+
+    def test_threads(self):
+        clock = FakeClock()
+        bucket = TokenBucket(5, clock=clock.time, sleep=lambda seconds: None)
+        waits = []
+        lock = threading.Lock()
+        def acquire():
+            w = bucket.acquire()
+            with lock:
+                waits.append(w)
+        threads = [threading.Thread(target=acquire) for _ in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # Each thread reserves the next token in turn
+        self.assertEqual([round(i * 0.2, 6) for i in range(10)], [round(w, 6) for w in sorted(waits)])
+
+    def test_invalid(self):
+        with self.assertRaises(Exception):
+            TokenBucket(0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+
+import unittest
+import os.path
+import sys
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from bird_tool_utils import in_tempdir
+
+from kingfisher.resume import DownloadJournal
+
+class Tests(unittest.TestCase):
+    maxDiff = None
+
+    def write(self, path, content):
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def test_fresh_download(self):
+        with in_tempdir():
+            journal = DownloadJournal('SRR1.sra')
+            self.assertFalse(journal.prepare('https://example.com/SRR1', 'curl', 100, 'abc'))
+            self.assertTrue(DownloadJournal.is_incomplete('SRR1.sra'))
+            journal.complete()
+            self.assertFalse(DownloadJournal.is_incomplete('SRR1.sra'))
+
+    def test_resume_same_source(self):
+        with in_tempdir():
+            DownloadJournal('SRR1.sra').prepare('https://example.com/SRR1', 'curl', 100, 'abc')
+            self.write('SRR1.sra', 'partial')
+            self.assertTrue(DownloadJournal('SRR1.sra').prepare('https://example.com/SRR1', 'curl', 100, 'abc'))
+            self.assertTrue(os.path.exists('SRR1.sra'))
+
+    def test_restart_when_source_differs(self):
+        with in_tempdir():
+            DownloadJournal('SRR1.sra').prepare('https://example.com/SRR1', 'curl')
+            self.write('SRR1.sra', 'partial')
+            self.assertFalse(DownloadJournal('SRR1.sra').prepare('https://example.com/other', 'curl'))
+            self.assertFalse(os.path.exists('SRR1.sra'))
+
+    def test_restart_when_downloader_differs(self):
+        with in_tempdir():
+            DownloadJournal('SRR1.sra').prepare('https://example.com/SRR1', 'aria2c')
+            self.write('SRR1.sra', 'partial')
+            self.assertFalse(DownloadJournal('SRR1.sra').prepare('https://example.com/SRR1', 'curl'))
+            self.assertFalse(os.path.exists('SRR1.sra'))
+
+    def test_restart_when_larger_than_expected(self):
+        with in_tempdir():
+            DownloadJournal('SRR1.sra').prepare('https://example.com/SRR1', 'curl', 3)
+            self.write('SRR1.sra', 'partial')
+            self.assertFalse(DownloadJournal('SRR1.sra').prepare('https://example.com/SRR1', 'curl', 3))
+
+    def test_restart_without_control_file(self):
+        with in_tempdir():
+            DownloadJournal('SRR1.sra').prepare('https://example.com/SRR1', 'aria2c')
+            self.write('SRR1.sra', 'partial')
+            self.assertFalse(DownloadJournal('SRR1.sra').prepare(
+                'https://example.com/SRR1', 'aria2c', resume_requires='SRR1.sra.aria2'))
+            self.write('SRR1.sra', 'partial')
+            self.write('SRR1.sra.aria2', 'control')
+            self.assertTrue(DownloadJournal('SRR1.sra').prepare(
+                'https://example.com/SRR1', 'aria2c', resume_requires='SRR1.sra.aria2'))
+
+    def test_unknown_file_removed(self):
+        with in_tempdir():
+            self.write('SRR1.sra', 'stale')
+            self.assertFalse(DownloadJournal('SRR1.sra').prepare('https://example.com/SRR1', 'curl'))
+            self.assertFalse(os.path.exists('SRR1.sra'))
+
+    def test_discard(self):
+        with in_tempdir():
+            journal = DownloadJournal('SRR1.sra')
+            journal.prepare('https://example.com/SRR1', 'curl')
+            self.write('SRR1.sra', 'bad')
+            journal.discard()
+            self.assertFalse(os.path.exists('SRR1.sra'))
+            self.assertFalse(DownloadJournal.is_incomplete('SRR1.sra'))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+
+import unittest
+import os.path
+import sys
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from kingfisher.run_sizes import RunSize, parse_size, order_largest_first
+
+class Tests(unittest.TestCase):
+    maxDiff = None
+
+    def test_parse_size(self):
+        self.assertEqual(500 * 1024**3, parse_size('500G'))
+        self.assertEqual(1536, parse_size('1.5k'))
+        self.assertEqual(2 * 1024**4, parse_size('2TiB'))
+        self.assertEqual(100, parse_size('100'))
+        with self.assertRaises(Exception):
+            parse_size('lots')
+
+    def test_scratch_bytes(self):
+        size = RunSize('SRR1', 1000, 2000, 10)
+        self.assertEqual(1000, size.scratch_bytes(['sra']))
+        self.assertEqual(1000 + 2 * (4000 + 1000), size.scratch_bytes(['fastq', 'fastq.gz']))
+        # Streamed into compression, so no uncompressed FASTQ output
+        self.assertEqual(1000 + 5000 + int(5000 * 0.3), size.scratch_bytes(['fastq.gz']))
+        self.assertEqual(1000 + 5000 + (2000 + 500), size.scratch_bytes(['fasta']))
+        self.assertEqual(1000 + 5000 + int(2500 * 0.3), size.scratch_bytes(['fasta.gz']))
+        self.assertIsNone(RunSize('SRR1', 1000, None, None).scratch_bytes(['fasta']))
+
+    def test_order_largest_first(self):
+        sizes = {
+            'small': RunSize('small', 10, None, None),
+            'big': RunSize('big', 1000, None, None),
+            'medium': RunSize('medium', 100, None, None),
+        }
+        self.assertEqual(['big', 'medium', 'small', 'unknown1', 'unknown2'],
+            order_largest_first(['unknown1', 'small', 'big', 'unknown2', 'medium'], sizes, ['sra']))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+
+import unittest
+import os.path
+import sys
+import threading
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from bird_tool_utils import in_tempdir
+
+import kingfisher
+from kingfisher.run_state import RunStateDatabase
+
+class Tests(unittest.TestCase):
+    maxDiff = None
+
+    def test_record_and_reopen(self):
+        with in_tempdir():
+            db = RunStateDatabase('.')
+            self.assertIsNone(db.get('SRR1'))
+            db.record('SRR1', RunStateDatabase.PHASE_RESOLVED, method='aws-http')
+            db.record('SRR1', RunStateDatabase.PHASE_VERIFIED,
+                downloaded_files=['./SRR1.sra'], downloaded_bytes=100, md5sums=['abc'], download_seconds=1.5)
+            db.close()
+
+            db = RunStateDatabase('.')
+            state = db.get('SRR1')
+            self.assertEqual(RunStateDatabase.PHASE_VERIFIED, state.phase)
+            self.assertEqual('aws-http', state.method)
+            self.assertEqual(['./SRR1.sra'], state.downloaded_files)
+            self.assertEqual(100, state.downloaded_bytes)
+            self.assertEqual(['abc'], state.md5sums)
+            self.assertIsNone(state.output_files)
+
+            db.forget('SRR1')
+            self.assertIsNone(db.get('SRR1'))
+            db.close()
+
+    def test_unexpected_column(self):
+        with in_tempdir():
+            db = RunStateDatabase('.')
+            with self.assertRaises(Exception):
+                db.record('SRR1', RunStateDatabase.PHASE_RESOLVED, colour='blue')
+            db.close()
+
+    def test_concurrent_records(self):
+        with in_tempdir():
+            db = RunStateDatabase('.')
+            def record(i):
+                db.record('SRR{}'.format(i), RunStateDatabase.PHASE_EXTRACTED, output_files=['{}.fasta'.format(i)])
+            threads = [threading.Thread(target=record, args=(i,)) for i in range(20)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            for i in range(20):
+                self.assertEqual(['{}.fasta'.format(i)], db.get('SRR{}'.format(i)).output_files)
+            db.close()
+
+    def test_extracted_runs_are_skipped(self):
+        with in_tempdir():
+            db = RunStateDatabase('.')
+            db.record('SRR1', RunStateDatabase.PHASE_EXTRACTED, output_files=['./SRR1.fasta'])
+            db.close()
+            # No download is attempted, so the unknown download method is not
+            # reached.
+            kingfisher.download_and_extract(
+                run_identifiers=['SRR1'],
+                run_identifiers_file=None,
+                download_methods=['not-a-method'],
+                output_format_possibilities=['fasta'],
+                location_cache_ttl=0,
+                run_state_database=True)
+
+    def test_downloaded_runs_are_only_extracted(self):
+        with in_tempdir():
+            with open('SRR1.sra', 'w') as f:
+                f.write('sra')
+            db = RunStateDatabase('.')
+            sra = os.path.abspath('SRR1.sra')
+            db.record('SRR1', RunStateDatabase.PHASE_DOWNLOADED, method='prefetch', downloaded_files=[sra])
+            db.close()
+            kingfisher.download_and_extract(
+                run_identifiers=['SRR1'],
+                run_identifiers_file=None,
+                download_methods=['not-a-method'],
+                output_format_possibilities=['sra'],
+                location_cache_ttl=0,
+                run_state_database=True)
+            db = RunStateDatabase('.')
+            state = db.get('SRR1')
+            self.assertEqual(RunStateDatabase.PHASE_EXTRACTED, state.phase)
+            self.assertEqual([sra], state.output_files)
+            db.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
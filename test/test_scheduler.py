@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+
+import unittest
+import os.path
+import sys
+import threading
+import time
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+import kingfisher
+from kingfisher.scheduler import RunScheduler
+
+class Tests(unittest.TestCase):
+    maxDiff = None
+
+    def test_all_runs_extracted(self):
+        extracted = []
+        lock = threading.Lock()
+        def extract(downloaded):
+            with lock:
+                extracted.append(downloaded)
+        failures = RunScheduler(lambda run: run + '.sra', extract, 3, 2).run(['A','B','C','D','E'])
+        self.assertEqual([], failures)
+        self.assertEqual(['A.sra','B.sra','C.sra','D.sra','E.sra'], sorted(extracted))
+
+    def test_runs_read_lazily(self):
+        started = []
+        given = []
+        def runs():
+            for run in ['A', 'B', 'C']:
+                # Runs are only asked for once a download worker is free
+                self.assertEqual(given, started)
+                given.append(run)
+                yield run
+        def download(run):
+            started.append(run)
+            return run
+        failures = RunScheduler(download, lambda run: None, 1, 1).run(runs())
+        self.assertEqual([], failures)
+        self.assertEqual(['A', 'B', 'C'], started)
+
+    def test_failure_reading_runs_raised(self):
+        extracted = []
+        def runs():
+            yield 'A'
+            yield 'B'
+            raise Exception("lookup failed")
+        with self.assertRaisesRegex(Exception, 'lookup failed'):
+            RunScheduler(lambda run: run, extracted.append, 2, 1).run(runs())
+        # Runs already given are still processed
+        self.assertEqual(['A', 'B'], sorted(extracted))
+
+    def test_failures_do_not_block_other_runs(self):
+        extracted = []
+        def download(run):
+            if run == 'bad_download':
+                raise Exception("download failed")
+            if run == 'slow':
+                time.sleep(0.2)
+            return run
+        def extract(run):
+            if run == 'bad_extract':
+                raise Exception("extract failed")
+            extracted.append(run)
+        failures = RunScheduler(download, extract, 2, 1).run(
+            ['slow','bad_download','good1','bad_extract','good2'])
+        self.assertEqual(['good1','good2','slow'], sorted(extracted))
+        self.assertEqual(
+            [('bad_download','download'), ('bad_extract','extraction')],
+            sorted([(f.run_identifier, f.phase) for f in failures]))
+
+    def test_download_workers_bounded(self):
+        active = [0]
+        max_active = [0]
+        lock = threading.Lock()
+        def download(run):
+            with lock:
+                active[0] += 1
+                max_active[0] = max(max_active[0], active[0])
+            time.sleep(0.05)
+            with lock:
+                active[0] -= 1
+            return run
+        RunScheduler(download, lambda run: None, 3, 1).run([str(i) for i in range(12)])
+        self.assertEqual(3, max_active[0])
+
+    def test_queue_depth_caps_waiting_downloads(self):
+        lock = threading.Lock()
+        downloaded_not_extracted = [0]
+        max_waiting = [0]
+        def download(run):
+            with lock:
+                downloaded_not_extracted[0] += 1
+                max_waiting[0] = max(max_waiting[0], downloaded_not_extracted[0])
+            return run
+        def extract(run):
+            time.sleep(0.05)
+            with lock:
+                downloaded_not_extracted[0] -= 1
+        failures = RunScheduler(download, extract, 1, 1, queue_depth=1).run([str(i) for i in range(8)])
+        self.assertEqual([], failures)
+        # One being extracted, one waiting in the queue and one finished
+        # downloading but blocked on the queue.
+        self.assertEqual(3, max_waiting[0])
+
+    def test_nothing_to_extract(self):
+        extracted = []
+        failures = RunScheduler(lambda run: None, extracted.append, 2, 2).run(['A','B'])
+        self.assertEqual([], failures)
+        self.assertEqual([], extracted)
+
+    def test_scratch_budget(self):
+        lock = threading.Lock()
+        in_use = [0]
+        max_in_use = [0]
+        started = []
+        costs = {'A': 60, 'B': 50, 'C': 30, 'D': 10, 'E': 10}
+        def download(run):
+            with lock:
+                in_use[0] += costs[run]
+                max_in_use[0] = max(max_in_use[0], in_use[0])
+                started.append(run)
+            time.sleep(0.05)
+            return run
+        def extract(run):
+            time.sleep(0.05)
+            with lock:
+                in_use[0] -= costs[run]
+        failures = RunScheduler(download, extract, 4, 4, run_costs=costs, scratch_budget=100).run(
+            ['A', 'B', 'C', 'D', 'E'])
+        self.assertEqual([], failures)
+        self.assertEqual(100, max_in_use[0])
+        # B does not fit alongside A, so smaller runs are started first
+        self.assertEqual(['A', 'C', 'D'], sorted(started[:3]))
+
+    def test_scratch_budget_oversized_runs_run_alone(self):
+        lock = threading.Lock()
+        active = [0]
+        max_active = [0]
+        def download(run):
+            with lock:
+                active[0] += 1
+                max_active[0] = max(max_active[0], active[0])
+            time.sleep(0.02)
+            return run
+        def extract(run):
+            with lock:
+                active[0] -= 1
+        costs = {'big': 500, 'unknown': None, 'small': 10}
+        failures = RunScheduler(download, extract, 3, 3, run_costs=costs, scratch_budget=100).run(
+            ['big', 'unknown', 'small'])
+        self.assertEqual([], failures)
+        self.assertEqual(1, max_active[0])
+
+    def test_scratch_released_on_failure(self):
+        def download(run):
+            if run == 'bad':
+                raise Exception("download failed")
+            return run
+        failures = RunScheduler(download, lambda run: None, 2, 2,
+            run_costs={'bad': 100, 'good': 100}, scratch_budget=100).run(['bad', 'good'])
+        self.assertEqual(['bad'], [f.run_identifier for f in failures])
+
+
+    def test_queue_depth_requires_concurrency(self):
+        with self.assertRaisesRegex(Exception, 'pipeline queue depth'):
+            kingfisher._download_and_extract_runs(['SRR1'], pipeline_queue_depth=2, download_methods=['not-a-method'])
+
+
+    def test_scratch_budget_requires_concurrency(self):
+        with self.assertRaisesRegex(Exception, 'scratch space budget'):
+            kingfisher._download_and_extract_runs(['SRR1'], scratch_budget=10, run_costs={'SRR1': 5},
+                download_methods=['not-a-method'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+
+import unittest
+import os.path
+import sys
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from bird_tool_utils import in_tempdir
+
+import kingfisher
+from kingfisher.sharding import parse_shard, shard_by_hash, shard_by_size, RunLock
+
+class Tests(unittest.TestCase):
+    maxDiff = None
+
+    def test_parse_shard(self):
+        self.assertEqual((1, 4), parse_shard('1/4'))
+        self.assertEqual((4, 4), parse_shard('4/4'))
+        for bad in ['0/4', '5/4', '1/0', '1', 'a/b']:
+            with self.assertRaises(Exception):
+                parse_shard(bad)
+
+    def test_shard_by_hash(self):
+        runs = ['SRR{}'.format(i) for i in range(100)]
+        shards = [shard_by_hash(runs, i, 3) for i in range(1, 4)]
+        self.assertEqual(sorted(runs), sorted(shards[0] + shards[1] + shards[2]))
+        for shard in shards:
+            self.assertTrue(len(shard) > 0)
+        # Stable regardless of the other runs given
+        self.assertEqual([r for r in shards[1] if r in runs[:50]], shard_by_hash(runs[:50], 2, 3))
+
+    def test_shard_by_size(self):
+        sizes = {'A': 100, 'B': 60, 'C': 50, 'D': 40, 'E': 10}
+        runs = ['A', 'B', 'C', 'D', 'E', 'unknown']
+        shard1 = shard_by_size(runs, sizes, 1, 2)
+        shard2 = shard_by_size(runs, sizes, 2, 2)
+        self.assertEqual(sorted(runs), sorted(shard1 + shard2))
+        self.assertEqual(['A', 'D'], [r for r in shard1 if r != 'unknown'])
+        self.assertEqual(['B', 'C', 'E'], [r for r in shard2 if r != 'unknown'])
+
+    def test_run_lock(self):
+        with in_tempdir():
+            lock1 = RunLock('.', 'SRR1')
+            lock2 = RunLock('.', 'SRR1')
+            self.assertTrue(lock1.acquire())
+            self.assertTrue(os.path.exists(lock1.path))
+            self.assertFalse(lock2.acquire())
+            self.assertTrue(RunLock('.', 'SRR2').acquire())
+            lock1.release()
+            self.assertFalse(os.path.exists(lock1.path))
+            self.assertTrue(lock2.acquire())
+            lock2.release()
+
+    def test_locked_runs_are_skipped(self):
+        with in_tempdir():
+            lock = RunLock(os.path.abspath('.'), 'SRR1')
+            self.assertTrue(lock.acquire())
+            # The unknown download method is not reached
+            locked_runs = []
+            self.assertEqual([], kingfisher.download_and_extract_one_run(
+                'SRR1', download_methods=['not-a-method'], output_directory='.', lock_runs=True,
+                locked_runs=locked_runs))
+            self.assertEqual(['SRR1'], locked_runs)
+            lock.release()
+
+    def test_locked_runs_reported(self):
+        with in_tempdir():
+            lock = RunLock(os.path.abspath('.'), 'SRR1')
+            self.assertTrue(lock.acquire())
+            # Skipping a run locked by a cooperating process is not an error
+            with self.assertLogs(level='WARNING') as logs:
+                kingfisher._download_and_extract_runs(
+                    ['SRR1'], download_methods=['not-a-method'], output_directory='.', lock_runs=True)
+            self.assertTrue(any(['another process held their lock: SRR1' in line for line in logs.output]))
+            lock.release()
+
+    def test_lock_released_after_failed_download(self):
+        with in_tempdir():
+            with self.assertRaises(Exception):
+                kingfisher.download_and_extract_one_run(
+                    'SRR1', download_methods=['not-a-method'], output_directory='.', lock_runs=True)
+            lock = RunLock(os.path.abspath('.'), 'SRR1')
+            self.assertTrue(lock.acquire())
+            lock.release()
+
+    def test_runs_not_locked_by_default(self):
+        with in_tempdir():
+            lock = RunLock(os.path.abspath('.'), 'SRR1')
+            self.assertTrue(lock.acquire())
+            # The lock is ignored, so the unknown download method is reached
+            with self.assertRaises(Exception):
+                kingfisher.download_and_extract_one_run(
+                    'SRR1', download_methods=['not-a-method'], output_directory='.')
+            lock.release()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+
+import unittest
+import os.path
+import sys
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from kingfisher import _spot_ranges, _spot_slice_dump_command, _spot_dump_command, extract
+from kingfisher.subsample import Subsample
+
+class Tests(unittest.TestCase):
+    maxDiff = None
+
+    def test_spot_ranges(self):
+        self.assertEqual([(1, 10)], _spot_ranges(10, 1))
+        self.assertEqual([(1, 3), (4, 6), (7, 10)], _spot_ranges(10, 3))
+        self.assertEqual([(1, 5), (6, 10)], _spot_ranges(10, 2))
+
+    def test_spot_ranges_more_slices_than_spots(self):
+        self.assertEqual([(1, 1), (2, 2)], _spot_ranges(2, 4))
+
+    def test_spot_ranges_no_spots(self):
+        self.assertEqual([], _spot_ranges(0, 4))
+
+    def test_spot_slice_dump_command(self):
+        self.assertEqual("fastq-dump --split-spot --skip-technical "
+            "--defline-seq '@$ac.$si $sn length=$rl' --defline-qual '+$ac.$si $sn length=$rl' "
+            "--stdout -N 11 -X 20 /tmp/SRR1.sra",
+            _spot_slice_dump_command('/tmp/SRR1.sra', 11, 20))
+
+    def test_spot_dump_command(self):
+        self.assertEqual(('fastq-dump', "fastq-dump --split-spot --skip-technical "
+            "--defline-seq '@$ac.$si $sn length=$rl' --defline-qual '+$ac.$si $sn length=$rl' "
+            "--stdout -X 5 /tmp/SRR1.sra"),
+            _spot_dump_command('/tmp/SRR1.sra', 4, Subsample(max_reads=5)))
+        self.assertEqual(('fasterq-dump', "fasterq-dump --split-spot --stdout --threads 4 /tmp/SRR1.sra"),
+            _spot_dump_command('/tmp/SRR1.sra', 4, Subsample(fraction=0.5)))
+
+    def test_spot_ranges_cover_all_spots(self):
+        for num_spots in (1, 7, 1000003):
+            for num_slices in (1, 2, 5, 16):
+                ranges = _spot_ranges(num_spots, num_slices)
+                self.assertEqual(1, ranges[0][0])
+                self.assertEqual(num_spots, ranges[-1][1])
+                for (previous, current) in zip(ranges, ranges[1:]):
+                    self.assertEqual(previous[1] + 1, current[0])
+
+    def test_slices_incompatible_with_unsorted(self):
+        with self.assertRaises(Exception):
+            extract(sra_file='SRR1.sra', unsorted=True, extraction_slices=2)
+
+if __name__ == "__main__":
+    unittest.main()
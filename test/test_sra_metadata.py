@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+
+import unittest
+import os.path
+import sys
+import io
+import re
+import tempfile
+import threading
+import time
+import random
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+path_to_data = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data'))
+
+import pandas as pd
+
+from kingfisher import _output_formatted_metadata
+from kingfisher import sra_metadata
+from kingfisher.sra_metadata import SraMetadata, AdaptiveChunkSize
+
+
+class StandInChunkMetadata(SraMetadata):
+    '''Answers queries for chunks of accessions without going to NCBI, taking
+    a random time, and failing the queries given.'''
+    def __init__(self, failing_calls=(), missing=()):
+        self.calls = []
+        self.failing_calls = failing_calls
+        self.missing = missing
+        self.lock = threading.Lock()
+
+    def _efetch_chunk(self, accessions, columns=None):
+        with self.lock:
+            self.calls.append(list(accessions))
+            call = len(self.calls)
+        time.sleep(random.random() * 0.01)
+        if call in self.failing_calls:
+            raise Exception("HTTP Failure: 502")
+        found = [a for a in accessions if a not in self.missing]
+        if len(found) == 0:
+            return None
+        return pd.DataFrame({
+            'run': found,
+            'study_accession': ['SRP{}'.format(int(a[3:]) % 3) for a in found],
+            'model': pd.Categorical(['Model {}'.format(int(a[3:]) // 100) for a in found]),
+        })
+
+class StandInBioprojectMetadata(SraMetadata):
+    '''Answers a BioProject search with count experiments, each with one run,
+    without going to NCBI, recording the pages fetched.'''
+    def __init__(self, count):
+        self.count = count
+        self.pages = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def _eutils_request(self, method, endpoint, **kwargs):
+        class Response:
+            ok = True
+            text = '<eSearchResult><Count>{}</Count><RetMax>0</RetMax><QueryKey>1</QueryKey>' \
+                '<WebEnv>MCID_1</WebEnv><IdList/></eSearchResult>'.format(self.count)
+        return Response()
+
+    def _efetch_page(self, webenv, query_key, retstart, retmax):
+        with self.lock:
+            self.pages.append(retstart)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(random.random() * 0.01)
+        with self.lock:
+            self.in_flight -= 1
+        return ['SRR{}'.format(i) for i in range(retstart, min(retstart + retmax, self.count))]
+
+class Tests(unittest.TestCase):
+    maxDiff = None
+
+    def parse_fixture(self, accessions=None, columns=None):
+        with open(os.path.join(path_to_data, 'efetch_ERR1739691.xml')) as f:
+            return SraMetadata.parse_efetch_metadata(f.read(), accessions, columns)
+
+    def test_parse_efetch_metadata(self):
+        metadata = self.parse_fixture()
+        self.assertEqual(['ERR1739691'], metadata['run'].to_list())
+        self.assertEqual(['PRJEB15706'], metadata['bioproject'].to_list())
+        self.assertEqual([2381690400], metadata['bases'].to_list())
+        self.assertEqual(['MM1_1'], metadata['sample_name'].to_list())
+        self.assertEqual(['PAIRED'], metadata['library_layout'].to_list())
+        self.assertEqual(['Illumina HiSeq 2500'], metadata['model'].to_list())
+        self.assertEqual([' '], metadata['organisation_contact_name'].to_list())
+        self.assertEqual(['[]'], metadata['study_links'].to_list())
+
+    def test_parse_efetch_metadata_types(self):
+        metadata = self.parse_fixture()
+        for column in ['number_of_runs_for_sample', 'spots', 'bases', 'run_size']:
+            self.assertEqual('Int64', str(metadata[column].dtype))
+        for column in ['library_strategy', 'library_source', 'library_selection', 'library_layout', 'platform', 'model']:
+            self.assertEqual('category', str(metadata[column].dtype))
+        # Integral, so output without .0
+        for column in ['read1_length_average', 'read1_length_stdev', 'read2_length_average', 'read2_length_stdev']:
+            self.assertEqual('Int64', str(metadata[column].dtype))
+        self.assertEqual([150], metadata['read1_length_average'].to_list())
+        self.assertEqual([0], metadata['read1_length_stdev'].to_list())
+
+    def test_read_length_types(self):
+        self.assertEqual('Int64', str(sra_metadata._read_length_array([150.0, float('nan')]).dtype))
+        lengths = sra_metadata._read_length_array([150.0, 142.5, float('nan')])
+        self.assertEqual('Float64', str(lengths.dtype))
+        self.assertEqual([150.0, 142.5], lengths[:2].tolist())
+        # Columns built without a dtype are retyped
+        metadata = sra_metadata._set_column_types(pd.DataFrame([
+            {'run': 'SRR1', 'read1_length_average': 150.0}, {'run': 'SRR2'}]))
+        self.assertEqual('Int64', str(metadata['read1_length_average'].dtype))
+        self.assertEqual([150, None], [None if pd.isna(v) else v for v in metadata['read1_length_average']])
+
+    def test_output_missing_bases(self):
+        metadata = pd.concat([self.parse_fixture(), self.parse_fixture()], ignore_index=True)
+        metadata.loc[1, 'run'] = 'ERR2'
+        metadata.loc[1, 'bases'] = pd.NA
+        with tempfile.NamedTemporaryFile(suffix='.csv') as f:
+            _output_formatted_metadata(metadata, f.name, 'csv', False, ['run', 'Gbp', 'model'])
+            with open(f.name) as g:
+                self.assertEqual(['run,Gbp,model', 'ERR1739691,2.382,Illumina HiSeq 2500', 'ERR2,,Illumina HiSeq 2500'],
+                    g.read().splitlines())
+        with tempfile.NamedTemporaryFile(suffix='.txt') as f:
+            _output_formatted_metadata(metadata, f.name, 'human', False, ['run', 'Gbp'])
+            with open(f.name) as g:
+                self.assertEqual(['run        | Gbp  ', '---------- | -----', 'ERR1739691 | 2.382', 'ERR2       |      '],
+                    g.read().splitlines())
+
+    def test_parse_efetch_metadata_accessions(self):
+        self.assertEqual(0, len(self.parse_fixture(['ERR1'])))
+        self.assertEqual(1, len(self.parse_fixture(['ERR1739691'])))
+
+    def test_parse_efetch_metadata_stream(self):
+        with open(os.path.join(path_to_data, 'efetch_ERR1739691.xml')) as f:
+            fixture = f.read()
+        start = fixture.index('<EXPERIMENT_PACKAGE>')
+        end = fixture.index('</EXPERIMENT_PACKAGE>') + len('</EXPERIMENT_PACKAGE>')
+        package = fixture[start:end]
+        # A second package without read statistics or sample attributes, so
+        # that some columns are missing from some rows
+        stripped = re.sub(r'<Statistics.*?</Statistics>', '', package.replace('ERR1739691', 'ERR2'), flags=re.S)
+        stripped = re.sub(r'<SAMPLE_ATTRIBUTES>.*?</SAMPLE_ATTRIBUTES>', '', stripped, flags=re.S)
+        xml = fixture[:start] + stripped + package + stripped.replace('ERR2', 'ERR3') + fixture[end:]
+        with tempfile.NamedTemporaryFile(suffix='.xml') as f:
+            f.write(xml.encode())
+            f.flush()
+            with open(f.name, 'rb') as g:
+                metadata = SraMetadata.parse_efetch_metadata_stream(g)
+        self.assertEqual(['ERR2', 'ERR1739691', 'ERR3'], metadata['run'].to_list())
+        # The same as building the DataFrame from a dict per run
+        expected = sra_metadata._set_column_types(pd.DataFrame(list(SraMetadata._iter_efetch_runs(io.StringIO(xml), None))))
+        pd.testing.assert_frame_equal(expected, metadata)
+        self.assertTrue(pd.isna(metadata['read1_length_average'][0]))
+
+    def test_output_all_columns_csv(self):
+        with tempfile.NamedTemporaryFile(suffix='.csv') as f:
+            _output_formatted_metadata(self.parse_fixture(), f.name, 'csv', True)
+            with open(f.name) as g:
+                lines = g.read().splitlines()
+        self.assertEqual(2, len(lines))
+        self.assertTrue(lines[0].startswith('run,bioproject,Gbp,library_strategy,library_selection,model,sample_name,taxon_name,experiment_accession,'))
+        self.assertTrue(lines[0].endswith(',study_links,number_of_runs_for_sample,spots,bases,run_size,published,read1_length_average,read1_length_stdev,read2_length_average,read2_length_stdev'))
+        self.assertTrue(lines[1].startswith('ERR1739691,PRJEB15706,2.382,WGS,RANDOM,Illumina HiSeq 2500,MM1_1,metagenome,ERX1809317,'))
+        self.assertTrue(lines[1].endswith(',[],1,7938968,2381690400,936643449,2017-06-13 08:05:22,150,0,150,0'))
+
+    def test_parse_efetch_metadata_columns(self):
+        metadata = self.parse_fixture(columns=['sample_name', 'bases', 'depth', 'read2_length_average', 'no_such_column'])
+        self.assertEqual(['depth', 'sample_name', 'bases', 'run', 'read2_length_average'], list(metadata.columns))
+        all_columns = self.parse_fixture()
+        for column in metadata.columns:
+            self.assertEqual(all_columns[column].to_list(), metadata[column].to_list())
+
+    def test_wants_sample_attributes(self):
+        self.assertTrue(sra_metadata._wants_sample_attributes(None))
+        self.assertTrue(sra_metadata._wants_sample_attributes(set(['run', 'sample_name'])))
+        self.assertTrue(sra_metadata._wants_sample_attributes(set(['run', 'depth'])))
+        self.assertFalse(sra_metadata._wants_sample_attributes(set(['run', 'bases'])))
+        self.assertFalse(sra_metadata._wants_sample_attributes(
+            set(['run', 'read1_length_average', 'read2_length_stdev'])))
+
+    def test_output_columns_csv(self):
+        metadata = self.parse_fixture(columns=['bases', 'taxon_name', 'no_such_column'])
+        with tempfile.NamedTemporaryFile(suffix='.csv') as f:
+            _output_formatted_metadata(metadata, f.name, 'csv', False, ['taxon_name', 'Gbp', 'run', 'no_such_column'])
+            with open(f.name) as g:
+                lines = g.read().splitlines()
+        self.assertEqual(['taxon_name,Gbp,run,no_such_column', 'metagenome,2.382,ERR1739691,'], lines)
+
+    def test_run_pages_from_bioprojects(self):
+        # More experiments than esearch returns at once
+        metadata = StandInBioprojectMetadata(25001)
+        runs = []
+        for page in metadata.run_pages_from_bioprojects(['PRJNA1'], page_size=1000, num_workers=3):
+            runs.extend(page)
+        self.assertEqual(['SRR{}'.format(i) for i in range(25001)], runs)
+        self.assertEqual(26, len(metadata.pages))
+        self.assertLessEqual(metadata.max_in_flight, 3)
+
+    def test_run_pages_fetched_ahead_bounded(self):
+        metadata = StandInBioprojectMetadata(100000)
+        pages = metadata.run_pages_from_bioprojects(['PRJNA1'], page_size=100, num_workers=4)
+        self.assertEqual(['SRR{}'.format(i) for i in range(100)], next(pages))
+        time.sleep(0.1)
+        # Only the pages needed next are fetched while the first is used
+        self.assertLessEqual(len(metadata.pages), 5)
+        pages.close()
+        self.assertLessEqual(len(metadata.pages), 5)
+
+    def test_run_pages_from_bioprojects_none_found(self):
+        self.assertEqual([], StandInBioprojectMetadata(0).fetch_runs_from_bioprojects(['PRJNA1']))
+
+    def test_chunks_reassembled_in_order(self):
+        accessions = ['SRR{}'.format(i) for i in range(1234)]
+        original = (sra_metadata.EFETCH_CHUNK_SIZE, sra_metadata.EFETCH_RETRY_SECONDS)
+        sra_metadata.EFETCH_CHUNK_SIZE, sra_metadata.EFETCH_RETRY_SECONDS = 100, 0
+        try:
+            metadata = StandInChunkMetadata(failing_calls=[2, 5])
+            result = metadata.efetch_sra_from_accessions(list(reversed(accessions)) + accessions[:10], num_workers=4)
+            expected = StandInChunkMetadata().efetch_sra_from_accessions(accessions, num_workers=1)
+        finally:
+            sra_metadata.EFETCH_CHUNK_SIZE, sra_metadata.EFETCH_RETRY_SECONDS = original
+        # Each accession was found once, despite failures
+        self.assertEqual(sorted(accessions), sorted(result['run'].to_list()))
+        # Still categorical, though each chunk had different categories
+        self.assertEqual('category', str(result['model'].dtype))
+        self.assertEqual(expected.values.tolist(), result.values.tolist())
+        # Failed chunks were retried in smaller pieces
+        self.assertEqual(set(accessions), set([a for call in metadata.calls for a in call]))
+        self.assertLess(min([len(call) for call in metadata.calls]), 100)
+
+    def test_chunk_not_found(self):
+        self.assertIsNone(StandInChunkMetadata(missing=['SRR1']).efetch_sra_from_accessions(['SRR1']))
+
+    def test_chunk_failing_repeatedly(self):
+        original = sra_metadata.EFETCH_RETRY_SECONDS
+        sra_metadata.EFETCH_RETRY_SECONDS = 0
+        try:
+            with self.assertRaises(Exception):
+                StandInChunkMetadata(failing_calls=[1, 2, 3]).efetch_sra_from_accessions(['SRR1'])
+        finally:
+            sra_metadata.EFETCH_RETRY_SECONDS = original
+
+    def test_adaptive_chunk_size(self):
+        size = AdaptiveChunkSize(100, 10, 200, 5)
+        size.succeeded(100, 1)
+        self.assertEqual(150, size.size)
+        # Slow, or smaller than the current size
+        size.succeeded(150, 6)
+        size.succeeded(100, 1)
+        self.assertEqual(150, size.size)
+        size.succeeded(150, 1)
+        self.assertEqual(200, size.size)
+        for _ in range(10):
+            size.failed()
+        self.assertEqual(10, size.size)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+
+
+import unittest
+import os.path
+import sys
+import gzip
+import io
+import shutil
+import threading
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from functools import partial
+
+import extern
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from bird_tool_utils import in_tempdir
+
+from kingfisher import ena
+from kingfisher.ena import EnaDownloader, EnaFileReport
+from kingfisher.fastx import split_spots_command
+from kingfisher.subsample import Subsample, subsample_fastq_files, subsample_fastq_streams, paired_groups, interleave_fastq_streams
+
+
+def record(spot, read):
+    return '@SRR1.{0} {0}/{1}\nACGT\n+\nIIII\n'.format(spot, read).encode()
+
+def interleaved(num_spots):
+    # As output by fasterq-dump --split-spot, where every third spot has only
+    # one read
+    return b''.join([record(i, r) for i in range(1, num_spots+1) for r in ([1] if i % 3 == 0 else [1, 2])])
+
+def spot_numbers(fastq):
+    return [int(line.split(b' ')[0][len(b'@SRR1.'):]) for line in fastq.split(b'\n')[0::4] if line != b'']
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class Tests(unittest.TestCase):
+    maxDiff = None
+
+    def write_gz(self, path, content):
+        with gzip.open(path, 'wb') as f:
+            f.write(content)
+
+    def read(self, path):
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rb') as f:
+            return f.read()
+
+    def test_select_max_reads(self):
+        self.assertEqual([0, 1, 2], list(Subsample(max_reads=3).select(iter(range(10)))))
+        self.assertEqual([0, 1], list(Subsample(max_reads=3).select(iter(range(2)))))
+
+    def test_select_max_reads_stops_reading(self):
+        spots = iter(range(10))
+        list(Subsample(max_reads=3).select(spots))
+        self.assertEqual(3, next(spots))
+
+    def test_select_fraction(self):
+        kept = list(Subsample(fraction=0.5, seed=1).select(range(1000)))
+        self.assertTrue(400 < len(kept) < 600)
+        self.assertEqual(sorted(kept), kept)
+        self.assertEqual(kept, list(Subsample(fraction=0.5, seed=1).select(range(1000))))
+        self.assertNotEqual(kept, list(Subsample(fraction=0.5, seed=2).select(range(1000))))
+        self.assertEqual(kept[:10], list(Subsample(fraction=0.5, max_reads=10, seed=1).select(range(1000))))
+
+    def test_select_reservoir(self):
+        kept = list(Subsample(reservoir_reads=10, seed=3).select(range(1000)))
+        self.assertEqual(10, len(kept))
+        self.assertEqual(sorted(kept), kept)
+        self.assertEqual(kept, list(Subsample(reservoir_reads=10, seed=3).select(range(1000))))
+        self.assertEqual([0, 1, 2], list(Subsample(reservoir_reads=10).select(range(3))))
+
+    def test_invalid(self):
+        with self.assertRaises(Exception):
+            Subsample(max_reads=0)
+        with self.assertRaises(Exception):
+            Subsample(fraction=1.5)
+        with self.assertRaises(Exception):
+            Subsample(reservoir_reads=5, max_reads=5)
+        self.assertIsNone(Subsample.from_options())
+
+    def test_paired_groups(self):
+        self.assertEqual([['d/SRR1_1.fastq.gz', 'd/SRR1_2.fastq.gz'], ['d/SRR1.fastq.gz']],
+            paired_groups(['d/SRR1_2.fastq.gz', 'd/SRR1.fastq.gz', 'd/SRR1_1.fastq.gz']))
+        self.assertEqual([['SRR1_1.fastq.gz']], paired_groups(['SRR1_1.fastq.gz']))
+
+    def test_subsample_files_keeps_pairs_together(self):
+        with in_tempdir():
+            self.write_gz('SRR1_1.fastq.gz', b''.join([record(i, 1) for i in range(1, 101)]))
+            self.write_gz('SRR1_2.fastq.gz', b''.join([record(i, 2) for i in range(1, 101)]))
+            num_kept = subsample_fastq_files([['SRR1_1.fastq.gz', 'SRR1_2.fastq.gz']],
+                [['SRR1_1.fastq.gz', 'SRR1_2.fastq.gz']], Subsample(fraction=0.3))
+            forward = spot_numbers(self.read('SRR1_1.fastq.gz'))
+            self.assertEqual(num_kept, len(forward))
+            self.assertTrue(0 < num_kept < 100)
+            self.assertEqual(forward, spot_numbers(self.read('SRR1_2.fastq.gz')))
+            self.assertEqual(['SRR1_1.fastq.gz', 'SRR1_2.fastq.gz'], sorted(os.listdir('.')))
+
+    def test_subsample_files_to_fasta(self):
+        with in_tempdir():
+            self.write_gz('SRR1.fastq.gz', interleaved(3))
+            subsample_fastq_files([['SRR1.fastq.gz']], [['SRR1.fasta']], Subsample(max_reads=2))
+            self.assertEqual(b'>SRR1.1 1/1\nACGT\n>SRR1.1 1/2\nACGT\n', self.read('SRR1.fasta'))
+
+    def test_subsample_files_unequal_pair(self):
+        with in_tempdir():
+            self.write_gz('SRR1_1.fastq.gz', record(1, 1) + record(2, 1))
+            self.write_gz('SRR1_2.fastq.gz', record(1, 2))
+            with self.assertRaises(Exception):
+                subsample_fastq_files([['SRR1_1.fastq.gz', 'SRR1_2.fastq.gz']],
+                    [['SRR1_1.fastq', 'SRR1_2.fastq']], Subsample(fraction=1))
+            self.assertEqual(['SRR1_1.fastq.gz', 'SRR1_2.fastq.gz'], sorted(os.listdir('.')))
+
+    def test_interleave_streams(self):
+        forward = io.BytesIO(record(1, 1) + record(2, 1))
+        reverse = io.BytesIO(record(1, 2) + record(2, 2))
+        output = io.BytesIO()
+        self.assertEqual(2, interleave_fastq_streams([[forward, reverse]], output, 'fastq'))
+        self.assertEqual(record(1, 1) + record(1, 2) + record(2, 1) + record(2, 2), output.getvalue())
+
+    def test_interleave_streams_fasta_gz_subsampled(self):
+        output = io.BytesIO()
+        self.assertEqual(1, interleave_fastq_streams([[io.BytesIO(interleaved(3))]], output, 'fasta.gz', Subsample(max_reads=1)))
+        self.assertEqual(b'>SRR1.1 1/1\nACGT\n', gzip.decompress(output.getvalue()))
+
+    def test_subsample_streams_interrupted(self):
+        with in_tempdir():
+            truncated = io.BytesIO(interleaved(5) + b'@SRR1.6 6/1\nACGT\n')
+            with self.assertRaises(Exception):
+                subsample_fastq_streams([[truncated]], [['SRR1.fastq.gz']], Subsample(fraction=1))
+            # Neither a truncated output nor its temporary file is left
+            self.assertEqual([], os.listdir('.'))
+
+    def test_subsample_files_counts_across_groups(self):
+        with in_tempdir():
+            self.write_gz('SRR1_1.fastq.gz', b''.join([record(i, 1) for i in range(1, 4)]))
+            self.write_gz('SRR1_2.fastq.gz', b''.join([record(i, 2) for i in range(1, 4)]))
+            self.write_gz('SRR1.fastq.gz', record(4, 1) + record(5, 1))
+            groups = [['SRR1_1.fastq.gz', 'SRR1_2.fastq.gz'], ['SRR1.fastq.gz']]
+            self.assertEqual(4, subsample_fastq_files(groups, groups, Subsample(max_reads=4)))
+            self.assertEqual([1, 2, 3], spot_numbers(self.read('SRR1_1.fastq.gz')))
+            self.assertEqual([4], spot_numbers(self.read('SRR1.fastq.gz')))
+            self.assertEqual(2, subsample_fastq_files(groups, groups, Subsample(max_reads=2)))
+            self.assertEqual(['SRR1_1.fastq.gz', 'SRR1_2.fastq.gz'], sorted(os.listdir('.')))
+
+    def split_spots(self, num_spots, subsample):
+        extern.run(split_spots_command(os.path.abspath('SRR1'), 'fastq', 1, subsample), stdin=interleaved(num_spots))
+        return [spot_numbers(self.read(f)) if os.path.exists(f) else [] for f in ['SRR1_1.fastq', 'SRR1_2.fastq', 'SRR1.fastq']]
+
+    @unittest.skipIf(shutil.which('awk') is None, 'awk is not installed')
+    def test_split_spots_max_reads(self):
+        with in_tempdir():
+            self.assertEqual([[1, 2, 4], [1, 2, 4], [3]], self.split_spots(20, Subsample(max_reads=4)))
+
+    @unittest.skipIf(shutil.which('awk') is None, 'awk is not installed')
+    def test_split_spots_fraction(self):
+        with in_tempdir():
+            forward, reverse, single = self.split_spots(300, Subsample(fraction=0.5, max_reads=100))
+            self.assertEqual(forward, reverse)
+            self.assertEqual(100, len(forward) + len(single))
+            self.assertTrue(all([i % 3 != 0 for i in forward]))
+            self.assertTrue(all([i % 3 == 0 for i in single]))
+            self.assertLess(max(forward + single), 300)
+
+    @unittest.skipIf(shutil.which('awk') is None, 'awk is not installed')
+    def test_split_spots_reservoir(self):
+        with in_tempdir():
+            forward, reverse, single = self.split_spots(300, Subsample(reservoir_reads=25, seed=7))
+            self.assertEqual(forward, reverse)
+            self.assertEqual(sorted(forward), forward)
+            self.assertEqual(sorted(single), single)
+            self.assertEqual(25, len(forward) + len(single))
+            for f in os.listdir('.'):
+                os.remove(f)
+            self.assertEqual([forward, reverse, single], self.split_spots(300, Subsample(reservoir_reads=25, seed=7)))
+
+    def subsample_split_files(self, num_spots, subsample):
+        # The same reads as split_spots reads, but in the files ENA would
+        # provide, subsampled as when downloading from ENA
+        spots = [(i, [1] if i % 3 == 0 else [1, 2]) for i in range(1, num_spots+1)]
+        self.write_gz('ENA1_1.fastq.gz', b''.join([record(i, 1) for (i, reads) in spots if len(reads) == 2]))
+        self.write_gz('ENA1_2.fastq.gz', b''.join([record(i, 2) for (i, reads) in spots if len(reads) == 2]))
+        self.write_gz('ENA1.fastq.gz', b''.join([record(i, 1) for (i, reads) in spots if len(reads) == 1]))
+        groups = paired_groups(['ENA1.fastq.gz', 'ENA1_1.fastq.gz', 'ENA1_2.fastq.gz'])
+        return subsample_fastq_files(groups, groups, subsample)
+
+    @unittest.skipIf(shutil.which('awk') is None, 'awk is not installed')
+    def test_split_spots_and_ena_counts_agree(self):
+        for subsample in [Subsample(max_reads=5), Subsample(max_reads=150), Subsample(max_reads=1000),
+                Subsample(reservoir_reads=25, seed=7), Subsample(reservoir_reads=1000)]:
+            with in_tempdir():
+                forward, _, single = self.split_spots(300, subsample)
+                self.assertEqual(len(forward) + len(single), self.subsample_split_files(300, subsample))
+
+    def test_ena_stream_interleaved(self):
+        with in_tempdir():
+            os.mkdir('served')
+            self.write_gz('served/SRR1_1.fastq.gz', b''.join([record(i, 1) for i in range(1, 4)]))
+            self.write_gz('served/SRR1_2.fastq.gz', b''.join([record(i, 2) for i in range(1, 4)]))
+            self.write_gz('served/SRR1.fastq.gz', record(4, 1))
+            server = ThreadingHTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory='served'))
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            original_scheme = ena.ENA_FASTQ_HTTP_SCHEME
+            ena.ENA_FASTQ_HTTP_SCHEME = 'http'
+            try:
+                host = '127.0.0.1:{}'.format(server.server_address[1])
+                downloader = EnaDownloader(file_reports={'SRR1': EnaFileReport(
+                    ['{}/{}'.format(host, f) for f in ['SRR1.fastq.gz', 'SRR1_1.fastq.gz', 'SRR1_2.fastq.gz']], ['x', 'y', 'z'])})
+                output = io.BytesIO()
+                self.assertEqual(4, downloader.stream_interleaved('SRR1', output, 'fastq'))
+                self.assertEqual(b''.join([record(i, r) for i in range(1, 4) for r in [1, 2]]) + record(4, 1),
+                    output.getvalue())
+                self.assertEqual(['served'], os.listdir('.'))
+
+                downloader.file_reports['SRR2'] = EnaFileReport(['{}/SRR2.fastq.gz'.format(host)], ['x'])
+                output = io.BytesIO()
+                self.assertFalse(downloader.stream_interleaved('SRR2', output, 'fastq'))
+                self.assertEqual(b'', output.getvalue())
+            finally:
+                ena.ENA_FASTQ_HTTP_SCHEME = original_scheme
+                server.shutdown()
+                server.server_close()
+
+    def test_ena_download_subsample(self):
+        with in_tempdir():
+            os.mkdir('served')
+            os.mkdir('out')
+            self.write_gz('served/SRR1_1.fastq.gz', b''.join([record(i, 1) for i in range(1, 10001)]))
+            self.write_gz('served/SRR1_2.fastq.gz', b''.join([record(i, 2) for i in range(1, 10001)]))
+            server = ThreadingHTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory='served'))
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            original_scheme = ena.ENA_FASTQ_HTTP_SCHEME
+            ena.ENA_FASTQ_HTTP_SCHEME = 'http'
+            try:
+                host = '127.0.0.1:{}'.format(server.server_address[1])
+                downloader = EnaDownloader(file_reports={'SRR1': EnaFileReport(
+                    ['{}/SRR1_1.fastq.gz'.format(host), '{}/SRR1_2.fastq.gz'.format(host)], ['x', 'y'])})
+                downloaded = downloader.download_subsample('SRR1', 'out', Subsample(max_reads=5))
+                self.assertEqual(['out/SRR1_1.fastq.gz', 'out/SRR1_2.fastq.gz'], downloaded)
+                self.assertEqual([1, 2, 3, 4, 5], spot_numbers(self.read('out/SRR1_1.fastq.gz')))
+                self.assertEqual([1, 2, 3, 4, 5], spot_numbers(self.read('out/SRR1_2.fastq.gz')))
+            finally:
+                ena.ENA_FASTQ_HTTP_SCHEME = original_scheme
+                server.shutdown()
+                server.server_close()
+
+    def test_ena_download_subsample_missing_file(self):
+        with in_tempdir():
+            os.mkdir('served')
+            server = ThreadingHTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory='served'))
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            original_scheme = ena.ENA_FASTQ_HTTP_SCHEME
+            ena.ENA_FASTQ_HTTP_SCHEME = 'http'
+            try:
+                host = '127.0.0.1:{}'.format(server.server_address[1])
+                downloader = EnaDownloader(file_reports={'SRR1': EnaFileReport(['{}/SRR1.fastq.gz'.format(host)], ['x'])})
+                self.assertFalse(downloader.download_subsample('SRR1', '.', Subsample(max_reads=5)))
+                self.assertFalse(os.path.exists('SRR1.fastq.gz'))
+            finally:
+                ena.ENA_FASTQ_HTTP_SCHEME = original_scheme
+                server.shutdown()
+                server.server_close()
+
+if __name__ == "__main__":
+    unittest.main()
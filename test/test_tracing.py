@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+#=======================================================================
+# Authors: Ben Woodcroft
+#
+# Unit tests.
+#
+# Copyright
+#
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.	See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License.
+# If not, see <http://www.gnu.org/licenses/>.
+#=======================================================================
+
+
+import unittest
+import os.path
+import sys
+import json
+
+sys.path = [os.path.join(os.path.dirname(os.path.realpath(__file__)),'..')]+sys.path
+
+from bird_tool_utils import in_tempdir
+
+import kingfisher
+from kingfisher import tracing
+from kingfisher.run_state import RunStateDatabase
+
+class Tests(unittest.TestCase):
+    maxDiff = None
+
+    def read_events(self, path):
+        with open(path) as f:
+            return json.load(f)['traceEvents']
+
+    def test_program_names(self):
+        self.assertEqual('fasterq-dump', tracing.program_names("cd '/tmp/out' && fasterq-dump --threads 4 /tmp/SRR1.sra"))
+        self.assertEqual('pigz|awk|pigz', tracing.program_names("pigz -cd a.gz |awk '{print}' |pigz -p 2 >b.gz"))
+        self.assertEqual('bash', tracing.program_names(['/bin/bash', '-c', 'true']))
+
+    def test_process_spans(self):
+        with in_tempdir():
+            tracing.start_tracing('trace.json')
+            self.assertEqual('hi\n', tracing.run('echo hi |cat'))
+            with self.assertRaises(Exception):
+                tracing.check_call('exit 3', shell=True)
+            tracing.stop_tracing()
+            self.assertFalse(tracing.is_tracing())
+
+            events = self.read_events('trace.json')
+            spans = [e for e in events if e['ph'] == 'X']
+            self.assertEqual(['echo|cat', 'exit'], [e['name'] for e in spans])
+            self.assertEqual('process', spans[0]['cat'])
+            self.assertTrue(spans[0]['dur'] >= 0)
+            self.assertTrue('child_user_cpu_seconds' in spans[0]['args'])
+            self.assertTrue('child_max_rss_kb' in spans[0]['args'])
+            self.assertTrue('error' in spans[1]['args'])
+            self.assertEqual(1, len([e for e in events if e['ph'] == 'M']))
+
+    def test_not_tracing(self):
+        with tracing.span('nothing', 'run') as args:
+            args['x'] = 1
+        self.assertEqual('hi\n', tracing.run('echo hi'))
+
+    def test_trace_file_from_download_and_extract(self):
+        with in_tempdir():
+            db = RunStateDatabase('.')
+            db.record('SRR1', RunStateDatabase.PHASE_EXTRACTED, output_files=['SRR1.fasta'])
+            db.close()
+            kingfisher.download_and_extract(
+                run_identifiers=['SRR1'],
+                run_identifiers_file=None,
+                download_methods=['not-a-method'],
+                output_format_possibilities=['fasta'],
+                location_cache_ttl=0,
+                run_state_database=True,
+                trace_file='trace.json')
+            self.assertEqual(['download SRR1', 'extract SRR1'],
+                [e['name'] for e in self.read_events('trace.json') if e['ph'] == 'X'])
+
+
+if __name__ == "__main__":
+    unittest.main()